@@ -17,12 +17,19 @@
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
 from django.contrib import admin
-from models import ThirdPartyAccount, YoutubeSyncRule
+from models import SyncPush, ThirdPartyAccount, YoutubeSyncRule
 
 
 class ThirdPartyAccountAdmin(admin.ModelAdmin):
     list_display = ('type', 'username',)
 
 
+class SyncPushAdmin(admin.ModelAdmin):
+    list_display = ('video_url', 'language_code', 'account', 'action',
+                    'attempts', 'next_attempt')
+    raw_id_fields = ('video_url', 'version')
+
+
 admin.site.register(ThirdPartyAccount, ThirdPartyAccountAdmin)
 admin.site.register(YoutubeSyncRule)
+admin.site.register(SyncPush, SyncPushAdmin)
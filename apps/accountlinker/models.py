@@ -18,7 +18,10 @@
 
 import logging
 
-from django.db import models
+from datetime import datetime
+
+from django.db import IntegrityError, models
+from django.db.models import F
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured, ValidationError
 
@@ -36,6 +39,9 @@ logger = logging.getLogger(__name__)
 # for now, they kind of match
 ACCOUNT_TYPES = VIDEO_TYPE
 
+# Video types we know how to push subtitles to.
+SYNC_VIDEO_TYPES = (VIDEO_TYPE_YOUTUBE,)
+
 
 def youtube_sync(video, language):
     """
@@ -151,6 +157,10 @@ class ThirdPartyAccountManager(models.Manager):
         This method is 'safe' to call, meaning that we only do syncing if there 
         are matching third party credentials for this video.
         The update will only be done if the version is synced
+
+        Nothing is pushed right away: the push is added to the SyncPush
+        outbox, where it replaces any older pending push of the same language
+        to the same video, and is done by accountlinker.sync.
         """
         if action not in [UPDATE_VERSION_ACTION, DELETE_LANGUAGE_ACTION]:
             raise NotImplementedError(
@@ -174,38 +184,34 @@ class ThirdPartyAccountManager(models.Manager):
         except IndexError:
             should_sync = False
 
+        if isinstance(language, basestring):
+            language_code = language
+        elif version:
+            language_code = version.subtitle_language.language_code
+        else:
+            language_code = language.language_code
+
         for vurl in video.videourl_set.all():
-            already_updated = False
-            vt = video_type_registrar.video_type_for_url(vurl.url)
-
-            if should_sync:
-                try:
-                    vt.update_subtitles(version, always_push_account)
-                    already_updated = True
-                    Meter('youtube.push.success').inc()
-                except:
-                    Meter('youtube.push.fail').inc()
-                    logger.error('Pushing to youtoube has failed.', extra={
-                        'video': video.video_id,
-                        'vurl': vurl.pk
-                    })
-                finally:
-                    Meter('youtube.push.request').inc()
+            if vurl.type not in SYNC_VIDEO_TYPES:
+                continue
+
+            already_queued = False
+            if should_sync and action == UPDATE_VERSION_ACTION:
+                SyncPush.objects.enqueue(vurl, always_push_account,
+                                         language_code, action, version)
+                already_queued = True
 
             username = vurl.owner_username
 
-            if not username:
+            if not username or already_queued:
                 continue
             try:
                 account = ThirdPartyAccount.objects.get(type=vurl.type, username=username)
             except ThirdPartyAccount.DoesNotExist:
                 continue
 
-            if hasattr(vt, action):
-                if action == UPDATE_VERSION_ACTION and not already_updated:
-                    vt.update_subtitles(version, account)
-                elif action == DELETE_LANGUAGE_ACTION:
-                    vt.delete_subtitles(language, account)
+            SyncPush.objects.enqueue(vurl, account, language_code, action,
+                                     version)
 
 
 class ThirdPartyAccount(models.Model):
@@ -322,3 +328,66 @@ class YoutubeSyncRule(models.Model):
 
         if len(users) != User.objects.filter(username__in=users).count():
             raise ValidationError("One or more users not found")
+
+
+class SyncPushManager(models.Manager):
+
+    def enqueue(self, video_url, account, language_code, action,
+                version=None):
+        """
+        Queue a push of a language to a video url, with an account.
+
+        There's at most one pending push per video url, language and account:
+        if there's one already it's replaced by this one, which keeps its
+        place in the queue (and its backoff, if it has been failing).
+        """
+        lookup = dict(video_url=video_url, account=account,
+                      language_code=language_code)
+        values = dict(action=action, version=version,
+                      revision=F('revision') + 1)
+
+        if self.filter(**lookup).update(**values):
+            return
+        try:
+            self.create(action=action, version=version,
+                        next_attempt=datetime.now(), **lookup)
+        except IntegrityError:
+            # Somebody else queued one in the meantime.
+            self.filter(**lookup).update(**values)
+
+    def due(self, now=None):
+        return self.filter(next_attempt__lte=now or datetime.now())
+
+
+class SyncPush(models.Model):
+    """
+    A pending push of subtitles to a third party video (see
+    ThirdPartyAccountManager.mirror_on_third_party).
+
+    *revision* goes up every time the push is replaced by a newer one, so
+    that a worker that just finished pushing can tell whether there's
+    something newer to push.
+    """
+    video_url = models.ForeignKey('videos.VideoUrl')
+    account = models.ForeignKey(ThirdPartyAccount)
+    language_code = models.CharField(max_length=16)
+    action = models.CharField(max_length=20, choices=(
+        (UPDATE_VERSION_ACTION, 'Update subtitles'),
+        (DELETE_LANGUAGE_ACTION, 'Delete subtitles'),
+    ))
+    version = models.ForeignKey('subtitles.SubtitleVersion', null=True,
+                                blank=True, on_delete=models.SET_NULL)
+    revision = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = SyncPushManager()
+
+    class Meta:
+        unique_together = ('video_url', 'language_code', 'account')
+
+    def __unicode__(self):
+        return u'%s %s to %s' % (self.action, self.language_code,
+                                 self.video_url.url)
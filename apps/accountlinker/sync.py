@@ -0,0 +1,223 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Pushing subtitles to third party accounts.
+
+mirror_on_third_party only queues SyncPush rows.  SyncWorker.run() does the
+pushes that are due, a batch at a time:
+
+1. Claim the batch, by moving each push's next_attempt past CLAIM_TIMEOUT, so
+   that another worker won't pick it up too.
+2. Apply the per-account rate limit: at most SYNC_RATE_LIMIT pushes per
+   account every SYNC_RATE_PERIOD seconds, counted in Redis so that it holds
+   across workers.  Pushes over the limit wait for the next period.
+3. Push in a pool of threads.  The threads only talk to the third party,
+   never to the database.
+4. Delete the pushes that worked, unless they were replaced while we were
+   pushing, in which case the newer push is due right away.  Pushes that
+   failed are retried with exponential backoff, and dropped after
+   SYNC_MAX_ATTEMPTS.
+
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from accountlinker.models import SyncPush
+from utils.metrics import Meter
+from utils.redis_utils import default_connection
+from videos.models import VIDEO_TYPE_YOUTUBE
+from videos.types import UPDATE_VERSION_ACTION
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = getattr(settings, 'SYNC_BATCH_SIZE', 50)
+SYNC_WORKERS = getattr(settings, 'SYNC_WORKERS', 4)
+SYNC_RATE_LIMIT = getattr(settings, 'SYNC_RATE_LIMIT', 30)
+SYNC_RATE_PERIOD = getattr(settings, 'SYNC_RATE_PERIOD', 60)
+SYNC_BACKOFF = getattr(settings, 'SYNC_BACKOFF', 60)
+SYNC_MAX_BACKOFF = getattr(settings, 'SYNC_MAX_BACKOFF', 6 * 60 * 60)
+SYNC_MAX_ATTEMPTS = getattr(settings, 'SYNC_MAX_ATTEMPTS', 8)
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def _youtube_bridge(push):
+    from videos.types.youtube import YouTubeApiBridge
+
+    return YouTubeApiBridge(push.account.oauth_access_token,
+                            push.account.oauth_refresh_token,
+                            push.video_url.videoid)
+
+# VideoUrl type -> function returning the API bridge to push with.
+BRIDGES = {
+    VIDEO_TYPE_YOUTUBE: _youtube_bridge,
+}
+
+def backoff(attempts):
+    """Return how long to wait after the given number of failed attempts."""
+    return timedelta(seconds=min(SYNC_BACKOFF * 2 ** (attempts - 1),
+                                 SYNC_MAX_BACKOFF))
+
+
+class SyncWorker(object):
+    def __init__(self, bridges=BRIDGES, batch_size=SYNC_BATCH_SIZE,
+                 workers=SYNC_WORKERS, rate_limit=SYNC_RATE_LIMIT,
+                 rate_period=SYNC_RATE_PERIOD, connection=default_connection):
+        self.bridges = bridges
+        self.batch_size = batch_size
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.connection = connection
+
+    def run(self, now=None):
+        """Do one batch of due pushes, and return how many were due."""
+        now = now or datetime.now()
+        due = list(SyncPush.objects.due(now)
+                   .select_related('account', 'video_url', 'version',
+                                   'version__subtitle_language')
+                   .order_by('next_attempt')[:self.batch_size])
+
+        pushes = []
+        for push in self._claim(due, now):
+            if push.action == UPDATE_VERSION_ACTION and push.version is None:
+                # The version was deleted before we got to it.
+                self._delete(push)
+            else:
+                pushes.append(push)
+        pushes = self._rate_limit(pushes, now)
+
+        if pushes:
+            pool = ThreadPool(max(1, min(self.workers, len(pushes))))
+            try:
+                errors = pool.map(self._push, pushes)
+            finally:
+                pool.close()
+                pool.join()
+
+            for push, error in zip(pushes, errors):
+                if error is None:
+                    self._done(push, now)
+                else:
+                    self._failed(push, error, now)
+
+        return len(due)
+
+    def _claim(self, pushes, now):
+        claimed = []
+        for push in pushes:
+            if SyncPush.objects.filter(
+                    pk=push.pk, next_attempt=push.next_attempt).update(
+                    next_attempt=now + CLAIM_TIMEOUT):
+                claimed.append(push)
+        return claimed
+
+    def _rate_limit(self, pushes, now):
+        if not pushes or not self.rate_limit:
+            return pushes
+
+        by_account = {}
+        for push in pushes:
+            by_account.setdefault(push.account_id, []).append(push)
+
+        window = int(time.time()) // self.rate_period
+        keys = dict((account_id, 'sync-rate:%s:%s' % (account_id, window))
+                    for account_id in by_account)
+        pipe = self.connection.pipeline(transaction=False)
+        for account_id, account_pushes in by_account.items():
+            pipe.incr(keys[account_id], len(account_pushes))
+            pipe.expire(keys[account_id], self.rate_period * 2)
+        used = dict(zip(by_account, pipe.execute()[::2]))
+
+        allowed, deferred = [], []
+        for account_id, account_pushes in by_account.items():
+            left = max(0, self.rate_limit - (used[account_id] -
+                                             len(account_pushes)))
+            allowed.extend(account_pushes[:left])
+            deferred.extend(account_pushes[left:])
+            if len(account_pushes) > left:
+                # Give back what we aren't going to use.
+                self.connection.decr(keys[account_id],
+                                     len(account_pushes) - left)
+
+        if deferred:
+            Meter('youtube.push.rate-limited').inc(len(deferred))
+            next_window = datetime.fromtimestamp(
+                (window + 1) * self.rate_period)
+            SyncPush.objects.filter(pk__in=[p.pk for p in deferred]).update(
+                next_attempt=max(now, next_window))
+        return allowed
+
+    def _push(self, push):
+        """Do a push, returning None if it worked or the error if it didn't.
+
+        This runs in a worker thread.
+
+        """
+        try:
+            bridge = self.bridges[push.video_url.type](push)
+            if push.action == UPDATE_VERSION_ACTION:
+                bridge.upload_captions(push.version)
+            else:
+                bridge.delete_subtitles(push.language_code)
+            return None
+        except Exception, e:
+            return repr(e)
+        finally:
+            Meter('youtube.push.request').inc()
+
+    def _delete(self, push):
+        SyncPush.objects.filter(pk=push.pk, revision=push.revision).delete()
+
+    def _done(self, push, now):
+        Meter('youtube.push.success').inc()
+        self._delete(push)
+        # If it wasn't deleted, it was replaced while we were pushing.
+        SyncPush.objects.filter(pk=push.pk).update(next_attempt=now,
+                                                   attempts=0)
+
+    def _failed(self, push, error, now):
+        Meter('youtube.push.fail').inc()
+        attempts = push.attempts + 1
+
+        if attempts >= SYNC_MAX_ATTEMPTS:
+            logger.error('Pushing to youtube has failed, giving up.', extra={
+                'video_url': push.video_url_id,
+                'language': push.language_code,
+                'error': error,
+            })
+            self._delete(push)
+        else:
+            logger.warning('Pushing to youtube has failed.', extra={
+                'video_url': push.video_url_id,
+                'language': push.language_code,
+                'attempts': attempts,
+                'error': error,
+            })
+            SyncPush.objects.filter(pk=push.pk, revision=push.revision).update(
+                attempts=attempts, next_attempt=now + backoff(attempts),
+                last_error=error)
+
+        # If it was replaced while we were pushing, the new revision hasn't
+        # failed yet.
+        SyncPush.objects.filter(pk=push.pk).exclude(
+            revision=push.revision).update(next_attempt=now, attempts=0)
@@ -0,0 +1,54 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+from datetime import datetime, timedelta
+
+from celery.decorators import periodic_task
+from django.conf import settings
+from django.db.models import Min
+
+from accountlinker.models import SyncPush
+from accountlinker.sync import SyncWorker
+from utils.metrics import Gauge
+
+SYNC_INTERVAL = getattr(settings, 'SYNC_INTERVAL', 10)
+# Batches done per run at most, so one run can't hog a worker.
+SYNC_MAX_BATCHES = getattr(settings, 'SYNC_MAX_BATCHES', 20)
+
+
+@periodic_task(run_every=timedelta(seconds=SYNC_INTERVAL))
+def process_sync_outbox():
+    worker = SyncWorker()
+    for i in xrange(SYNC_MAX_BATCHES):
+        if worker.run() < worker.batch_size:
+            break
+
+
+@periodic_task(run_every=timedelta(seconds=30))
+def gauge_accountlinker():
+    # The outbox only holds pending pushes, so it stays small enough to count.
+    now = datetime.now()
+    due = SyncPush.objects.due(now)
+    oldest = due.aggregate(oldest=Min('next_attempt'))['oldest']
+
+    Gauge('accountlinker.SyncPush').report(SyncPush.objects.count())
+    Gauge('accountlinker.SyncPush-due').report(due.count())
+    Gauge('accountlinker.SyncPush-failing').report(
+        SyncPush.objects.filter(attempts__gt=0).count())
+    Gauge('accountlinker.SyncPush-lag').report(
+        int((now - oldest).total_seconds()) if oldest else 0)
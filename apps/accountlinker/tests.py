@@ -16,13 +16,19 @@
 # along with this program. If not, see
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
+from datetime import datetime, timedelta
+
 from django.test import TestCase
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
 from accountlinker.models import (
-    ThirdPartyAccount, YoutubeSyncRule, check_authorization, can_be_synced
+    SyncPush, ThirdPartyAccount, YoutubeSyncRule, check_authorization,
+    can_be_synced
 )
+from accountlinker.sync import SyncWorker
+from utils.redis_utils import default_connection
+from videos.types import UPDATE_VERSION_ACTION, DELETE_LANGUAGE_ACTION
 from videos.models import Video, VideoUrl
 from teams.models import Team, TeamVideo
 from auth.models import CustomUser as User
@@ -145,3 +151,122 @@ class AccountTest(TestCase):
         self.assertTrue(version.is_synced())
 
         self.assertTrue(can_be_synced(version))
+
+
+class FakeYouTubeApiBridge(object):
+    """Stands in for videos.types.youtube.YouTubeApiBridge."""
+    calls = []
+    fail = False
+
+    def __init__(self, push):
+        self.videoid = push.video_url.videoid
+
+    def upload_captions(self, subtitle_version):
+        if self.fail:
+            raise IOError('YouTube is down')
+        self.calls.append(('upload', self.videoid, subtitle_version.pk))
+
+    def delete_subtitles(self, language):
+        if self.fail:
+            raise IOError('YouTube is down')
+        self.calls.append(('delete', self.videoid, language))
+
+
+class SyncOutboxTest(TestCase):
+    fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
+
+    def setUp(self):
+        self.vurl = VideoUrl.objects.filter(type='Y')[0]
+        self.vurl.owner_username = 'test'
+        self.vurl.save()
+        self.video = self.vurl.video
+
+        self.account = ThirdPartyAccount.objects.create(
+            type='Y', username='test', oauth_access_token='a',
+            oauth_refresh_token='b')
+        team = Team.objects.all()[0]
+        TeamVideo.objects.create(video=self.video, team=team,
+                                 added_by=User.objects.get(username='admin'))
+        team.third_party_accounts.add(self.account)
+
+        FakeYouTubeApiBridge.calls = []
+        FakeYouTubeApiBridge.fail = False
+        self.worker = SyncWorker(bridges={'Y': FakeYouTubeApiBridge},
+                                 rate_limit=2)
+        keys = default_connection.keys('sync-rate:*')
+        if keys:
+            default_connection.delete(*keys)
+
+    def _add_version(self, language_code='en'):
+        return add_subtitles(self.video, language_code,
+                             [(0, 1000, 'Hello', {})], complete=True)
+
+    def test_coalesce(self):
+        versions = [self._add_version() for i in xrange(3)]
+        for version in versions:
+            ThirdPartyAccount.objects.mirror_on_third_party(
+                self.video, version.subtitle_language, UPDATE_VERSION_ACTION,
+                version)
+
+        push = SyncPush.objects.get()
+        self.assertEqual(push.version, versions[-1])
+        self.assertEqual(push.account, self.account)
+
+        self.worker.run()
+        self.assertEqual(FakeYouTubeApiBridge.calls,
+                         [('upload', self.vurl.videoid, versions[-1].pk)])
+        self.assertFalse(SyncPush.objects.exists())
+
+    def test_backoff(self):
+        FakeYouTubeApiBridge.fail = True
+        SyncPush.objects.enqueue(self.vurl, self.account, 'en',
+                                 DELETE_LANGUAGE_ACTION)
+        self.worker.run()
+
+        push = SyncPush.objects.get()
+        self.assertEqual(push.attempts, 1)
+        self.assertTrue(push.next_attempt > datetime.now())
+
+        # Not due yet.
+        FakeYouTubeApiBridge.fail = False
+        self.worker.run()
+        self.assertEqual(FakeYouTubeApiBridge.calls, [])
+
+        self.worker.run(now=datetime.now() + timedelta(hours=1))
+        self.assertEqual(FakeYouTubeApiBridge.calls,
+                         [('delete', self.vurl.videoid, 'en')])
+        self.assertFalse(SyncPush.objects.exists())
+
+    def test_replaced_while_failing(self):
+        FakeYouTubeApiBridge.fail = True
+        SyncPush.objects.enqueue(self.vurl, self.account, 'en',
+                                 DELETE_LANGUAGE_ACTION)
+        SyncPush.objects.update(attempts=2)
+
+        def push_and_replace(push):
+            error = SyncWorker._push(self.worker, push)
+            SyncPush.objects.enqueue(self.vurl, self.account, 'en',
+                                     DELETE_LANGUAGE_ACTION)
+            return error
+        self.worker._push = push_and_replace
+
+        now = datetime.now()
+        self.worker.run(now=now)
+
+        # The new revision hasn't failed, so it doesn't inherit the backoff.
+        push = SyncPush.objects.get()
+        self.assertEqual(push.revision, 1)
+        self.assertEqual(push.attempts, 0)
+        self.assertTrue(push.next_attempt <= now)
+
+    def test_rate_limit(self):
+        for language_code in ('en', 'fr', 'de'):
+            SyncPush.objects.enqueue(self.vurl, self.account, language_code,
+                                     DELETE_LANGUAGE_ACTION)
+
+        self.assertEqual(self.worker.run(), 3)
+        self.assertEqual(len(FakeYouTubeApiBridge.calls), 2)
+
+        push = SyncPush.objects.get()
+        self.assertEqual(push.attempts, 0)
+        self.assertTrue(push.next_attempt > datetime.now())
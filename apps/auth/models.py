@@ -37,6 +37,7 @@ from datetime import datetime, timedelta
 from django.core.cache import cache
 from django.utils.hashcompat import sha_constructor
 from utils.metrics import Meter
+from utils import rowcounts
 from random import random
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
@@ -566,3 +567,7 @@ class LoginToken(models.Model):
 
     def __unicode__(self):
         return u"LoginToken for %s" %(self.user)
+
+
+rowcounts.register('auth.CustomUser',
+                   CustomUser.objects.count).track(CustomUser)
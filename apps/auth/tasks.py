@@ -1,9 +1,11 @@
 from celery.decorators import periodic_task
 from celery.schedules import timedelta
 
-from apps.auth.models import CustomUser
+from utils import rowcounts
 from utils.metrics import Gauge
 
 @periodic_task(run_every=timedelta(seconds=5))
 def gauge_auth():
-    Gauge('auth.CustomUser').report(CustomUser.objects.count())
+    # Importing the models registers their row counters.
+    import auth.models
+    Gauge('auth.CustomUser').report(rowcounts.value('auth.CustomUser'))
@@ -24,6 +24,7 @@ from django.contrib.sites.models import Site
 from auth.models import CustomUser as User, Awards
 from django.conf import settings
 from django.db.models.signals import post_save
+from utils import rowcounts
 
 from localeurl.utils import universal_url
 
@@ -63,3 +64,5 @@ def comment_post_save_handler(sender, instance, created, **kwargs):
 post_save.connect(Awards.on_comment_save, Comment)
 post_save.connect(comment_post_save_handler, Comment,
         dispatch_uid='notifications')
+
+rowcounts.register('comments.Comment', Comment.objects.count).track(Comment)
@@ -27,10 +27,10 @@ the user has allowed email notifications
 """
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django.template.loader import render_to_string
-from django.contrib.contenttypes.models import ContentType
 
 from raven.contrib.django.models import client
 
@@ -44,8 +44,8 @@ from teams.moderation_const import REVIEWED_AND_PUBLISHED, \
 
 
 from messages.models import Message
-from utils import send_templated_email
-from utils.metrics import Meter
+from utils import send_templated_email, templated_email_context
+from utils.metrics import Meter, Timer
 from utils.translation import get_language_label
 
 
@@ -689,56 +689,157 @@ def send_video_comment_notification(comment_pk_or_instance, version_pk=None):
 
     subject = SUBJECT_EMAIL_VIDEO_COMMENTED  % dict(user=unicode(comment.user), title=video.title_display())
 
-    followers = set(video.notification_list(comment.user))
-
-    for user in followers:
-        Meter('templated-emails-sent-by-type.new-comment-notification').inc()
-        send_templated_email(
-            user,
-            subject,
-            "messages/email/comment-notification.html",
-            {
-                "video": video,
-                "user": user,
-                "hash": user.hash_for_video(video.video_id),
-                "commenter": unicode(comment.user),
-                "commenter_url": comment.user.get_absolute_url(),
-                "version_url":version_url,
-                "language_url":language_url,
-                "domain":domain,
-                "version": version,
-                "body": comment.content,
-                "STATIC_URL": settings.STATIC_URL,
-            },
-            fail_silently=not settings.DEBUG)
+    followers = video.notification_list(comment.user)
+    sent = send_templated_email_to_many(
+        followers, subject, "messages/email/comment-notification.html", {
+            "video": video,
+            "commenter": unicode(comment.user),
+            "commenter_url": comment.user.get_absolute_url(),
+            "version_url":version_url,
+            "language_url":language_url,
+            "domain":domain,
+            "version": version,
+            "body": comment.content,
+            "STATIC_URL": settings.STATIC_URL,
+        }, video.video_id)
+    Meter('templated-emails-sent-by-type.new-comment-notification').inc(sent)
 
 
     if language:
         obj = language
-        object_pk = language.pk
-        content_type = ContentType.objects.get_for_model(language)
         exclude = [c.user for c in language.followers.filter(notify_by_message=False)]
         exclude.append(comment.user)
         message_followers = language.notification_list(exclude)
     else:
         obj = video
-        object_pk = video.pk
-        content_type = ContentType.objects.get_for_model(video)
         exclude = list(video.followers.filter(notify_by_message=False))
         exclude.append(comment.user)
         message_followers = video.notification_list(exclude)
 
-    for user in message_followers:
-        Message.objects.create(user=user, subject=subject, object_pk=object_pk,
-                content_type=content_type, object=obj,
-                content=render_to_string('messages/new-comment.html', {
-                    "video": video,
-                    "commenter": unicode(comment.user),
-                    "commenter_url": comment.user.get_absolute_url(),
-                    "version_url":version_url,
-                    "language_url":language_url,
-                    "domain":domain,
-                    "protocol": protocol,
-                    "version": version,
-                    "body": comment.content
-                }))
+    create_messages(message_followers, subject, obj=obj,
+                    content=render_to_string('messages/new-comment.html', {
+                        "video": video,
+                        "commenter": unicode(comment.user),
+                        "commenter_url": comment.user.get_absolute_url(),
+                        "version_url":version_url,
+                        "language_url":language_url,
+                        "domain":domain,
+                        "protocol": protocol,
+                        "version": version,
+                        "body": comment.content
+                    }))
+
+
+# Fan-out ---------------------------------------------------------------------
+# Notifications about a video can go to thousands of followers.  Rather than
+# rendering the whole template and opening an SMTP connection per follower, we
+# render it once (per variant, see below) with placeholders for the few fields
+# that differ per user, and send the emails in chunks, each chunk in its own
+# task over a single connection.
+
+NOTIFICATION_CHUNK_SIZE = getattr(settings, 'NOTIFICATION_CHUNK_SIZE', 200)
+
+USER_ID_PLACEHOLDER = '__notification_user_id__'
+HASH_PLACEHOLDER = '__notification_hash__'
+
+class _RecipientPlaceholder(object):
+    """Stands in for the recipient while rendering a shared email body.
+
+    Templates rendered for many users can only use the recipient's id (and
+    the `hash` and `user_is_rtl` variables).  Anything else about the user
+    would render as an empty string.
+
+    """
+    id = pk = USER_ID_PLACEHOLDER
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def send_templated_email_to_many(users, subject, template, context, video_id):
+    """Send the same templated email about a video to many users.
+
+    This is send_templated_email for notifications: `context` must not depend
+    on the recipient, apart from the `user`, `hash` and `user_is_rtl`
+    variables, which are filled in here.  Users that have no email address or
+    don't want notifications by email are skipped.
+
+    The emails are queued in chunks of NOTIFICATION_CHUNK_SIZE.  Returns the
+    number of emails queued.
+
+    """
+    if hasattr(users, 'prefetch_related'):
+        # For guess_is_rtl
+        users = users.prefetch_related('userlanguage_set')
+
+    recipients = []
+    variants = set()
+    for user in users:
+        if not user.email or not user.notify_by_email:
+            continue
+        variant = 'rtl' if user.guess_is_rtl() else 'ltr'
+        variants.add(variant)
+        recipients.append((user.email, user.pk, user.hash_for_video(video_id),
+                           variant))
+
+    if not recipients:
+        return 0
+
+    bodies = {}
+    for variant in variants:
+        variant_context = templated_email_context(dict(context))
+        variant_context.update({
+            'user': _RecipientPlaceholder(),
+            'hash': HASH_PLACEHOLDER,
+            'user_is_rtl': variant == 'rtl',
+        })
+        bodies[variant] = render_to_string(template, variant_context)
+
+    for chunk in _chunks(recipients, NOTIFICATION_CHUNK_SIZE):
+        send_prerendered_emails.delay(subject, bodies, chunk)
+
+    Meter('notifications.emails-queued').inc(len(recipients))
+    return len(recipients)
+
+@task
+def send_prerendered_emails(subject, bodies, recipients):
+    """Send one chunk of the emails queued by send_templated_email_to_many.
+
+    `recipients` is a list of (email, user id, hash, variant) tuples.
+
+    """
+    messages = []
+    for email, user_id, hash, variant in recipients:
+        body = (bodies[variant].replace(USER_ID_PLACEHOLDER, str(user_id))
+                               .replace(HASH_PLACEHOLDER, hash))
+        message = EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+                               [email], bcc=settings.EMAIL_BCC_LIST)
+        message.content_subtype = 'html'
+        messages.append(message)
+
+    with Timer('notifications.email-chunk'):
+        connection = get_connection(fail_silently=not settings.DEBUG)
+        sent = connection.send_messages(messages)
+
+    Meter('templated-emails-sent').inc(len(messages))
+    Meter('notifications.emails-sent').inc(sent or 0)
+
+def create_messages(users, subject, content, obj=None):
+    """Create the same site Message for many users with bulk INSERTs.
+
+    This does what Message.save() would for each of them.
+
+    """
+    if getattr(settings, "MESSAGES_DISABLED", False):
+        return 0
+
+    extra = {'object': obj} if obj is not None else {}
+    messages = [Message(user=user, subject=subject, content=content,
+                        read=not user.notify_by_message, **extra)
+                for user in users]
+
+    for chunk in _chunks(messages, NOTIFICATION_CHUNK_SIZE):
+        Message.objects.bulk_create(chunk)
+
+    Meter('notifications.messages-created').inc(len(messages))
+    return len(messages)
@@ -428,6 +428,56 @@ class MessageTest(TestCase):
         self.assertIn(invite_message, Message.objects.for_user(user))
 
 
+class NotificationFanOutTest(TestCase):
+    def setUp(self):
+        self.video, created = Video.get_or_create_for_url(
+            "http://www.example.com/fan-out.mp4")
+        for i in xrange(5):
+            User.objects.create(username='follower%s' % i,
+                                email='follower%s@example.com' % i,
+                                notify_by_message=(i % 2 == 0))
+        self.followers = User.objects.filter(username__startswith='follower')
+        self.old_chunk_size = notifier.NOTIFICATION_CHUNK_SIZE
+        notifier.NOTIFICATION_CHUNK_SIZE = 2
+        mail.outbox = []
+
+    def tearDown(self):
+        notifier.NOTIFICATION_CHUNK_SIZE = self.old_chunk_size
+
+    def test_emails_are_personalized(self):
+        User.objects.create(username='follower-no-email', email='')
+
+        sent = notifier.send_templated_email_to_many(
+            self.followers, 'New comment',
+            'messages/email/comment-notification.html',
+            {'video': self.video, 'commenter': 'someone', 'body': 'Hi!'},
+            self.video.video_id)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(mail.outbox), 5)
+        for user in self.followers.exclude(email=''):
+            emails = [m for m in mail.outbox if m.to == [user.email]]
+            self.assertEqual(len(emails), 1)
+            body = emails[0].body
+            self.assertIn('?u=%s&h=%s' % (
+                user.pk, user.hash_for_video(self.video.video_id)), body)
+            self.assertIn('Hi!', body)
+            self.assertNotIn(notifier.USER_ID_PLACEHOLDER, body)
+            self.assertNotIn(notifier.HASH_PLACEHOLDER, body)
+            self.assertEqual(emails[0].subject, 'New comment')
+
+    def test_create_messages(self):
+        created = notifier.create_messages(self.followers, 'New comment',
+                                           'Hi!', obj=self.video)
+
+        self.assertEqual(created, 5)
+        for user in self.followers:
+            message = Message.objects.get(user=user)
+            self.assertEqual(message.object, self.video)
+            self.assertEqual(message.content, 'Hi!')
+            self.assertEqual(message.read, not user.notify_by_message)
+
+
 class TeamBlockSettingsTest(TestCase):
     fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
 
@@ -23,6 +23,31 @@ from statistic.pre_day_statistic import BasePerDayStatistic, UpdatingLogger
 from utils.redis_utils import default_connection
 
 
+def _video_pks(video_ids):
+    from videos.models import Video
+
+    return dict(Video.objects.filter(video_id__in=set(video_ids))
+                             .values_list('video_id', 'pk'))
+
+def _update_video_counters(field, items):
+    """Add the values of (key, obj, value) *items* to the *field* of their videos.
+
+    Issues one UPDATE per distinct increment instead of one per video.
+    """
+    from videos.models import Video
+
+    per_video = {}
+    for key, obj, value in items:
+        per_video[obj.video_id] = per_video.get(obj.video_id, 0) + value
+
+    by_value = {}
+    for video_pk, value in per_video.items():
+        by_value.setdefault(value, []).append(video_pk)
+
+    for value, pks in by_value.items():
+        Video.objects.filter(pk__in=pks).update(**{field: F(field)+value})
+
+
 class VideoViewStatistic(BasePerDayStatistic):
     """
     statistic.WidgetViewStatistic is inherited from this. Pay attention changing
@@ -61,13 +86,33 @@ class VideoViewStatistic(BasePerDayStatistic):
         obj, created = self.model.objects.get_or_create(video=video, date=date)
         return obj
 
+    def parse_keys(self, keys):
+        parsed = [key.split(':') for key in keys]
+        pks = _video_pks([parts[1] for parts in parsed])
+
+        result = {}
+        for key, (prefix, video_id, date_str) in zip(keys, parsed):
+            if video_id in pks:
+                result[key] = {'video_id': pks[video_id],
+                               'date': self.get_date(date_str)}
+        return result
+
     def get_query_set(self, video):
         return self.model.objects.filter(video=video)
 
+    def get_views_cache_key(self, video):
+        return '%s:views:%s' % (self.prefix, video.pk)
+
+    def get_object_views_cache_key(self, obj):
+        return '%s:views:%s' % (self.prefix, obj.video_id)
+
     def update_total(self, key, obj, value):
         video = obj.video
         video.__class__.objects.filter(pk=video.pk).update(view_count=F('view_count')+value)
 
+    def update_totals(self, items):
+        _update_video_counters('view_count', items)
+
 st_video_view_handler = VideoViewStatistic()
 
 class WidgetViewStatistic(VideoViewStatistic):
@@ -100,6 +145,9 @@ class WidgetViewStatistic(VideoViewStatistic):
         Video.objects.filter(pk=obj.video_id) \
             .update(widget_views_count=F('widget_views_count')+value)
 
+    def update_totals(self, items):
+        _update_video_counters('widget_views_count', items)
+
     def post_migrate(self, updated_objects, updated_keys):
         from utils.celery_search_index import update_search_index_for_qs
         from videos.models import Video
@@ -120,7 +168,12 @@ class SubtitleFetchStatistic(BasePerDayStatistic):
     prefix = 'st_subtitles_fetch'
     model = SubtitleFetchCounters
 
-    def get_key(self, date, video=None, sl=None, sl_pk=None, video_id=None):
+    def get_key(self, date, video=None, sl=None, sl_pk=None, video_id=None,
+                language_code=None):
+        """
+        Pass *language_code* rather than *sl_pk* where you can, since looking
+        the language up by pk takes a query.
+        """
         from videos.models import SubtitleLanguage
 
         if not video and not video_id:
@@ -133,28 +186,33 @@ class SubtitleFetchStatistic(BasePerDayStatistic):
 
         key = '%s:%s:' % (self.prefix, video_id)
 
-        if sl_pk:
+        if not language_code and sl_pk:
             try:
                 sl = SubtitleLanguage.objects.get(pk=sl_pk)
             except (SubtitleLanguage.DoesNotExist, ValueError):
                 pass
 
-        if sl and sl.language:
-            key += ':%s' % sl.language
+        if not language_code and sl:
+            language_code = sl.language
+
+        if language_code:
+            key += ':%s' % language_code
 
         key += ':%s' % self.date_format(date)
 
         return key
 
+    def _get_language(self, parts):
+        if len(parts) == 6:
+            return parts[2]
+        else:
+            return ''
+
     def get_object(self, key):
         from videos.models import Video
 
         parts = key.split(':')
-
-        if len(parts) == 6:
-            lang = parts[2]
-        else:
-            lang = ''
+        lang = self._get_language(parts)
 
         try:
             video = Video.objects.get(video_id=parts[1])
@@ -173,6 +231,18 @@ class SubtitleFetchStatistic(BasePerDayStatistic):
             obj = self.model.objects.get(**fields)
         return obj
 
+    def parse_keys(self, keys):
+        parsed = [key.split(':') for key in keys]
+        pks = _video_pks([parts[1] for parts in parsed])
+
+        result = {}
+        for key, parts in zip(keys, parsed):
+            if parts[1] in pks:
+                result[key] = {'video_id': pks[parts[1]],
+                               'language': self._get_language(parts),
+                               'date': self.get_date(parts[-1])}
+        return result
+
     def get_query_set(self, date, video, sl=None):
         qs = self.model.objects.filter(video=video)
 
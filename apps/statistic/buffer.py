@@ -0,0 +1,148 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Buffering per-day statistic updates in process.
+
+Video views, widget plays and subtitle fetches used to queue a celery task per
+hit, just to INCR a Redis counter.  Now they are added to a per-process
+buffer, which is written to Redis in one pipeline every
+STATISTIC_FLUSH_INTERVAL seconds, once STATISTIC_FLUSH_SIZE hits are waiting,
+and when the process exits.
+
+The keys written are exactly the ones BasePerDayStatistic.update() writes:
+the per-day counter, its entry in the handler's set, and the handler's total.
+The Redis key is worked out when the hit is recorded, so the day a hit counts
+for doesn't depend on when it gets flushed.
+
+Set STATISTIC_FLUSH_INTERVAL to 0 to call update() on every hit instead.
+
+"""
+
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from utils.redis_utils import default_connection
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = getattr(settings, 'STATISTIC_FLUSH_INTERVAL', 5)
+FLUSH_SIZE = getattr(settings, 'STATISTIC_FLUSH_SIZE', 500)
+
+
+class CounterBuffer(object):
+    """Buffers statistic counter increments and writes them in batches.
+
+    Like utils.metrics.Aggregator, the flush thread is started lazily, and
+    again after a fork.  If `interval` is 0 or None there's no thread, and
+    flush() must be called by hand (or happens once `size` hits are waiting).
+
+    """
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE,
+                 connection=default_connection):
+        self.interval = interval
+        self.size = size
+        self.connection = connection
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._reset()
+
+    def _reset(self):
+        # (handler, redis key) -> count
+        self.counts = {}
+        self.pending = 0
+
+    def _ensure_thread(self):
+        if not self.interval:
+            return
+
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            if self._thread_pid is not None:
+                # We were forked, and what's buffered belongs to the parent.
+                self._reset()
+            self._thread_pid = pid
+
+        thread = threading.Thread(target=self._run, name='statistic-flush')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def add(self, handler, **kwargs):
+        """Count a hit, with the kwargs BasePerDayStatistic.update() takes."""
+        self._ensure_thread()
+        date = kwargs.pop('date', None) or datetime.date.today()
+        key = handler.get_key(date=date, **kwargs)
+        if not key:
+            return
+
+        with self._lock:
+            self.counts[(handler, key)] = self.counts.get((handler, key), 0) + 1
+            self.pending += 1
+            full = self.size and self.pending >= self.size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts = self.counts
+            self._reset()
+
+        if not counts:
+            return
+
+        per_handler = {}
+        for (handler, key), n in counts.iteritems():
+            per_handler.setdefault(handler, {})[key] = n
+
+        pipe = self.connection.pipeline(transaction=False)
+        for handler, handler_counts in per_handler.iteritems():
+            handler.update_many(handler_counts, pipe)
+        try:
+            pipe.execute()
+        except Exception:
+            logger.exception('Error flushing %s statistic counters',
+                             sum(counts.values()))
+
+
+counter_buffer = CounterBuffer()
+
+if FLUSH_INTERVAL:
+    atexit.register(counter_buffer.flush)
+
+def count(handler, **kwargs):
+    """Count a hit for a BasePerDayStatistic handler."""
+    if FLUSH_INTERVAL:
+        counter_buffer.add(handler, **kwargs)
+    else:
+        handler.update(**kwargs)
@@ -0,0 +1,94 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from statistic import WidgetViewStatistic
+from utils.redis_utils import default_connection
+from videos.models import Video
+
+
+class BenchmarkWidgetViewStatistic(WidgetViewStatistic):
+    prefix = 'st_benchmark_widget_view'
+    log_to_redis = None
+
+    def post_migrate(self, updated_objects, updated_keys):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Fill Redis with a synthetic backlog of widget view counters and '
+            'time migrating it to the DB. Writes to the statistic tables, so '
+            'only run this against a development database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--keys', action='store', dest='keys', type='int',
+                    default=1000000, help='Number of Redis keys to create.'),
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=1000,
+                    help='Batch size for the batched migration. Use 0 to '
+                         'benchmark the unbatched migration.'),
+        make_option('--videos', action='store', dest='videos', type='int',
+                    default=1000,
+                    help='Number of existing videos to spread the keys over.'),
+    )
+
+    def handle(self, *args, **options):
+        if default_connection.ping() is None:
+            print 'Redis is unavailable.'
+            return
+
+        video_ids = list(Video.objects.values_list('video_id', flat=True)
+                                      [:options['videos']])
+        if not video_ids:
+            print 'There are no videos to generate statistic for.'
+            return
+
+        handler = BenchmarkWidgetViewStatistic()
+        self.fill(handler, video_ids, options['keys'])
+
+        start = time.time()
+        count = handler.migrate(verbosity=int(options.get('verbosity', 1)),
+                                batch_size=options['batch_size'])
+        elapsed = time.time() - start
+
+        print 'Migrated %s keys in %.1fs (%.0f keys/s)' % (
+            count, elapsed, count / elapsed if elapsed else 0)
+
+    def fill(self, handler, video_ids, key_count):
+        print 'Creating %s keys...' % key_count
+        start = time.time()
+        today = datetime.date.today()
+
+        pipe = default_connection.pipeline(transaction=False)
+        for i in xrange(key_count):
+            video_id = video_ids[i % len(video_ids)]
+            date = today - datetime.timedelta(days=i // len(video_ids))
+            key = handler.get_key(date=date, video_id=video_id)
+
+            pipe.incr(key, 1 + i % 5)
+            pipe.sadd(handler.set_key.redis_key, key)
+
+            if i % 10000 == 9999:
+                pipe.execute()
+        pipe.execute()
+
+        print 'Created keys in %.1fs' % (time.time() - start)
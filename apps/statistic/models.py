@@ -20,6 +20,7 @@ from auth.models import CustomUser as User
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from statistic.pre_day_statistic import BasePerDayStatisticModel
+from utils import rowcounts
 
 ALL_LANGUAGES = [(val, _(name))for val, name in settings.ALL_LANGUAGES]
 
@@ -74,3 +75,11 @@ def get_model_statistics(model, today, month_ago, week_ago, day_ago):
     stats['week'] = model.objects.filter(created__range=(week_ago, today)).count()
     stats['day'] = model.objects.filter(created__range=(day_ago, today)).count()
     return stats
+
+
+rowcounts.register('statistic.shares.twitter',
+                   TweeterShareStatistic.objects.count).track(TweeterShareStatistic)
+rowcounts.register('statistic.shares.facebook',
+                   FBShareStatistic.objects.count).track(FBShareStatistic)
+rowcounts.register('statistic.shares.email',
+                   EmailShareStatistic.objects.count).track(EmailShareStatistic)
@@ -16,15 +16,21 @@
 # along with this program.  If not, see 
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
-from django.db import models
+from django.core.cache import cache
+from django.db import IntegrityError, connection, models, transaction
+from django.utils.datastructures import SortedDict
 from utils.redis_utils import RedisKey
 from django.contrib.admin import ModelAdmin
 from django.views.generic.simple import direct_to_template
 from django.core.paginator import EmptyPage, InvalidPage, Paginator
 import datetime
+import operator
 import time
 from django.views.generic.list_detail import object_list
 
+# get_views results are dropped by migrate, this is just an upper bound
+VIEWS_CACHE_TIMEOUT = 60 * 60 * 24
+
 class LoggerModelAdmin(ModelAdmin):
     logger = None
     verbose_name = u'Redis->MySql migration statistic'
@@ -234,6 +240,25 @@ class BasePerDayStatistic(object):
         Should return QuerySet for self.model for get_views method
         """
         raise Exception('Not implemented')
+
+    def parse_keys(self, keys):
+        """
+        Optional, used by batched migration (see *migrate*).
+        Should return dict {key: fields}, where fields is a dict of *model*
+        field values (everything except *count*) that identifies the row for
+        this Redis key. Keys that should not be saved can be left out.
+        Try to do this with a constant number of queries for all keys.
+
+        Example:
+
+        def parse_keys(self, keys):
+            parsed = [(key,) + tuple(key.split(':')[1:]) for key in keys]
+            pks = dict(Video.objects.filter(video_id__in=[p[1] for p in parsed])
+                                    .values_list('video_id', 'pk'))
+            return dict((key, {'video_id': pks[video_id], 'date': self.get_date(date_str)})
+                        for key, video_id, date_str in parsed if video_id in pks)
+        """
+        raise NotImplementedError
     
     def update_total(self, key, obj, value):
         """
@@ -249,33 +274,164 @@ class BasePerDayStatistic(object):
             video.__class__.objects.filter(pk=video.pk).update(view_count=F('view_count')+value)        
         """
         raise Exception('Not implemented')
+
+    def update_totals(self, items):
+        """
+        Update total counters for many instances at once. Used by batched
+        migration. *items* is a list of (key, obj, value) tuples with one
+        tuple per *model* object. By default *update_total* is called for each
+        of them, override this to group the updates.
+        """
+        for key, obj, value in items:
+            self.update_total(key, obj, value)
         
+    def get_views_cache_key(self, **kwargs):
+        """
+        Optional. Return cache key for get_views result for kwargs or None to
+        not cache it. Cached value lives until *migrate* touches one of the
+        objects, so *get_object_views_cache_key* should return same key for
+        *model* objects that are counted for these kwargs.
+        """
+        return None
+
+    def get_object_views_cache_key(self, obj):
+        """
+        Optional. Return cache key of get_views result that should be dropped
+        when *obj* (*model* instance) is updated by *migrate*.
+        """
+        return None
+
+    def _windows(self):
+        today = datetime.date.today()
+        return SortedDict([
+            ('week', today - datetime.timedelta(days=7)),
+            ('month', today - datetime.timedelta(days=30)),
+            ('year', today - datetime.timedelta(days=365)),
+        ]), today
+
+    def _windows_select(self):
+        """
+        Return SortedDict of {name: SQL} and list of params to sum all view
+        windows in one query (conditional aggregation).
+        """
+        qn = connection.ops.quote_name
+        date_col, count_col = qn('date'), qn('count')
+        starts, today = self._windows()
+
+        select = SortedDict()
+        params = []
+        for name, start in starts.items():
+            select[name] = 'SUM(CASE WHEN %s >= %%s THEN %s ELSE 0 END)' % (date_col, count_col)
+            params.append(start)
+
+        for name, day in [('today_views', today),
+                          ('yesterday_views', today - datetime.timedelta(days=1))]:
+            select[name] = 'SUM(CASE WHEN %s = %%s THEN %s ELSE 0 END)' % (date_col, count_col)
+            params.append(day)
+
+        return select, params, starts['year'], today
+
+    def _views_cache_key(self, key):
+        """
+        Cache keys include current date, because windows move every day
+        """
+        return '%s:%s' % (key, datetime.date.today().isoformat())
+
+    def _build_views(self, sums):
+        now = datetime.datetime.now()
+        result = dict((name, int(sums.get(name) or 0)) for name in ('week', 'month', 'year'))
+        today_views = int(sums.get('today_views') or 0)
+        yesterday_views = int(sums.get('yesterday_views') or 0)
+        result['today'] = int(today_views + yesterday_views * (1 - now.hour / 24.))
+        return result
+
     def get_views(self, **kwargs):
         """
         Return views statistic for week and month like: {'month': value, 'week': value, 'year': value}
         Pas
         """
-        qs = self.get_query_set(**kwargs)
-        today = datetime.datetime.today()
-        yesterday  = today - datetime.timedelta(days=1)
-        week_ago = today - datetime.timedelta(days=7)
-        month_ago = today - datetime.timedelta(days=30)
-        year_ago = today - datetime.timedelta(days=365)
-        
-        #TODO: refactor this. too many queries. 
-        result = dict(week=0, month=0)
-        result['week'] = qs.filter(date__range=(week_ago, today)) \
-            .aggregate(s=models.Sum('count'))['s'] or 0
-        result['month'] = qs.filter(date__range=(month_ago, today)) \
-            .aggregate(s=models.Sum('count'))['s'] or 0
-        result['year'] = qs.filter(date__range=(year_ago, today)) \
-            .aggregate(s=models.Sum('count'))['s'] or 0
-
-        today_views = qs.filter(date=today).aggregate(s=models.Sum('count'))['s'] or 0
-        yesterday_views = qs.filter(date=yesterday).aggregate(s=models.Sum('count'))['s'] or 0
-        result['today'] =  int(today_views + yesterday_views * (1 - today.hour / 24.))
-                    
+        cache_key = self.get_views_cache_key(**kwargs)
+        if cache_key:
+            cache_key = self._views_cache_key(cache_key)
+            sums = cache.get(cache_key)
+            if sums is not None:
+                return self._build_views(sums)
+
+        select, params, year_ago, today = self._windows_select()
+        qs = self.get_query_set(**kwargs).filter(date__range=(year_ago, today))
+        sums = qs.extra(select=select, select_params=params).values(*select.keys())[0]
+        sums = dict((name, int(value or 0)) for name, value in sums.items())
+
+        if cache_key:
+            cache.set(cache_key, sums, VIEWS_CACHE_TIMEOUT)
+
+        return self._build_views(sums)
+
+    def get_views_many(self, objects, field='video'):
+        """
+        Return dict {obj.pk: views statistic} like *get_views* for many objects
+        at once, for listing pages. *field* is FK of *model* to *objects*.
+        Only objects filter is applied, so use this for handlers whose
+        *get_query_set* just filters by that FK.
+        """
+        objects = list(objects)
+        result = {}
+
+        keys = {}
+        for obj in objects:
+            cache_key = self.get_views_cache_key(**{field: obj})
+            if cache_key:
+                keys[self._views_cache_key(cache_key)] = obj.pk
+        cached = cache.get_many(keys.keys()) if keys else {}
+        for cache_key, sums in cached.items():
+            result[keys[cache_key]] = self._build_views(sums)
+
+        missing = [obj.pk for obj in objects if obj.pk not in result]
+        if not missing:
+            return result
+
+        qn = connection.ops.quote_name
+        column = qn(self.model._meta.get_field(field).column)
+        select, params, year_ago, today = self._windows_select()
+        sql = 'SELECT %s, %s FROM %s WHERE %s IN (%s) AND %s BETWEEN %%s AND %%s GROUP BY %s' % (
+            column,
+            ', '.join(select.values()),
+            qn(self.model._meta.db_table),
+            column, ', '.join(['%s'] * len(missing)),
+            qn('date'),
+            column)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params + missing + [year_ago, today])
+
+        to_cache = {}
+        fetched = {}
+        for row in cursor.fetchall():
+            fetched[row[0]] = dict(zip(select.keys(), [int(v or 0) for v in row[1:]]))
+
+        for obj in objects:
+            if obj.pk in result:
+                continue
+            sums = fetched.get(obj.pk, {})
+            result[obj.pk] = self._build_views(sums)
+
+            cache_key = self.get_views_cache_key(**{field: obj})
+            if cache_key:
+                to_cache[self._views_cache_key(cache_key)] = sums
+
+        if to_cache:
+            cache.set_many(to_cache, VIEWS_CACHE_TIMEOUT)
+
         return result
+
+    def _invalidate_views(self, updated_objects):
+        keys = set()
+        for obj in updated_objects:
+            cache_key = self.get_object_views_cache_key(obj)
+            if cache_key:
+                keys.add(self._views_cache_key(cache_key))
+        if keys:
+            cache.delete_many(list(keys))
     
     def post_migrate(self, updated_objects, updated_keys):
         """
@@ -289,10 +445,19 @@ class BasePerDayStatistic(object):
         """
         pass
     
-    def migrate(self, verbosity=1):
+    def migrate(self, verbosity=1, batch_size=None):
         """
         Migrate information from Redis to DB
+
+        If *batch_size* is passed and *parse_keys* is implemented, keys are
+        migrated in batches (see *migrate_batched*).
         """
+        if batch_size:
+            try:
+                return self.migrate_batched(batch_size, verbosity)
+            except NotImplementedError:
+                pass
+
         if verbosity >= 2:
             print '>>> Start migration...'
             
@@ -333,6 +498,7 @@ class BasePerDayStatistic(object):
                     pass
                 self.connection.delete(key)
 
+        self._invalidate_views(updated_objects)
         self.post_migrate(updated_objects, updated_keys)
 
         if self.log_to_redis and count:
@@ -340,6 +506,184 @@ class BasePerDayStatistic(object):
 
         return count
         
+    def migrate_batched(self, batch_size=1000, verbosity=1):
+        """
+        Migrate information from Redis to DB in batches of *batch_size* keys.
+
+        Per batch this costs three Redis round trips (SPOPs, GETSETs and
+        DELETEs are pipelined), the queries done by *parse_keys*, a couple of
+        queries to find or create the *model* rows and one UPDATE per distinct
+        increment value, instead of half a dozen queries for every key.
+
+        Keys are popped from the set before their counters are read and reset
+        with GETSET, and are deleted only after the DB was updated. The DB
+        writes of a batch are done in one transaction; if they fail, the
+        counts are added back to the counters with INCRBY and the keys put
+        back in the set before the error is raised, so nothing is lost.
+        Raises NotImplementedError if *parse_keys* is not implemented.
+        """
+        if verbosity >= 2:
+            print '>>> Start batched migration...'
+
+        start = time.time()
+
+        self.pre_migrate()
+
+        count = self.set_key.scard()
+        remaining = count
+
+        updated_keys = []
+        updated_objects = []
+
+        while remaining > 0:
+            if verbosity >= 2:
+                print '  >>> migrate keys: %s of %s' % ((count - remaining), count)
+
+            n = min(batch_size, remaining)
+            remaining -= n
+
+            pipe = self.connection.pipeline(transaction=False)
+            for i in xrange(n):
+                pipe.spop(self.set_key.redis_key)
+            keys = [key for key in pipe.execute() if key]
+
+            if not keys:
+                break
+
+            try:
+                parsed = self.parse_keys(keys)
+            except NotImplementedError:
+                # Put the keys back so that the unbatched migration sees them.
+                pipe = self.connection.pipeline(transaction=False)
+                for key in keys:
+                    pipe.sadd(self.set_key.redis_key, key)
+                pipe.execute()
+                raise
+
+            updated_keys.extend(keys)
+
+            pipe = self.connection.pipeline(transaction=False)
+            for key in keys:
+                pipe.getset(key, 0)
+            values = pipe.execute()
+
+            counts = {}
+            key_for_fields = {}
+            reset = {}
+            for key, value in zip(keys, values):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    continue
+                reset[key] = value
+
+                fields = parsed.get(key)
+                if fields is None:
+                    continue
+
+                group = tuple(sorted(fields.items()))
+                counts[group] = counts.get(group, 0) + value
+                key_for_fields.setdefault(group, key)
+
+            try:
+                updated_objects.extend(
+                    self._migrate_counts(counts, key_for_fields))
+            except Exception:
+                pipe = self.connection.pipeline(transaction=False)
+                for key, value in reset.items():
+                    if value:
+                        pipe.incr(key, value)
+                for key in keys:
+                    pipe.sadd(self.set_key.redis_key, key)
+                pipe.execute()
+                raise
+
+            pipe = self.connection.pipeline(transaction=False)
+            for key in keys:
+                pipe.delete(key)
+            pipe.execute()
+
+        self._invalidate_views(updated_objects)
+        self.post_migrate(updated_objects, updated_keys)
+
+        if self.log_to_redis and count:
+            self.log_to_redis.save(datetime.datetime.now(), count, time.time()-start)
+
+        return count
+
+    def _migrate_counts(self, counts, key_for_fields):
+        """
+        Add *counts*, a dict {group: value} as built in *migrate_batched*, to
+        the *model* rows and the totals in one transaction. Return the
+        updated objects.
+        """
+        # Creating the rows can't be rolled back cleanly after an
+        # IntegrityError on every backend, and rows with a count of 0 are
+        # harmless, so it's done before the transaction.
+        objects = self._get_or_create_objects(counts.keys())
+
+        by_value = {}
+        totals = []
+        updated_objects = []
+        for group, value in counts.items():
+            obj = objects.get(group)
+            if obj is None:
+                continue
+
+            by_value.setdefault(value, []).append(obj.pk)
+            totals.append((key_for_fields[group], obj, value))
+            updated_objects.append(obj)
+
+        with transaction.commit_on_success():
+            for value, pks in by_value.items():
+                self.model._default_manager.filter(pk__in=pks) \
+                    .update(count=models.F('count')+value)
+
+            self.update_totals(totals)
+
+        return updated_objects
+
+    def _get_or_create_objects(self, groups, chunk_size=200):
+        """
+        Return dict {group: obj} for *groups* of field values (as built in
+        *migrate_batched*), creating the missing *model* rows in bulk.
+        """
+        manager = self.model._default_manager
+        field_names = set()
+        for group in groups:
+            field_names.update(name for name, value in group)
+        field_names = sorted(field_names)
+
+        def _group_for(obj):
+            return tuple((name, getattr(obj, name)) for name in field_names)
+
+        def _fetch(groups):
+            found = {}
+            for i in xrange(0, len(groups), chunk_size):
+                q = reduce(operator.or_, [models.Q(**dict(group))
+                                          for group in groups[i:i+chunk_size]])
+                for obj in manager.filter(q):
+                    found[_group_for(obj)] = obj
+            return found
+
+        groups = list(groups)
+        objects = _fetch(groups)
+
+        missing = [group for group in groups if group not in objects]
+        if missing:
+            try:
+                manager.bulk_create([self.model(**dict(group)) for group in missing])
+            except IntegrityError:
+                # Somebody else created some of these rows in the meantime.
+                for group in missing:
+                    try:
+                        manager.get_or_create(**dict(group))
+                    except IntegrityError:
+                        pass
+            objects.update(_fetch(missing))
+
+        return objects
+
     def update(self, **kwargs):
         """
         Update counter for date in Redis
@@ -352,4 +696,25 @@ class BasePerDayStatistic(object):
         
         self.connection.incr(key)
         self.set_key.sadd(key)
-        self.total_key.incr()    
\ No newline at end of file
+        self.total_key.incr()
+
+    def update_many(self, counts, pipe=None):
+        """
+        Add *counts*, a dict of Redis keys from *get_key* to the number of
+        hits, to the counters in one round trip. Writes the same keys as
+        *update*. If *pipe* is passed the commands are only added to it.
+        """
+        if not counts:
+            return
+
+        execute = pipe is None
+        if execute:
+            pipe = self.connection.pipeline(transaction=False)
+
+        for key, n in counts.items():
+            pipe.incr(key, n)
+            pipe.sadd(self.set_key.redis_key, key)
+        pipe.incr(self.total_key.redis_key, sum(counts.values()))
+
+        if execute:
+            pipe.execute()
@@ -23,19 +23,19 @@ from statistic import (
     st_sub_fetch_handler, st_video_view_handler, st_widget_view_statistic
 )
 
-from django.db.models import Count, Sum
-from apps.statistic.models import (
-    EmailShareStatistic, TweeterShareStatistic, FBShareStatistic,
-    SubtitleFetchCounters
-)
+from django.conf import settings
+from django.db.models import Count
+from utils import rowcounts
 from utils.metrics import Gauge
 
 
 @periodic_task(run_every=timedelta(seconds=5))
 def gauge_statistic():
-    Gauge('statistic.shares.twitter').report(TweeterShareStatistic.objects.count())
-    Gauge('statistic.shares.facebook').report(FBShareStatistic.objects.count())
-    Gauge('statistic.shares.email').report(EmailShareStatistic.objects.count())
+    # Importing the models registers their row counters.
+    import statistic.models
+    for name in ('statistic.shares.twitter', 'statistic.shares.facebook',
+                 'statistic.shares.email'):
+        Gauge(name).report(rowcounts.value(name))
     Gauge('statistic.views.subtitles').report(int(st_sub_fetch_handler.total_key.get()))
 
 def graphite_slugify(s):
@@ -63,9 +63,12 @@ def gauge_statistic_languages():
 
 @periodic_task(run_every=timedelta(hours=6))
 def update_statistic(*args, **kwargs):
-    st_sub_fetch_handler.migrate(verbosity=kwargs.get('verbosity', 1))
-    st_video_view_handler.migrate(verbosity=kwargs.get('verbosity', 1))
-    st_widget_view_statistic.migrate(verbosity=kwargs.get('verbosity', 1))
+    verbosity = kwargs.get('verbosity', 1)
+    batch_size = getattr(settings, 'STATISTIC_MIGRATE_BATCH_SIZE', 1000)
+
+    st_sub_fetch_handler.migrate(verbosity=verbosity, batch_size=batch_size)
+    st_video_view_handler.migrate(verbosity=verbosity, batch_size=batch_size)
+    st_widget_view_statistic.migrate(verbosity=verbosity, batch_size=batch_size)
 
 
 @task
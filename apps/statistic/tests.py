@@ -0,0 +1,246 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+import datetime
+
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError
+from django.test import TestCase
+
+from statistic import (VideoViewStatistic, WidgetViewStatistic,
+                       st_sub_fetch_handler, st_widget_view_statistic)
+from statistic.buffer import CounterBuffer
+from statistic.models import WidgetViewCounter
+from subtitles.tests.utils import make_video
+from videos.models import Video
+
+
+class ViewsStatisticTest(TestCase):
+    def setUp(self):
+        self.handler = st_widget_view_statistic
+        self.today = datetime.date.today()
+        self.busy = make_video()
+        self.quiet = make_video()
+        self.unseen = make_video()
+        for video in (self.busy, self.quiet, self.unseen):
+            cache.delete(self._cache_key(video))
+
+        for days, count in [(0, 1), (3, 10), (20, 100), (200, 1000),
+                            (400, 10000)]:
+            self._add(self.busy, days, count)
+        self._add(self.quiet, 1, 5)
+
+    def _add(self, video, days, count):
+        WidgetViewCounter.objects.create(
+            video=video, count=count,
+            date=self.today - datetime.timedelta(days=days))
+
+    def _cache_key(self, video):
+        return self.handler._views_cache_key(
+            self.handler.get_views_cache_key(video=video))
+
+    def test_get_views(self):
+        views = self.handler.get_views(video=self.busy)
+        self.assertEqual(views['week'], 11)
+        self.assertEqual(views['month'], 111)
+        self.assertEqual(views['year'], 1111)
+        self.assertEqual(views['today'], 1)
+
+        self.assertEqual(self.handler.get_views(video=self.unseen),
+                         {'week': 0, 'month': 0, 'year': 0, 'today': 0})
+
+    def test_get_views_is_cached(self):
+        views = self.handler.get_views(video=self.busy)
+        self._add(self.busy, 2, 50)
+        self.assertEqual(self.handler.get_views(video=self.busy), views)
+
+    def test_get_views_many(self):
+        videos = [self.busy, self.quiet, self.unseen]
+        expected = dict((v.pk, self.handler.get_views(video=v))
+                        for v in videos)
+        for video in videos:
+            cache.delete(self._cache_key(video))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.handler.get_views_many(videos), expected)
+
+        # Everything is cached now, so it doesn't take another query.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.handler.get_views_many(videos), expected)
+
+    def test_prefetch_views(self):
+        videos = list(Video.objects.filter(
+            pk__in=[self.busy.pk, self.quiet.pk, self.unseen.pk]))
+        with self.assertNumQueries(1):
+            Video.prefetch_views(videos)
+        with self.assertNumQueries(0):
+            views = dict((v.pk, v.views) for v in videos)
+
+        self.assertEqual(views[self.busy.pk]['month'], 111)
+        self.assertEqual(views[self.quiet.pk]['week'], 5)
+        self.assertEqual(views[self.unseen.pk]['total'],
+                         self.unseen.widget_views_count)
+
+
+class TestWidgetViewStatistic(WidgetViewStatistic):
+    prefix = 'st_test_widget_view'
+    log_to_redis = None
+
+    def post_migrate(self, updated_objects, updated_keys):
+        pass
+
+
+class MigrateBatchedTest(TestCase):
+    def setUp(self):
+        self.handler = TestWidgetViewStatistic()
+        self.today = datetime.date.today()
+        self.yesterday = self.today - datetime.timedelta(days=1)
+        self.videos = [make_video() for i in xrange(3)]
+        self._clear()
+
+    def tearDown(self):
+        self._clear()
+
+    def _clear(self):
+        keys = self.handler.connection.keys('st_test_widget_view:*')
+        if keys:
+            self.handler.connection.delete(*keys)
+
+    def _hit(self, video, n, date=None):
+        key = self.handler.get_key(date=date or self.today, video=video)
+        self.handler.update_many({key: n})
+
+    def _count(self, video, date=None):
+        return WidgetViewCounter.objects.get(
+            video=video, date=date or self.today).count
+
+    def test_migrate_batched(self):
+        self._hit(self.videos[0], 3)
+        self._hit(self.videos[0], 2, self.yesterday)
+        self._hit(self.videos[1], 1)
+        self._hit(self.videos[2], 4)
+        WidgetViewCounter.objects.create(video=self.videos[2],
+                                         date=self.today, count=10)
+
+        self.assertEqual(self.handler.migrate_batched(batch_size=2), 4)
+
+        self.assertEqual(self._count(self.videos[0]), 3)
+        self.assertEqual(self._count(self.videos[0], self.yesterday), 2)
+        self.assertEqual(self._count(self.videos[1]), 1)
+        self.assertEqual(self._count(self.videos[2]), 14)
+        self.assertEqual(Video.objects.get(pk=self.videos[0].pk)
+                         .widget_views_count,
+                         self.videos[0].widget_views_count + 5)
+        self.assertEqual(self.handler.set_key.scard(), 0)
+
+        # Migrating again only adds what came in since.
+        self._hit(self.videos[1], 2)
+        self.handler.migrate_batched(batch_size=2)
+        self.assertEqual(self._count(self.videos[1]), 3)
+
+    def test_failed_batch_is_put_back(self):
+        self._hit(self.videos[0], 3)
+        self._hit(self.videos[1], 1)
+
+        def fail(groups):
+            raise DatabaseError('test')
+        self.handler._get_or_create_objects = fail
+
+        self.assertRaises(DatabaseError, self.handler.migrate_batched,
+                          batch_size=10)
+        self.assertEqual(self.handler.set_key.scard(), 2)
+        key = self.handler.get_key(date=self.today, video=self.videos[0])
+        self.assertEqual(int(self.handler.connection.get(key)), 3)
+
+        del self.handler._get_or_create_objects
+        self.handler.migrate_batched(batch_size=10)
+        self.assertEqual(self._count(self.videos[0]), 3)
+        self.assertEqual(self._count(self.videos[1]), 1)
+
+    def test_get_or_create_objects_after_integrity_error(self):
+        manager = WidgetViewCounter._default_manager
+        groups = [(('date', self.today), ('video_id', video.pk))
+                  for video in self.videos]
+
+        # Someone else creates one of the rows while we aren't looking.
+        def bulk_create(objs):
+            manager.create(video=self.videos[0], date=self.today)
+            raise IntegrityError('duplicate')
+        manager.bulk_create = bulk_create
+        try:
+            objects = self.handler._get_or_create_objects(groups)
+        finally:
+            del manager.bulk_create
+
+        self.assertEqual(sorted(objects.keys()), sorted(groups))
+        self.assertEqual(WidgetViewCounter.objects.filter(
+            video__in=self.videos, date=self.today).count(), 3)
+
+
+class TestViewStatistic(VideoViewStatistic):
+    prefix = 'st_test_view'
+
+
+class StatisticBufferTest(TestCase):
+    def setUp(self):
+        self.handler = TestViewStatistic()
+        self.buffer = CounterBuffer(interval=None, size=5)
+        self._clear()
+
+    def tearDown(self):
+        self._clear()
+
+    def _clear(self):
+        keys = self.handler.connection.keys('st_test_view:*')
+        if keys:
+            self.handler.connection.delete(*keys)
+
+    def _counters(self):
+        return dict((key, int(self.handler.connection.get(key)))
+                    for key in self.handler.set_key.smembers())
+
+    def test_flush_matches_update(self):
+        for video_id in ['a', 'a', 'b']:
+            self.handler.update(video_id=video_id)
+        expected = self._counters()
+        self._clear()
+
+        for video_id in ['a', 'a', 'b']:
+            self.buffer.add(self.handler, video_id=video_id)
+        self.assertEqual(self._counters(), {})
+
+        self.buffer.flush()
+        self.assertEqual(self._counters(), expected)
+        self.assertEqual(int(self.handler.total_key.get()), 3)
+
+    def test_flush_when_full(self):
+        for i in xrange(5):
+            self.buffer.add(self.handler, video_id='a')
+
+        self.assertEqual(self.buffer.counts, {})
+        self.assertEqual(sum(self._counters().values()), 5)
+
+    def test_subtitle_fetch_key(self):
+        video = make_video()
+        date = datetime.date(2012, 10, 1)
+        with self.assertNumQueries(0):
+            key = st_sub_fetch_handler.get_key(
+                date=date, video_id=video.video_id, language_code='en')
+        self.assertEqual(key, 'st_subtitles_fetch:%s::en:2012-10-1' %
+                         video.video_id)
+
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program.  If not, see http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Shared cache of decoded SubtitleSets.
+
+Decoding a version's subtitles (decompressing the blob and parsing the DFXP) is
+expensive, and the same popular versions get decoded over and over by the
+widget, downloads, diffs and billing.  SubtitleVersions are immutable once
+saved, so the decoded set for a given version id never goes stale and we can
+share it freely.
+
+Keys also include a checksum of the serialized blob.  It's cheap to compute and
+protects us from rows that get rewritten in place (data migrations) and from
+ids that get reused (SQLite reuses them after test rollbacks).
+
+There are two tiers:
+
+* A bounded, in-process LRU that holds the parsed SubtitleSet objects.
+* An optional tier in Django's cache that holds the decompressed DFXP, so that
+  other processes can skip the decompression step.  Set
+  SUBTITLE_SET_CACHE_TIMEOUT to 0 to disable it.
+
+SubtitleSets handed out by this cache are shared between callers.  Treat them
+as read-only!
+
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.metrics import Meter
+
+
+LRU_SIZE = getattr(settings, 'SUBTITLE_SET_CACHE_SIZE', 500)
+TIMEOUT = getattr(settings, 'SUBTITLE_SET_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+class LRUCache(object):
+    """A small thread-safe LRU mapping with a fixed maximum size."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+
+            # Re-insert to mark it as the most recently used.
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SubtitleSetCache(object):
+    """Two-tier cache of decoded SubtitleSets, keyed by SubtitleVersion id."""
+
+    def __init__(self, max_size=LRU_SIZE, timeout=TIMEOUT):
+        self.lru = LRUCache(max_size)
+        self.timeout = timeout
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _key(self, version_id, serialized):
+        return '%s-%08x' % (version_id, zlib.crc32(serialized) & 0xffffffff)
+
+    def _shared_key(self, key):
+        return 'subtitles-decoded-set-%s' % key
+
+    def get(self, version_id, serialized, decode, load_shared):
+        """Return the decoded SubtitleSet for the given version id.
+
+        `serialized` is the version's serialized_subtitles blob.
+
+        `decode` is a callable that takes no arguments and returns a tuple of
+        (subtitle_set, shared_value).  It is only called on a miss in both
+        tiers.  `shared_value` is what will be stored in the Django cache tier.
+
+        `load_shared` is a callable that turns a value from the Django cache
+        tier back into a SubtitleSet.
+
+        """
+        if isinstance(serialized, unicode):
+            serialized = serialized.encode('utf-8')
+        key = self._key(version_id, serialized)
+
+        subtitles = self.lru.get(key)
+        if subtitles is not None:
+            self.hits += 1
+            Meter('subtitles.set-cache.hits').inc()
+            return subtitles
+
+        shared = None
+        if self.timeout:
+            shared = cache.get(self._shared_key(key))
+
+        if shared is not None:
+            self.shared_hits += 1
+            Meter('subtitles.set-cache.shared-hits').inc()
+            subtitles = load_shared(shared)
+        else:
+            self.misses += 1
+            Meter('subtitles.set-cache.misses').inc()
+            subtitles, shared = decode()
+
+            if self.timeout and shared is not None:
+                cache.set(self._shared_key(key), shared, self.timeout)
+
+        self.lru.set(key, subtitles)
+        return subtitles
+
+    def clear(self):
+        """Clear the in-process tier and reset the counters."""
+        self.lru.clear()
+        self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self.lru),
+            'max_size': self.lru.max_size,
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+        }
+
+
+subtitle_set_cache = SubtitleSetCache()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program.  If not, see http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Diffing subtitle versions.
+
+Everything here works on plain lists of (start, end, text) tuples (anything
+longer, like the (start, end, text, meta) tuples of get_subtitle_items, is
+fine too -- the extra fields are ignored).
+
+Subtitles are aligned in two passes, patience diff style:
+
+1. Subtitles whose text occurs exactly once in each version are anchors.  We
+   keep the longest run of anchors that appear in the same order in both
+   versions (a longest increasing subsequence, so O(n log n)).  This is what
+   lets a line that was only retimed, or that moved because lines were
+   inserted above it, still be matched with itself.
+2. The stretches between anchors are matched by text from both ends, and then
+   by overlapping timing, walking both sides in order.  Subtitles that overlap
+   in time are treated as the same line with new text; anything left over was
+   added or removed.
+
+Both passes are linear apart from the LIS, so this is fine for transcripts
+with thousands of lines.
+
+Versions are immutable, so diffs of saved versions are memoized per pair in a
+small in-process LRU (see version_diff).
+
+"""
+
+import zlib
+from bisect import bisect_left
+
+from django.conf import settings
+
+from apps.subtitles.cache import LRUCache
+from utils.metrics import Meter
+
+
+DIFF_CACHE_SIZE = getattr(settings, 'SUBTITLE_DIFF_CACHE_SIZE', 100)
+
+
+def _text(item):
+    return item[2]
+
+def _timing(item):
+    return item[0], item[1]
+
+def _overlaps(a, b):
+    """Return whether two subtitles look like the same line, by timing.
+
+    Unsynced subtitles only overlap other unsynced subtitles.
+
+    """
+    if a[0] is None or b[0] is None:
+        return a[0] is None and b[0] is None
+
+    a_end = a[1] if a[1] is not None else a[0]
+    b_end = b[1] if b[1] is not None else b[0]
+    return a[0] <= b_end and b[0] <= a_end
+
+def _longest_increasing_run(pairs):
+    """Return the longest subsequence of pairs whose second items increase.
+
+    `pairs` must be sorted by their first items.
+
+    """
+    tails = []      # tails[k] = index into pairs of the best run of length k+1
+    tail_values = []
+    previous = [None] * len(pairs)
+
+    for i, (_, j) in enumerate(pairs):
+        k = bisect_left(tail_values, j)
+        if k:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(j)
+        else:
+            tails[k] = i
+            tail_values[k] = j
+
+    run = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        run.append(pairs[i])
+        i = previous[i]
+    run.reverse()
+    return run
+
+def _anchors(old, new, old_lo, old_hi, new_lo, new_hi):
+    """Return (old index, new index) pairs of subtitles with unique text."""
+    old_counts, new_counts = {}, {}
+    for i in xrange(old_lo, old_hi):
+        text = _text(old[i])
+        old_counts[text] = i if text not in old_counts else None
+    for j in xrange(new_lo, new_hi):
+        text = _text(new[j])
+        new_counts[text] = j if text not in new_counts else None
+
+    pairs = []
+    for text, i in old_counts.iteritems():
+        if i is not None and new_counts.get(text) is not None:
+            pairs.append((i, new_counts[text]))
+    pairs.sort()
+
+    return _longest_increasing_run(pairs)
+
+def _align_gap(old, new, old_lo, old_hi, new_lo, new_hi, ops):
+    """Align a stretch with no anchors, appending the ops to `ops`."""
+    # Same text at either end.
+    while (old_lo < old_hi and new_lo < new_hi
+           and _text(old[old_lo]) == _text(new[new_lo])):
+        ops.append((old_lo, new_lo))
+        old_lo += 1
+        new_lo += 1
+
+    tail = []
+    while (old_lo < old_hi and new_lo < new_hi
+           and _text(old[old_hi - 1]) == _text(new[new_hi - 1])):
+        old_hi -= 1
+        new_hi -= 1
+        tail.append((old_hi, new_hi))
+
+    # Whatever's left, match by timing.
+    i, j = old_lo, new_lo
+    while i < old_hi and j < new_hi:
+        if _overlaps(old[i], new[j]):
+            ops.append((i, j))
+            i += 1
+            j += 1
+        elif old[i][0] is not None and (new[j][0] is None
+                                        or old[i][0] <= new[j][0]):
+            ops.append((i, None))
+            i += 1
+        else:
+            ops.append((None, j))
+            j += 1
+
+    ops.extend((i, None) for i in xrange(i, old_hi))
+    ops.extend((None, j) for j in xrange(j, new_hi))
+
+    tail.reverse()
+    ops.extend(tail)
+
+def align(old, new):
+    """Align two lists of subtitles.
+
+    Returns a list of (old index, new index) pairs in order.  The old index is
+    None for subtitles that were added, and the new index for ones that were
+    removed.
+
+    """
+    ops = []
+    old_lo, old_hi, new_lo, new_hi = 0, len(old), 0, len(new)
+
+    for i, j in _anchors(old, new, old_lo, old_hi, new_lo, new_hi):
+        _align_gap(old, new, old_lo, i, new_lo, j, ops)
+        ops.append((i, j))
+        old_lo, new_lo = i + 1, j + 1
+
+    _align_gap(old, new, old_lo, old_hi, new_lo, new_hi, ops)
+    return ops
+
+
+class SubtitleDiff(object):
+    """The alignment of two lists of subtitles, and what changed between them."""
+
+    def __init__(self, old, new):
+        self.old = [tuple(item[:3]) for item in old]
+        self.new = [tuple(item[:3]) for item in new]
+        self.ops = align(self.old, self.new)
+        self._changes = None
+
+    def rows(self):
+        """Return a list of (old subtitle, new subtitle, changed) rows.
+
+        Either subtitle is None if it was added or removed.  `changed` is a
+        dict with 'text', 'time' and 'end_time' flags (just 'text' and 'time'
+        for added and removed subtitles).
+
+        """
+        rows = []
+        for i, j in self.ops:
+            old = self.old[i] if i is not None else None
+            new = self.new[j] if j is not None else None
+
+            if old is None or new is None:
+                changed = dict(text=True, time=True)
+            else:
+                changed = {
+                    'text': old[2] != new[2],
+                    'time': old[0] != new[0],
+                    'end_time': old[1] != new[1],
+                }
+            rows.append((old, new, changed))
+
+        return rows
+
+    def changes(self):
+        """Return (time_change, text_change) as fractions of the new subtitles.
+
+        A retimed subtitle counts as a time change, one with new text as a text
+        change.  Added and removed subtitles count as both.
+
+        """
+        if self._changes is None:
+            self._changes = self._count_changes()
+        return self._changes
+
+    def _count_changes(self):
+        if not self.old or not self.new:
+            if self.old or self.new:
+                # If one version is empty but the other isn't: 100%.
+                return (1.0, 1.0)
+            else:
+                # If both versions are empty: 0%.
+                return (0.0, 0.0)
+
+        time_count = text_count = 0
+        for i, j in self.ops:
+            if i is None or j is None:
+                time_count += 1
+                text_count += 1
+                continue
+
+            old, new = self.old[i], self.new[j]
+            if _timing(old) != _timing(new):
+                time_count += 1
+            if old[2] != new[2]:
+                text_count += 1
+
+        length = float(len(self.new))
+        return min(time_count / length, 1), min(text_count / length, 1)
+
+
+_diffs = LRUCache(DIFF_CACHE_SIZE)
+
+def _version_key(version):
+    serialized = version.serialized_subtitles
+    if isinstance(serialized, unicode):
+        serialized = serialized.encode('utf-8')
+    return (version.pk, zlib.crc32(serialized) & 0xffffffff)
+
+def version_diff(old_version, new_version):
+    """Return the SubtitleDiff between two SubtitleVersions.
+
+    Diffs of saved versions are memoized, keyed (like the subtitle set cache)
+    by version id and a checksum of the serialized subtitles.  The
+    SubtitleDiffs handed out are shared, so treat them as read-only.
+
+    """
+    key = None
+    if old_version.pk and new_version.pk:
+        key = (_version_key(old_version), _version_key(new_version))
+        diff = _diffs.get(key)
+        if diff is not None:
+            Meter('subtitles.diff-cache.hits').inc()
+            return diff
+        Meter('subtitles.diff-cache.misses').inc()
+
+    diff = SubtitleDiff(old_version.get_subtitle_items(),
+                        new_version.get_subtitle_items())
+    if key:
+        _diffs.set(key, diff)
+    return diff
+
+def clear_cache():
+    _diffs.clear()
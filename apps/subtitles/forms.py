@@ -71,7 +71,7 @@ class SubtitlesUploadForm(forms.Form):
     # Validation for various restrictions on subtitle uploads.
     def _verify_not_writelocked(self, subtitle_language):
         writelocked = (subtitle_language.is_writelocked and
-                       subtitle_language.writelock_owner != self.user)
+                       subtitle_language.get_writelock_owner() != self.user)
         if writelocked:
             raise forms.ValidationError(_(
                 u"Sorry, we can't upload your subtitles because work on "
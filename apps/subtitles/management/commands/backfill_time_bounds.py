@@ -0,0 +1,85 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Fill in the time bounds of SubtitleVersions saved before they existed."""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.subtitles.models import (SubtitleVersion, get_time_bounds,
+                                   deserialize_subtitle_items)
+
+
+class Command(BaseCommand):
+    help = ('Set SubtitleVersion.first_start_time and last_end_time from the '
+            'subtitles, in batches.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=500,
+                    help='Number of versions to update per transaction.'),
+        make_option('--start-id', action='store', dest='start_id',
+                    type='int', default=0,
+                    help='Only update versions with an id greater than this '
+                         '(useful for resuming).'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        verbosity = int(options.get('verbosity', 1))
+
+        updated = 0
+        start = time.time()
+
+        while True:
+            rows = list(SubtitleVersion.objects
+                                       .filter(pk__gt=last_id,
+                                               subtitle_count__gt=0,
+                                               first_start_time=None,
+                                               last_end_time=None)
+                                       .order_by('pk')
+                                       .values_list('pk',
+                                                    'serialized_subtitles')
+                                       [:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            self._write([(pk, get_time_bounds(
+                deserialize_subtitle_items(serialized)))
+                for pk, serialized in rows])
+
+            updated += len(rows)
+            if verbosity >= 1:
+                print 'Updated %d versions (last id %s, %.1fs)' % (
+                    updated, last_id, time.time() - start)
+
+        print 'Done: %d updated, last id %s' % (updated, last_id)
+
+    @transaction.commit_on_success
+    def _write(self, bounds):
+        for pk, (first_start_time, last_end_time) in bounds:
+            if first_start_time is None and last_end_time is None:
+                continue
+            SubtitleVersion.objects.filter(pk=pk).update(
+                first_start_time=first_start_time,
+                last_end_time=last_end_time)
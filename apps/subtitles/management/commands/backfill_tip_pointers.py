@@ -0,0 +1,86 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Recompute the denormalized tip pointers of existing SubtitleLanguages.
+
+Migration 0017 fills them in when it adds them; this is for fixing them up
+afterwards, e.g. after versions were changed behind the ORM's back.
+
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.subtitles.models import SubtitleLanguage, SubtitleVersion
+
+
+class Command(BaseCommand):
+    help = ('Set SubtitleLanguage.tip_version, public_tip_version and '
+            'tip_subtitle_count from the versions, in batches.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=500,
+                    help='Number of languages to update per transaction.'),
+        make_option('--start-id', action='store', dest='start_id',
+                    type='int', default=0,
+                    help='Only update languages with an id greater than this '
+                         '(useful for resuming).'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        verbosity = int(options.get('verbosity', 1))
+
+        updated = 0
+        start = time.time()
+
+        while True:
+            ids = list(SubtitleLanguage.objects
+                                       .filter(pk__gt=last_id)
+                                       .order_by('pk')
+                                       .values_list('pk', flat=True)
+                                       [:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            # Pass ids rather than objects so tips() computes the tips from
+            # the versions instead of trusting the pointers we're filling in.
+            tips = SubtitleVersion.objects.tips(ids)
+            public_tips = SubtitleVersion.objects.tips(ids, public=True)
+            self._write(ids, tips, public_tips)
+
+            updated += len(ids)
+            if verbosity >= 1:
+                print 'Updated %d languages (last id %s, %.1fs)' % (
+                    updated, last_id, time.time() - start)
+
+        print 'Done: %d updated, last id %s' % (updated, last_id)
+
+    @transaction.commit_on_success
+    def _write(self, ids, tips, public_tips):
+        for pk in ids:
+            tip = tips.get(pk)
+            SubtitleLanguage.objects.filter(pk=pk).update(
+                tip_version=tip, public_tip_version=public_tips.get(pk),
+                tip_subtitle_count=tip.subtitle_count if tip else 0)
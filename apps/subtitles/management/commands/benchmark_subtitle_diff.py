@@ -0,0 +1,178 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Compare the subtitle diff engine with the dict based diffs it replaced."""
+
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.subtitles import diff
+
+
+def legacy_changes(subtitles, last_subtitles):
+    """SubtitleVersion.get_changes as it was before apps.subtitles.diff."""
+    sub_dict = dict([("-".join(map(str, s[0:2])), s[2]) for s in subtitles])
+    last_sub_dict = dict([("-".join(map(str, s[0:2])), s[2])
+                          for s in last_subtitles])
+
+    sub_dict_reverse = dict((v, k) for k, v in sub_dict.iteritems())
+    last_sub_dict_reverse = dict((v, k) for k, v in last_sub_dict.iteritems())
+
+    text_count_changed = 0
+    time_count_changed = 0
+
+    for sub_timing in sub_dict:
+        if sub_timing in last_sub_dict:
+            if not last_sub_dict[sub_timing] == sub_dict[sub_timing]:
+                text_count_changed += 1
+
+    for sub_text in sub_dict_reverse:
+        try:
+            last = last_sub_dict_reverse[sub_text]
+            current = sub_dict_reverse[sub_text]
+        except KeyError:
+            continue
+
+        if not last == current:
+            time_count_changed += 1
+
+    for sub_timing in last_sub_dict:
+        if sub_timing not in sub_dict.keys():
+            text_count_changed += 1
+            time_count_changed += 1
+
+    for sub_timing in sub_dict:
+        if sub_timing not in last_sub_dict.keys():
+            text_count_changed += 1
+            time_count_changed += 1
+
+    subs_length = len(subtitles)
+    return (min(time_count_changed / 1. / subs_length, 1),
+            min(text_count_changed / 1. / subs_length, 1))
+
+def legacy_caption_diff_data(first_captions, second_captions):
+    """get_caption_diff_data as it was before apps.subtitles.diff."""
+    subtitles = {}
+    first_map = {}
+    second_map = {}
+
+    for start, end, text in first_captions:
+        id = str(start) + str(end)
+        if not id in subtitles:
+            subtitles[id] = (start, end, text)
+        first_map[id] = (start, end, text)
+
+    for start, end, text in second_captions:
+        id = str(start) + str(end)
+        if not id in subtitles:
+            subtitles[id] = (start, end, text)
+        second_map[id] = (start, end, text)
+
+    subs = subtitles.items()
+    subs.sort(key=lambda item: item[1][0])
+
+    captions = []
+    for id, s in subs:
+        fcaption = first_map.get(id)
+        scaption = second_map.get(id)
+        if fcaption is None or scaption is None:
+            changed = dict(text=True, time=True)
+        else:
+            changed = {
+                'text': (not fcaption[2] == scaption[2]),
+                'time': (not fcaption[0] == scaption[0]),
+                'end_time': (not fcaption[1]== scaption[1])
+            }
+        captions.append([fcaption, scaption, changed])
+
+    return captions
+
+def _timeit(fn, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = ('Benchmark diffing two synthetic transcripts with the diff engine '
+            'and with the dict based diffs it replaced.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--lines', action='store', dest='lines', type='int',
+                    default=5000,
+                    help='Number of subtitles in each transcript.'),
+        make_option('--edits', action='store', dest='edits', type='int',
+                    default=50,
+                    help='Number of lines inserted, edited and retimed.'),
+        make_option('--repeat', action='store', dest='repeat', type='int',
+                    default=5,
+                    help='Number of diffs to average over.'),
+    )
+
+    def handle(self, *args, **options):
+        lines, edits, repeat = (options['lines'], options['edits'],
+                                options['repeat'])
+        rng = random.Random(0)
+
+        old = [(i * 2000, i * 2000 + 1500, u'Line number %d of the talk.' % i)
+               for i in xrange(lines)]
+
+        # Insert lines near the top so that everything after them moves down,
+        # then edit and retime some others.
+        new = list(old)
+        for i in xrange(edits):
+            start = rng.randrange(0, 20000)
+            new.insert(rng.randrange(0, 10), (start, start + 500,
+                                              u'Inserted %d' % i))
+        new.sort(key=lambda s: s[0])
+        for i in rng.sample(xrange(len(new)), edits):
+            start, end, text = new[i]
+            new[i] = (start, end, text + u' (edited)')
+        for i in rng.sample(xrange(len(new)), edits):
+            start, end, text = new[i]
+            new[i] = (start + 100, end + 100, text)
+
+        print '%d -> %d lines, %d edits of each kind:' % (len(old), len(new),
+                                                          edits)
+        print
+        print '%-28s %12s %20s' % ('diff', 'ms', '(time, text) change')
+
+        def report(name, fn, changes=None):
+            ms = _timeit(fn, repeat)
+            if changes:
+                print '%-28s %12.1f %9.3f %9.3f' % ((name, ms) + changes)
+            else:
+                print '%-28s %12.1f' % (name, ms)
+
+        report('legacy get_changes', lambda: legacy_changes(new, old),
+               legacy_changes(new, old))
+        report('legacy caption diff data',
+               lambda: legacy_caption_diff_data(new, old))
+        report('diff engine changes',
+               lambda: diff.SubtitleDiff(old, new).changes(),
+               diff.SubtitleDiff(old, new).changes())
+        report('diff engine rows', lambda: diff.SubtitleDiff(old, new).rows())
+
+        # The memoized path, as hit by a notification email after the history
+        # page has already diffed the pair.
+        memoized = diff.SubtitleDiff(old, new)
+        report('memoized changes', memoized.changes, memoized.changes())
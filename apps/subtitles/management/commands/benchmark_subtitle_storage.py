@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Compare the legacy DFXP subtitle storage with the packed binary format."""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from babelsubs.storage import SubtitleSet
+
+from apps.subtitles import packing
+from apps.subtitles.models import (
+    SubtitleVersion, serialize_subtitles, deserialize_subtitle_items, _load_dfxp
+)
+from utils.compress import decompress
+
+
+def _timeit(fn, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = ('Benchmark bytes stored and decode time of the DFXP and packed '
+            'subtitle storage formats.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--lines', action='store', dest='lines', type='int',
+                    default=1000,
+                    help='Number of subtitles in the synthetic set.'),
+        make_option('--repeat', action='store', dest='repeat', type='int',
+                    default=20,
+                    help='Number of decodes to average over.'),
+        make_option('--sample', action='store', dest='sample', type='int',
+                    default=0,
+                    help='Also benchmark this many real versions from the DB.'),
+    )
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        items = [(i * 2000, i * 2000 + 1500,
+                  u'Subtitle line number %d, with some ünïcödé text.' % i)
+                 for i in xrange(options['lines'])]
+        subtitles = SubtitleSet.from_list('en', items)
+
+        print 'Synthetic set of %d subtitles:' % len(items)
+        self.report([serialize_subtitles(subtitles, 'dfxp')], repeat)
+
+        if options['sample']:
+            blobs = list(SubtitleVersion.objects.order_by('-pk')
+                                                .values_list('serialized_subtitles', flat=True)
+                                                [:options['sample']])
+            blobs = [b for b in blobs if not packing.is_packed(b)]
+
+            print
+            print '%d real versions:' % len(blobs)
+            self.report(blobs, repeat)
+
+    def report(self, dfxp_blobs, repeat):
+        packed_blobs = [packing.pack(deserialize_subtitle_items(b))
+                        for b in dfxp_blobs]
+        raw_blobs = [packing.pack(deserialize_subtitle_items(b), compress=False)
+                     for b in dfxp_blobs]
+
+        def decode_dfxp():
+            for b in dfxp_blobs:
+                _load_dfxp(decompress(b)).subtitle_items()
+
+        def decode_packed():
+            for b in packed_blobs:
+                packing.unpack(b)
+
+        def decode_packed_to_set():
+            for b in packed_blobs:
+                SubtitleSet.from_list('en', packing.unpack(b), escape=False)
+
+        rows = [
+            ('dfxp (base64+zlib)', dfxp_blobs, decode_dfxp),
+            ('packed (zlib)', packed_blobs, decode_packed),
+            ('packed (raw)', raw_blobs, None),
+            ('packed -> SubtitleSet', packed_blobs, decode_packed_to_set),
+        ]
+
+        baseline = sum(len(b) for b in dfxp_blobs) or 1
+        print '%-24s %12s %8s %12s' % ('format', 'bytes', 'ratio', 'decode ms')
+        for name, blobs, decode in rows:
+            size = sum(len(b) for b in blobs)
+            ms = ('%12.3f' % _timeit(decode, repeat)) if decode else '%12s' % '-'
+            print '%-24s %12d %7.1f%% %s' % (name, size, 100.0 * size / baseline, ms)
@@ -0,0 +1,122 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Compare tip lookups through the denormalized pointers with the old queries.
+
+The numbers only mean something against a production-sized database (the
+interesting case is a snapshot with ~10M versions), and after
+backfill_tip_pointers has been run on it.
+
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.subtitles.models import SubtitleLanguage, SubtitleVersion
+
+
+# The filter having_nonempty_tip used before the pointers existed.
+LEGACY_NONEMPTY_TIP_WHERE = """
+EXISTS (
+   SELECT 1 FROM subtitles_subtitleversion AS sv
+    INNER JOIN (
+       SELECT subtitle_language_id,
+              MAX(version_number) AS tip_version_number
+       FROM subtitles_subtitleversion AS subver
+       GROUP BY subtitle_language_id
+    ) AS tip_versions ON (
+        sv.subtitle_language_id = tip_versions.subtitle_language_id
+        AND sv.version_number = tip_versions.tip_version_number
+    )
+    WHERE sv.subtitle_count > 0
+      AND sv.subtitle_language_id = subtitles_subtitlelanguage.id
+)
+"""
+
+def _timeit(fn, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = ('Benchmark get_tip and having_nonempty_tip with the denormalized '
+            'tip pointers against the queries they replaced.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sample', action='store', dest='sample', type='int',
+                    default=200,
+                    help='Number of languages to call get_tip on.'),
+        make_option('--repeat', action='store', dest='repeat', type='int',
+                    default=3,
+                    help='Number of runs to average over.'),
+        make_option('--video', action='store', dest='video_id', default=None,
+                    help='Restrict the having_nonempty_tip query to a video.'),
+    )
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        print 'subtitles_subtitleversion: %d rows' % (
+            SubtitleVersion.objects.count())
+        print 'subtitles_subtitlelanguage: %d rows' % (
+            SubtitleLanguage.objects.count())
+        print
+
+        languages = list(SubtitleLanguage.objects.exclude(tip_version=None)
+                                                 .order_by('-pk')
+                                                 [:options['sample']])
+
+        def old_get_tip():
+            for sl in languages:
+                sl._find_tip(public=False)
+                sl._find_tip(public=True)
+
+        def new_get_tip():
+            for sl in languages:
+                # Drop the cached related objects so each run hits the DB.
+                sl.__dict__.pop('_tip_version_cache', None)
+                sl.__dict__.pop('_public_tip_version_cache', None)
+                sl.get_tip(public=False)
+                sl.get_tip(public=True)
+
+        qs = SubtitleLanguage.objects.all()
+        if options['video_id']:
+            qs = qs.filter(video__video_id=options['video_id'])
+
+        def old_nonempty():
+            list(qs.extra(where=[LEGACY_NONEMPTY_TIP_WHERE])
+                   .values_list('pk', flat=True))
+
+        def new_nonempty():
+            list(qs.filter(pk__in=SubtitleLanguage.objects.having_nonempty_tip())
+                   .values_list('pk', flat=True))
+
+        rows = [
+            ('get_tip x%d (ORDER BY/LIMIT)' % len(languages), old_get_tip),
+            ('get_tip x%d (pointers)' % len(languages), new_get_tip),
+            ('having_nonempty_tip (GROUP BY)', old_nonempty),
+            ('having_nonempty_tip (pointers)', new_nonempty),
+        ]
+
+        print '%-36s %12s' % ('query', 'ms')
+        for name, fn in rows:
+            print '%-36s %12.1f' % (name, _timeit(fn, repeat))
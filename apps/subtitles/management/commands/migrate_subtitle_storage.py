@@ -0,0 +1,118 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Rewrite legacy DFXP subtitle blobs in the packed binary format."""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.subtitles import packing
+from apps.subtitles.models import SubtitleVersion, repack_subtitles
+
+
+class Command(BaseCommand):
+    help = ('Migrate SubtitleVersion.serialized_subtitles from base64/zlib DFXP '
+            'to the packed binary format, in batches.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=500,
+                    help='Number of versions to convert per transaction.'),
+        make_option('--start-id', action='store', dest='start_id',
+                    type='int', default=0,
+                    help='Only convert versions with an id greater than this '
+                         '(useful for resuming).'),
+        make_option('--limit', action='store', dest='limit',
+                    type='int', default=None,
+                    help='Stop after converting this many versions.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Decode and re-encode, but do not write anything.'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        limit = options['limit']
+        dry_run = options['dry_run']
+        verbosity = int(options.get('verbosity', 1))
+
+        converted = failed = kept = 0
+        bytes_before = bytes_after = 0
+        start = time.time()
+
+        while limit is None or converted < limit:
+            # Walk by primary key so each batch is a cheap range scan, no
+            # matter how far into the table we are.
+            rows = list(SubtitleVersion.objects
+                                       .filter(pk__gt=last_id)
+                                       .order_by('pk')
+                                       .values_list('pk', 'language_code',
+                                                    'serialized_subtitles')
+                                       [:batch_size])
+            if not rows:
+                break
+
+            updates = []
+            for pk, language_code, serialized in rows:
+                last_id = pk
+
+                if packing.is_packed(serialized):
+                    continue
+
+                try:
+                    packed = repack_subtitles(language_code, serialized)
+                except Exception, e:
+                    failed += 1
+                    print 'Failed to convert version %s: %s' % (pk, e)
+                    continue
+
+                if packed is None:
+                    # It has metadata or styling the packed format would drop.
+                    kept += 1
+                    continue
+
+                bytes_before += len(serialized)
+                bytes_after += len(packed)
+                updates.append((pk, packed))
+
+            if not dry_run:
+                self._write(updates)
+
+            converted += len(updates)
+
+            if verbosity >= 1:
+                print 'Converted %d versions (last id %s, %.1fs)' % (
+                    converted, last_id, time.time() - start)
+
+        print 'Done: %d converted, %d kept as DFXP, %d failed, last id %s' % (
+            converted, kept, failed, last_id)
+        if bytes_before:
+            print 'Stored size: %d -> %d bytes (%.1f%%)' % (
+                bytes_before, bytes_after, 100.0 * bytes_after / bytes_before)
+
+    @transaction.commit_on_success
+    def _write(self, updates):
+        # Versions are immutable, so there's no risk of clobbering a
+        # concurrent edit here.
+        for pk, packed in updates:
+            SubtitleVersion.objects.filter(pk=pk).update(
+                serialized_subtitles=packed)
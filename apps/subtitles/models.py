@@ -19,6 +19,7 @@
 """Django models represention subtitles."""
 
 import itertools
+import operator
 from datetime import datetime, date, timedelta
 
 from django.conf import settings
@@ -27,14 +28,17 @@ from django.db import models
 from django.utils import simplejson as json
 from django.utils.translation import ugettext_lazy as _
 
-from apps.subtitles import shims
+from apps.subtitles import diff, packing, shims
+from apps.subtitles.cache import subtitle_set_cache
 from apps.auth.models import CustomUser as User
 from apps.videos.models import Video, Action
 from babelsubs.storage import SubtitleSet
 from babelsubs import load_from
 
 from utils.compress import compress, decompress
+from utils.leases import LeaseService
 from utils.redis_utils import RedisSimpleField
+from utils import rowcounts
 from utils.translation import is_rtl
 
 ALL_LANGUAGES = sorted([(val, _(name)) for val, name in settings.ALL_LANGUAGES],
@@ -43,6 +47,18 @@ ALL_LANGUAGES = sorted([(val, _(name)) for val, name in settings.ALL_LANGUAGES],
 
 WRITELOCK_EXPIRATION = 30 # 30 seconds
 
+# Writelocks are leases in Redis, grouped by video_id and named by language
+# code.  If WRITELOCK_AUDIT is set we also record who took the lock and when
+# in the SubtitleLanguage's writelock_* columns, but those are never used to
+# decide whether a language is locked.
+writelocks = LeaseService('writelock', WRITELOCK_EXPIRATION)
+WRITELOCK_AUDIT = getattr(settings, 'WRITELOCK_AUDIT', True)
+
+# Format used when writing SubtitleVersion.serialized_subtitles.  Either
+# 'packed' (see apps.subtitles.packing) or 'dfxp' (the legacy base64'ed zlib'ed
+# DFXP).  Both formats are always readable.
+SUBTITLE_STORAGE_FORMAT = getattr(settings, 'SUBTITLE_STORAGE_FORMAT', 'packed')
+
 # Utility functions -----------------------------------------------------------
 def mapcat(fn, iterable):
     """Mapcatenate.
@@ -107,63 +123,102 @@ def get_caption_diff_data(first_version, second_version):
     """
     Return a list of captions that looks something like this:
     [
-        [None, (0, 100, 'Hello'), {'text': True, 'time': True}]
-        [(50, 150, 'Hello'), None, {'text': True, 'time': True}]
+        [(50, 150, 'Hello'), (0, 100, 'Hello'), {'text': False, 'time': True, 'end_time': True}]
         [None, (200, 300, 'world!'), {'text': True, 'time': True}]
-        [(250, 350, 'world!'), None, {'text': True, 'time': True}]
+        [(250, 350, 'world!!'), (250, 350, 'world!'), {'text': True, 'time': False, 'end_time': False}]
     ]
+
+    The first caption of each row is from the later of the two versions.  See
+    apps.subtitles.diff for how captions are matched up.
     """
     if second_version.version_number > first_version.version_number:
         first_version, second_version = second_version, first_version
 
-    second_captions = [item for item in second_version.get_subtitles()]
-    first_captions = [item for item in first_version.get_subtitles()]
+    rows = diff.version_diff(second_version, first_version).rows()
+    return [[new, old, changed] for old, new, changed in rows]
+
 
-    subtitles = {}
+def _load_dfxp(xml):
+    return load_from(xml, type='dfxp').to_internal()
 
-    first_map = {}
-    second_map = {}
+def can_pack(language_code, subtitles, items):
+    """Return whether the packed format can hold everything in a SubtitleSet.
 
-    for start, end, text, _ in first_captions:
-        id = str(start) + str(end)
-        if not id in subtitles:
-            subtitles[id] = (start, end, text)
-        first_map[id] = (start, end, text)
+    Packing only keeps the timing, text and paragraph breaks of each subtitle.
+    DFXP can also carry head metadata, styling and layout, so we check that
+    the set built back from the items is the same one.
 
-    for start, end, text, _ in second_captions:
-        id = str(start) + str(end)
-        if not id in subtitles:
-            subtitles[id] = (start, end, text)
-        second_map[id] = (start, end, text)
+    """
+    return SubtitleSet.from_list(language_code, items, escape=False) == subtitles
 
-    subs = [item for item in subtitles.items()]
-    subs.sort(key=lambda item: item[1][0])
+def serialize_subtitles(subtitles, format=None, items=None, language_code=None):
+    """Serialize a SubtitleSet for storing in a SubtitleVersion.
 
-    captions = []
+    `format` defaults to SUBTITLE_STORAGE_FORMAT.
 
-    for id, s in subs:
-        try:
-            fcaption = first_map[id]
-        except KeyError:
-            fcaption = None
+    `items` can be passed if you already have the list of subtitle tuples for
+    the set, to avoid walking it again.
 
-        try:
-            scaption = second_map[id]
-        except KeyError:
-            scaption = None
+    If `language_code` is given, sets that the packed format can't represent
+    (see can_pack) are stored as DFXP regardless of `format`.
 
-        if fcaption is None or scaption is None:
-            changed = dict(text=True, time=True)
-        else:
-            changed = {
-                'text': (not fcaption[2] == scaption[2]),
-                'time': (not fcaption[0] == scaption[0]),
-                'end_time': (not fcaption[1]== scaption[1])
-            }
-        data = [fcaption, scaption, changed]
-        captions.append(data)
+    """
+    if (format or SUBTITLE_STORAGE_FORMAT) != 'dfxp':
+        if items is None:
+            items = list(subtitles.subtitle_items())
+        if not language_code or can_pack(language_code, subtitles, items):
+            return packing.pack(items)
+
+    return compress(subtitles.to_xml())
+
+def repack_subtitles(language_code, serialized):
+    """Convert legacy serialized subtitles to the packed format.
+
+    Returns None if they're packed already, or if packing them would lose
+    something (see can_pack).
+
+    """
+    if packing.is_packed(serialized):
+        return None
+
+    subtitles = _load_dfxp(decompress(serialized))
+    items = list(subtitles.subtitle_items())
+    if not can_pack(language_code, subtitles, items):
+        return None
+
+    return packing.pack(items)
 
-    return captions
+def deserialize_subtitle_items(serialized):
+    """Return a list of subtitle tuples from serialized subtitles.
+
+    Works with both storage formats.  Packed subtitles are decoded without
+    building a DOM.
+
+    """
+    if packing.is_packed(serialized):
+        return packing.unpack(serialized)
+    else:
+        return list(_load_dfxp(decompress(serialized)).subtitle_items())
+
+
+def get_time_bounds(items):
+    """Return the (start, end) in ms covered by a list of subtitle tuples.
+
+    The start is the start of the first subtitle and the end is the end of the
+    last one.  If the last subtitle has no end time its start is used instead.
+    Either value may be None if the subtitles aren't synced.
+
+    """
+    if not items:
+        return None, None
+
+    start = items[0][0]
+    end = items[-1][1]
+
+    if end is None or end < 0:
+        end = items[-1][0]
+
+    return start, end
 
 
 # Lineage functions -----------------------------------------------------------
@@ -273,45 +328,11 @@ class SubtitleLanguageManager(models.Manager):
 
     def having_nonempty_tip(self):
         """Return a QS of SLs that have a tip version with 1 or more subtitles."""
-        return self.get_query_set().extra(where=[
-            """
-            EXISTS (
-               SELECT 1 FROM subtitles_subtitleversion AS sv
-                INNER JOIN (
-                   SELECT subtitle_language_id,
-                          MAX(version_number) AS tip_version_number
-                   FROM subtitles_subtitleversion AS subver
-                   GROUP BY subtitle_language_id
-                ) AS tip_versions ON (
-                    sv.subtitle_language_id = tip_versions.subtitle_language_id
-                    AND sv.version_number = tip_versions.tip_version_number
-                )
-                WHERE sv.subtitle_count > 0
-                  AND sv.subtitle_language_id = subtitles_subtitlelanguage.id
-            )
-            """,
-        ])
+        return self.get_query_set().filter(tip_subtitle_count__gt=0)
 
     def not_having_nonempty_tip(self):
         """Return a QS of SLs that do not have a tip version with 1 or more subtitles."""
-        return self.get_query_set().extra(where=[
-            """
-            NOT EXISTS (
-               SELECT 1 FROM subtitles_subtitleversion AS sv
-                INNER JOIN (
-                   SELECT subtitle_language_id,
-                          MAX(version_number) AS tip_version_number
-                   FROM subtitles_subtitleversion AS subver
-                   GROUP BY subtitle_language_id
-                ) AS tip_versions ON (
-                    sv.subtitle_language_id = tip_versions.subtitle_language_id
-                    AND sv.version_number = tip_versions.tip_version_number
-                )
-                WHERE sv.subtitle_count > 0
-                  AND sv.subtitle_language_id = subtitles_subtitlelanguage.id
-            )
-            """,
-        ])
+        return self.get_query_set().filter(tip_subtitle_count=0)
 
 
     def having_public_versions(self):
@@ -406,6 +427,23 @@ class SubtitleLanguage(models.Model):
     pending_signoff_expired_count = models.PositiveIntegerField(default=0,
                                                                 editable=False)
 
+    # Denormalized pointers to the tip and public tip versions, and the
+    # subtitle count of the tip.  These are kept up to date by add_version and
+    # whenever a version's visibility changes (see update_tip_pointers), always
+    # with UPDATE queries so they can't be clobbered by a stale instance.
+    #
+    # Rows from before these existed need to be filled in with the
+    # backfill_tip_pointers command.  Until then get_tip falls back to
+    # querying the versions.
+    tip_version = models.ForeignKey('SubtitleVersion', null=True, blank=True,
+                                    editable=False, on_delete=models.SET_NULL,
+                                    related_name='tip_of_languages+')
+    public_tip_version = models.ForeignKey('SubtitleVersion', null=True,
+                                           blank=True, editable=False,
+                                           on_delete=models.SET_NULL,
+                                           related_name='public_tip_of_languages+')
+    tip_subtitle_count = models.PositiveIntegerField(default=0, editable=False)
+
     followers = models.ManyToManyField(User, blank=True,
             related_name='new_followed_languages', editable=False)
 
@@ -420,58 +458,92 @@ class SubtitleLanguage(models.Model):
 
 
     # Writelocking
+    def _writelock_group(self):
+        return self.video.video_id
+
+    def get_writelock(self):
+        """Return the Lease on this language, or None if it's not writelocked."""
+        return writelocks.holder(self._writelock_group(), self.language_code)
+
     @property
     def is_writelocked(self):
         """Return whether this language is writelocked for subtitling."""
-        if self.writelock_time == None:
-            return False
-        delta = datetime.now() - self.writelock_time
-        seconds = delta.days * 24 * 60 * 60 + delta.seconds
-        return seconds < WRITELOCK_EXPIRATION
+        return self.get_writelock() is not None
 
     def can_writelock(self, key):
         """Return whether a user with the session key can writelock this language."""
-        return self.writelock_session_key == key or not self.is_writelocked
+        lease = self.get_writelock()
+        return lease is None or lease.session == key
 
     def writelock(self, user, key, save=True):
-        """Writelock this language for subtitling and save it.
+        """Writelock this language for subtitling.
 
         This method does NO permission checking.  If you want that you'll need
-        to use can_writelock() yourself before calling this (probably in
-        a transaction).
+        to use can_writelock() yourself before calling this.  The lock itself
+        is taken atomically though, so if someone else got there first this
+        returns False.
 
         `user` is the User who should own the lock.
 
         `key` is their session key which you can get through request.browser_id
 
-        `save` determines whether this method will save the SubtitleLanguage for
-        you.  Pass False if you want to handle saving yourself.
+        `save` determines whether this method will save the audit trail columns
+        of the SubtitleLanguage for you.  Pass False if you want to handle
+        saving yourself.
 
         """
-        if user.is_authenticated():
-            self.writelock_owner = user
-        else:
-            self.writelock_owner = None
+        owner = user.pk if user.is_authenticated() else None
+        acquired = writelocks.acquire(self._writelock_group(),
+                                      self.language_code, key, owner)
+
+        if acquired and WRITELOCK_AUDIT:
+            self.writelock_owner = user if owner else None
+            self.writelock_session_key = key
+            self.writelock_time = datetime.now()
+
+            if save:
+                self.save()
 
-        self.writelock_session_key = key
-        self.writelock_time = datetime.now()
+        return acquired
 
-        if save:
-            self.save()
+    def renew_writelock(self, key):
+        """Extend the writelock held by the session key.
+
+        This is what editors call to keep their lock alive.  It's a single
+        Redis operation and never touches the database.  Returns False if the
+        session doesn't hold the lock (e.g. it expired).
+
+        """
+        return writelocks.renew(self._writelock_group(), self.language_code,
+                                key)
 
     def release_writelock(self, save=True):
-        """Writelock this language for subtitling and save it.
+        """Release the writelock on this language, no matter who holds it.
 
         `save` determines whether this method will save the SubtitleLanguage
         for you.  Pass False if you want to handle saving yourself.
 
         """
-        self.writelock_owner = None
-        self.writelock_session_key = ''
-        self.writelock_time = None
+        writelocks.release(self._writelock_group(), self.language_code)
+
+        if WRITELOCK_AUDIT:
+            self.writelock_owner = None
+            self.writelock_session_key = ''
+            self.writelock_time = None
+
+            if save:
+                self.save()
+
+    def get_writelock_owner(self):
+        """Return the User that holds this language's writelock, if any."""
+        lease = self.get_writelock()
+        if lease is None or lease.owner is None:
+            return None
 
-        if save:
-            self.save()
+        try:
+            return User.objects.get(pk=lease.owner)
+        except User.DoesNotExist:
+            return None
 
     def get_writelock_owner_name(self):
         """Return the human-readable name of the owner of this language's writelock.
@@ -481,10 +553,11 @@ class SubtitleLanguage(models.Model):
         check that first.
 
         """
-        if self.writelock_owner == None:
+        owner = self.get_writelock_owner()
+        if owner == None:
             return "anonymous"
         else:
-            return self.writelock_owner.__unicode__()
+            return owner.__unicode__()
 
 
     def is_rtl(self):
@@ -503,16 +576,63 @@ class SubtitleLanguage(models.Model):
         if creating and not self.created:
             self.created = datetime.now()
 
+        if not creating:
+            self._load_tip_pointers()
+
         return super(SubtitleLanguage, self).save(*args, **kwargs)
 
 
-    def get_tip(self, public=False):
-        """Return the tipmost version of this language (if any).
+    # Tip pointers
+    def _load_tip_pointers(self):
+        """Refresh the denormalized tip fields of this instance from the DB.
 
-        If public is given, returns the tipmost version that is visible to the
-        general public (if any).
+        Versions may have been added through another instance of this language
+        since this one was loaded, and we don't want to write stale pointers
+        back when saving.
+
+        """
+        rows = (SubtitleLanguage.objects.filter(pk=self.pk)
+                                        .values_list('tip_version',
+                                                     'public_tip_version',
+                                                     'tip_subtitle_count'))
+        if not rows:
+            return
+
+        tip_id, public_tip_id, count = rows[0]
+        for field, value in (('tip_version', tip_id),
+                             ('public_tip_version', public_tip_id)):
+            if getattr(self, field + '_id') != value:
+                setattr(self, field + '_id', value)
+                self.__dict__.pop('_%s_cache' % field, None)
+        self.tip_subtitle_count = count
+
+    def _set_tip_pointers(self, tip, public_tip):
+        count = tip.subtitle_count if tip else 0
+
+        SubtitleLanguage.objects.filter(pk=self.pk).update(
+            tip_version=tip, public_tip_version=public_tip,
+            tip_subtitle_count=count)
+
+        self.tip_version = tip
+        self.public_tip_version = public_tip
+        self.tip_subtitle_count = count
+
+    def update_tip_pointers(self):
+        """Recompute the denormalized tip fields from the versions and store them.
+
+        Call this after changing versions behind the ORM's back, e.g. after
+        changing their visibility with a QuerySet.update().
 
         """
+        tip = self._find_tip(public=False)
+        if tip is None or tip.is_public():
+            public_tip = tip
+        else:
+            public_tip = self._find_tip(public=True)
+
+        self._set_tip_pointers(tip, public_tip)
+
+    def _find_tip(self, public):
         if public:
             versions = SubtitleVersion.objects.public()
         else:
@@ -527,6 +647,27 @@ class SubtitleLanguage(models.Model):
         else:
             return None
 
+    def get_tip(self, public=False):
+        """Return the tipmost version of this language (if any).
+
+        If public is given, returns the tipmost version that is visible to the
+        general public (if any).
+
+        This follows the denormalized tip pointers, so it doesn't query at all
+        once they've been loaded (or select_related).  Note that the pointers
+        of an instance are only refreshed when it's saved or has versions added
+        through it.
+
+        """
+        if self.tip_version_id is None:
+            # Either there are no versions or this row hasn't been backfilled.
+            return self._find_tip(public) if self.pk else None
+
+        if public:
+            return self.public_tip_version
+        else:
+            return self.tip_version
+
     def is_complete_and_synced(self, public=False):
         """Return whether this language's subtitles are complete and fully synced."""
 
@@ -609,7 +750,9 @@ class SubtitleLanguage(models.Model):
         kwargs['language_code'] = self.language_code
         kwargs['video'] = self.video
 
-        tip = self.get_tip()
+        # Don't trust the pointers here, this instance might be stale and the
+        # version number has to be right.
+        tip = self._find_tip(public=False)
 
         version_number = ((tip.version_number + 1) if tip else 1)
         kwargs['version_number'] = version_number
@@ -635,6 +778,11 @@ class SubtitleLanguage(models.Model):
         for p in parents:
             sv.parents.add(p)
 
+        # The new version is always the tip.  The public tip only moves if
+        # the new version is public.
+        public_tip = sv if sv.is_public() else self.get_tip(public=True)
+        self._set_tip_pointers(sv, public_tip)
+
         return sv
 
 
@@ -680,6 +828,9 @@ class SubtitleLanguage(models.Model):
         return self.subtitleversion_set.count()
 
     def get_subtitle_count(self):
+        if self.tip_version_id is not None:
+            return self.tip_subtitle_count
+
         tip = self.get_tip()
         if tip:
             return tip.get_subtitle_count()
@@ -839,6 +990,54 @@ class SubtitleVersionManager(models.Manager):
                     .exclude(visibility='private', visibility_override='')
                     .exclude(visibility_override='private'))
 
+    def tips(self, subtitle_languages, public=False):
+        """Return a dict of SubtitleLanguage id -> tip version for many languages.
+
+        `subtitle_languages` can be SubtitleLanguage objects or their ids.
+
+        For objects whose tip pointers are filled in this is a single query by
+        primary key.  Ids (and rows that haven't been backfilled) take two
+        queries no matter how many there are.  Either way, use it instead of
+        calling get_tip in a loop.  The serialized subtitles are deferred,
+        since you usually don't need them when looking at lots of versions at
+        once.
+
+        """
+        pointer_ids, ids = [], []
+        for sl in subtitle_languages:
+            if getattr(sl, 'tip_version_id', None) is not None:
+                pointer_id = (sl.public_tip_version_id if public
+                              else sl.tip_version_id)
+                if pointer_id is not None:
+                    pointer_ids.append(pointer_id)
+            else:
+                ids.append(getattr(sl, 'pk', sl))
+
+        tips = {}
+        if pointer_ids:
+            versions = (self.get_query_set().filter(pk__in=pointer_ids)
+                                            .defer('serialized_subtitles'))
+            tips.update((v.subtitle_language_id, v) for v in versions)
+        if not ids:
+            return tips
+
+        qs = self.public() if public else self.get_query_set()
+
+        numbers = (qs.filter(subtitle_language__in=ids)
+                     .values_list('subtitle_language')
+                     .annotate(tip_number=models.Max('version_number')))
+        numbers = list(numbers)
+        if not numbers:
+            return tips
+
+        q = reduce(operator.or_, [models.Q(subtitle_language=sl_id,
+                                           version_number=number)
+                                  for sl_id, number in numbers])
+        versions = qs.filter(q).defer('serialized_subtitles')
+
+        tips.update((v.subtitle_language_id, v) for v in versions)
+        return tips
+
 class SubtitleVersion(models.Model):
     """SubtitleVersions are the equivalent of a 'changeset' in a VCS.
 
@@ -909,11 +1108,19 @@ class SubtitleVersion(models.Model):
     # easier filtering later.
     subtitle_count = models.PositiveIntegerField(default=0)
 
+    # Denormalized start of the first subtitle and end of the last one (in ms),
+    # so durations can be computed without decoding the subtitles.  Versions
+    # saved before these existed get them from backfill_time_bounds.
+    first_start_time = models.PositiveIntegerField(null=True, blank=True)
+    last_end_time = models.PositiveIntegerField(null=True, blank=True)
+
     created = models.DateTimeField(editable=False)
 
-    # Subtitles are stored in a text blob, serialized as base64'ed zipped XML
-    # (oh the joys of Django).  Use the subtitles property to get and set them.
-    # You shouldn't be touching this field.
+    # Subtitles are stored in a text blob, serialized either in the packed
+    # binary format (see apps.subtitles.packing) or as legacy base64'ed zipped
+    # XML (oh the joys of Django), which is still used for subtitles with
+    # styling or metadata.  Use get_subtitles/set_subtitles to get and
+    # set them.  You shouldn't be touching this field.
     serialized_subtitles = models.TextField()
 
     # Lineage is stored as a blob of JSON to save on DB rows.  You shouldn't
@@ -929,13 +1136,53 @@ class SubtitleVersion(models.Model):
         subtitles.
 
         """
-        # We cache the parsed subs for speed.
+        # We cache the parsed subs for speed.  Saved versions are immutable, so
+        # they can also share the decoded set across instances and processes.
         if self._subtitles == None:
-            self._subtitles = load_from(decompress(self.serialized_subtitles),
-                    type='dfxp').to_internal()
+            if self.pk:
+                self._subtitles = subtitle_set_cache.get(
+                    self.pk, self.serialized_subtitles,
+                    self._decode_subtitles, _load_dfxp)
+            else:
+                self._subtitles = self._decode_subtitles()[0]
 
         return self._subtitles
 
+    def _decode_subtitles(self):
+        """Decode the serialized subtitles.
+
+        Returns a tuple of (SubtitleSet, DFXP string) for the shared cache.
+        Packed subtitles are cheap enough to decode that we don't bother
+        putting them in the shared tier, so the DFXP string is None for those.
+
+        """
+        if packing.is_packed(self.serialized_subtitles):
+            items = self.get_subtitle_items()
+            return SubtitleSet.from_list(self.language_code, items,
+                                         escape=False), None
+        else:
+            xml = decompress(self.serialized_subtitles)
+            return _load_dfxp(xml), xml
+
+    def get_subtitle_items(self):
+        """Return a list of (start, end, text, meta) tuples for this version.
+
+        Unlike get_subtitles this doesn't need to build a SubtitleSet when the
+        subtitles are stored in the packed format, so prefer it when all you
+        need is the timing and text.
+
+        """
+        if self._subtitles != None:
+            return list(self._subtitles.subtitle_items())
+
+        if self._subtitle_items == None:
+            if packing.is_packed(self.serialized_subtitles):
+                self._subtitle_items = packing.unpack(self.serialized_subtitles)
+            else:
+                return list(self.get_subtitles().subtitle_items())
+
+        return self._subtitle_items
+
     def set_subtitles(self, subtitles):
         """Set the SubtitleSet for this version.
 
@@ -963,11 +1210,16 @@ class SubtitleVersion(models.Model):
                 raise TypeError("Cannot create SubtitleSet from type %s"
                                 % str(type(subtitles)))
 
+        items = list(subtitles.subtitle_items())
+
         self.subtitle_count = len(subtitles)
-        self.serialized_subtitles = compress(subtitles.to_xml())
+        self.serialized_subtitles = serialize_subtitles(
+            subtitles, items=items, language_code=self.language_code)
+        self.first_start_time, self.last_end_time = get_time_bounds(items)
 
         # We cache the parsed subs for speed.
         self._subtitles = subtitles
+        self._subtitle_items = None
 
 
     def get_lineage(self):
@@ -1017,6 +1269,7 @@ class SubtitleVersion(models.Model):
         super(SubtitleVersion, self).__init__(*args, **kwargs)
 
         self._subtitles = None
+        self._subtitle_items = None
         if has_subtitles:
             self.set_subtitles(subtitles)
 
@@ -1024,6 +1277,8 @@ class SubtitleVersion(models.Model):
         if lineage != None:
             self.lineage = lineage
 
+        self._original_visibility = (self.visibility, self.visibility_override)
+
     def __unicode__(self):
         return u'SubtitleVersion %s / %s / %s v%s' % (
             (self.id or '(unsaved)'), self.video.video_id,
@@ -1055,7 +1310,15 @@ class SubtitleVersion(models.Model):
             "Version visibility must be either 'public' or 'private'!"
 
         Action.create_caption_handler(self, self.created)
-        return super(SubtitleVersion, self).save(*args, **kwargs)
+        result = super(SubtitleVersion, self).save(*args, **kwargs)
+
+        # Changing the visibility can change which version is the public tip.
+        visibility = (self.visibility, self.visibility_override)
+        if not creating and visibility != self._original_visibility:
+            self.subtitle_language.update_tip_pointers()
+        self._original_visibility = visibility
+
+        return result
 
 
     def get_ancestors(self):
@@ -1075,23 +1338,27 @@ class SubtitleVersion(models.Model):
         return set(mapcat(_ancestors, self.parents.all()))
 
     def get_subtitle_count(self):
-        return len([s for s in self.get_subtitles().subtitle_items()])
+        return len(self.get_subtitle_items())
 
-    def get_changes(self):
-        """Return (time_change, text_change).
+    def get_time_bounds(self):
+        """Return (start of the first subtitle, end of the last one) in ms.
 
-        Beware.
+        This only reads the denormalized fields, so it never decodes the
+        subtitles.  Both are None for versions saved before the fields existed
+        until backfill_time_bounds has been run.
 
-        This was ported over from the old data model as a hack.  There are
-        probably lots of cases where it doesn't work right.
+        """
+        return self.first_start_time, self.last_end_time
 
-        What we *really* need to do is sit down and come up with a scheme for
-        diffing subtitle versions meaningfully.  Until then, we have this
-        monstrosity.  Godspeed.
+    def get_changes(self):
+        """Return (time_change, text_change).
 
-        """
-        # TODO: Time only changes aren't quite right.
+        These are the fractions of this version's subtitles that were retimed
+        and whose text changed since the previous version, where added and
+        removed subtitles count as both.  See apps.subtitles.diff for how
+        subtitles are matched up.
 
+        """
         if hasattr(self, '_time_change') and hasattr(self, '_text_change'):
             return (self._time_change, self._text_change)
 
@@ -1100,61 +1367,7 @@ class SubtitleVersion(models.Model):
         if not parent:
             return (1.0, 1.0)
 
-        subtitles = [s for s in self.get_subtitles().subtitle_items()]
-        last_subtitles = [s for s in parent.get_subtitles().subtitle_items()]
-
-        if not subtitles or not last_subtitles:
-            if subtitles or last_subtitles:
-                # If one version is empty but the other isn't: 100%.
-                return (1.0, 1.0)
-            else:
-                # If both versions are empty: 100%.
-                return (0.0, 0.0)
-
-        sub_dict = dict([("-".join(map(str, s[0:2])), s[2])
-                                for s in subtitles])
-        last_sub_dict = dict([("-".join(map(str, s[0:2])), s[2])
-                                for s in last_subtitles])
-
-        sub_dict_reverse = dict((v, k) for k, v in sub_dict.iteritems())
-        last_sub_dict_reverse = dict((v, k)
-                                    for k, v in last_sub_dict.iteritems())
-
-        text_count_changed = 0
-        time_count_changed = 0
-
-        # Same timing, different text
-        for sub_timing in sub_dict:
-            if sub_timing in last_sub_dict:
-                if not last_sub_dict[sub_timing] == sub_dict[sub_timing]:
-                    text_count_changed += 1
-
-        # Same text, different timing
-        for sub_text in sub_dict_reverse:
-            try:
-                last = last_sub_dict_reverse[sub_text]
-                current = sub_dict_reverse[sub_text]
-            except KeyError:
-                continue
-
-            if not last == current:
-                time_count_changed += 1
-
-        # How many of the timings from the old version aren't in the new one
-        for sub_timing in last_sub_dict:
-            if sub_timing not in sub_dict.keys():
-                text_count_changed += 1
-                time_count_changed += 1
-
-        # How many of the timings from the new version aren't in the old one
-        for sub_timing in sub_dict:
-            if sub_timing not in last_sub_dict.keys():
-                text_count_changed += 1
-                time_count_changed += 1
-
-        subs_length = len(subtitles)
-        time_change = min(time_count_changed / 1. / subs_length, 1)
-        text_change = min(text_count_changed / 1. / subs_length, 1)
+        time_change, text_change = diff.version_diff(parent, self).changes()
 
         self._text_change = text_change
         self._time_change = time_change
@@ -1415,3 +1628,32 @@ class Collaborator(models.Model):
         return result
 
 
+# Counters for the gauge tasks.  The captioned count changes when a video gets
+# its first language or loses its last one.
+def _only_language(language):
+    return not (SubtitleLanguage.objects.filter(video=language.video_id)
+                                        .exclude(pk=language.pk).exists())
+
+def _captioned_on_save(language, created):
+    if not (created and _only_language(language)):
+        return 0
+    _captioned.release(language.video_id)
+    return 1
+
+def _captioned_on_delete(language):
+    # Deleting a video, or several of its languages at once, deletes all the
+    # rows before sending any post_delete, so every one of them looks like
+    # the last.  Only the first counts.
+    if not _only_language(language):
+        return 0
+    return -int(_captioned.claim(language.video_id))
+
+rowcounts.register('videos.SubtitleLanguage',
+                   SubtitleLanguage.objects.count).track(SubtitleLanguage)
+rowcounts.register('videos.SubtitleVersion',
+                   SubtitleVersion.objects.count).track(SubtitleVersion)
+_captioned = rowcounts.register(
+    'videos.Video-captioned',
+    lambda: Video.objects.exclude(newsubtitlelanguage_set=None).count()
+).track(SubtitleLanguage, on_save=_captioned_on_save,
+        on_delete=_captioned_on_delete)
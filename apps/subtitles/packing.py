@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program.  If not, see http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Compact binary storage format for subtitles.
+
+Historically SubtitleVersions stored their subtitles as base64'ed zlib'ed DFXP.
+Reading those means decompressing the blob and then parsing the whole XML
+document, even if all you want is the list of start/end times and text.
+
+This module implements a small versioned binary encoding instead.  The layout
+(all integers little-endian) is:
+
+    header:  MAGIC (4 bytes) | format version (uint8) | flags (uint8)
+    body:    count (uint32)
+             count x start time in ms (int32, -1 for unsynced)
+             count x end time in ms (int32, -1 for unsynced)
+             count x paragraph flags (uint8)
+             count x text length in bytes (uint32)
+             text table (the UTF-8 text of every subtitle, concatenated)
+
+If FLAG_ZLIB is set the body is zlib compressed.  The whole thing is then
+base64'ed with a PREFIX in front so it can live in the same TextField as the
+legacy blobs.  The prefix contains a character that is not in the base64
+alphabet, so legacy blobs can never be mistaken for packed ones.
+
+Unpacking never builds a DOM -- you get a plain list of subtitle tuples.
+
+Only the timing, text and paragraph breaks are kept.  Subtitles whose DFXP has
+head metadata, styling or layout are stored as DFXP instead (see
+apps.subtitles.models.can_pack).
+
+"""
+
+import base64
+import struct
+import zlib
+
+
+PREFIX = 'pk:'
+MAGIC = 'ASUB'
+FORMAT_VERSION = 1
+
+FLAG_ZLIB = 0x01
+PARAGRAPH_NEW = 0x01
+
+_HEADER = struct.Struct('<4sBB')
+_COUNT = struct.Struct('<I')
+
+
+class PackingError(Exception):
+    pass
+
+
+def is_packed(serialized):
+    """Return whether the given serialized subtitles use the binary format."""
+    return bool(serialized) and serialized.startswith(PREFIX)
+
+
+def _time_to_int(t):
+    return -1 if t is None else int(t)
+
+def _int_to_time(i):
+    return None if i < 0 else i
+
+
+def pack_items(items, compress=True):
+    """Pack an iterable of subtitle tuples into a bytestring.
+
+    Each item should be (start, end, text) or (start, end, text, meta) where
+    meta is a dict that may contain a 'new_paragraph' key, which is what
+    SubtitleSet.subtitle_items() yields.
+
+    """
+    starts, ends, flags, lengths, texts = [], [], [], [], []
+
+    for item in items:
+        start, end, text = item[0], item[1], item[2]
+        meta = item[3] if len(item) > 3 and item[3] else {}
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        elif text is None:
+            text = ''
+
+        starts.append(_time_to_int(start))
+        ends.append(_time_to_int(end))
+        flags.append(PARAGRAPH_NEW if meta.get('new_paragraph') else 0)
+        lengths.append(len(text))
+        texts.append(text)
+
+    n = len(texts)
+    body = ''.join([
+        _COUNT.pack(n),
+        struct.pack('<%di' % n, *starts),
+        struct.pack('<%di' % n, *ends),
+        struct.pack('<%dB' % n, *flags),
+        struct.pack('<%dI' % n, *lengths),
+        ''.join(texts),
+    ])
+
+    header_flags = 0
+    if compress:
+        body = zlib.compress(body)
+        header_flags |= FLAG_ZLIB
+
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, header_flags) + body
+
+def unpack_items(data):
+    """Unpack a bytestring created by pack_items into a list of tuples.
+
+    Each tuple is (start, end, text, meta), matching SubtitleSet.subtitle_items().
+
+    """
+    try:
+        magic, version, header_flags = _HEADER.unpack_from(data)
+    except struct.error:
+        raise PackingError('Packed subtitles are truncated.')
+
+    if magic != MAGIC:
+        raise PackingError('Not a packed subtitle blob.')
+    if version != FORMAT_VERSION:
+        raise PackingError('Unknown packed subtitle format version %d.' % version)
+
+    body = data[_HEADER.size:]
+    if header_flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+
+    n, = _COUNT.unpack_from(body)
+    offset = _COUNT.size
+
+    starts = struct.unpack_from('<%di' % n, body, offset)
+    offset += 4 * n
+    ends = struct.unpack_from('<%di' % n, body, offset)
+    offset += 4 * n
+    flags = struct.unpack_from('<%dB' % n, body, offset)
+    offset += n
+    lengths = struct.unpack_from('<%dI' % n, body, offset)
+    offset += 4 * n
+
+    items = []
+    for i in xrange(n):
+        text = body[offset:offset + lengths[i]].decode('utf-8')
+        offset += lengths[i]
+        items.append((_int_to_time(starts[i]), _int_to_time(ends[i]), text,
+                      {'new_paragraph': bool(flags[i] & PARAGRAPH_NEW)}))
+
+    return items
+
+
+def pack(items, compress=True):
+    """Pack subtitle tuples into a string that Django can store in a TextField."""
+    return PREFIX + base64.b64encode(pack_items(items, compress))
+
+def unpack(serialized):
+    """Unpack a string created by pack into a list of subtitle tuples."""
+    if not is_packed(serialized):
+        raise PackingError('Not a packed subtitle blob.')
+
+    return unpack_items(base64.b64decode(serialized[len(PREFIX):]))
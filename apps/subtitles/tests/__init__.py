@@ -1,4 +1,7 @@
+from apps.subtitles.tests.cache import *
 from apps.subtitles.tests.collaborators import *
 from apps.subtitles.tests.compat import *
+from apps.subtitles.tests.diff import *
 from apps.subtitles.tests.models import *
+from apps.subtitles.tests.packing import *
 from apps.subtitles.tests.pipeline import *
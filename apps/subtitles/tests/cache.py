@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Tests for the shared cache of decoded SubtitleSets."""
+
+from django.test import TestCase
+
+from babelsubs.storage import SubtitleSet
+
+from apps.subtitles.cache import LRUCache, subtitle_set_cache
+from apps.subtitles.tests.utils import make_video, make_sl, refresh
+
+
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+
+        # Touching 'a' makes 'b' the least recently used.
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_disabled(self):
+        lru = LRUCache(0)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), None)
+
+
+class TestSubtitleSetCache(TestCase):
+    def setUp(self):
+        self.video = make_video()
+        self.sl_en = make_sl(self.video, 'en')
+        subtitle_set_cache.clear()
+
+    def test_shared_between_instances(self):
+        subs = [(100, 200, "a"), (300, 400, "b")]
+        sv = self.sl_en.add_version(subtitles=subs)
+
+        first = refresh(sv).get_subtitles()
+        self.assertEqual(subtitle_set_cache.stats()['hits'], 0)
+
+        second = refresh(sv).get_subtitles()
+        self.assertEqual(subtitle_set_cache.stats()['hits'], 1)
+
+        self.assertTrue(first is second)
+        self.assertEqual(second, SubtitleSet.from_list('en', subs))
+
+    def test_rewritten_rows_are_not_stale(self):
+        sv = self.sl_en.add_version(subtitles=[(100, 200, "a")])
+        refresh(sv).get_subtitles()
+
+        sv.set_subtitles([(100, 200, "changed")])
+        sv.save()
+
+        self.assertEqual(refresh(sv).get_subtitles(),
+                         SubtitleSet.from_list('en', [(100, 200, "changed")]))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Tests for diffing subtitle versions."""
+
+from django.test import TestCase
+
+from apps.subtitles import diff
+from apps.subtitles.models import get_caption_diff_data
+from apps.subtitles.tests.utils import make_video, make_sl, refresh
+
+
+def _lines(count, shift=0):
+    return [(i * 1000 + shift, i * 1000 + 900 + shift, 'Line %d' % i)
+            for i in xrange(count)]
+
+
+class TestAlign(TestCase):
+    def test_identical(self):
+        subs = _lines(5)
+        self.assertEqual(diff.align(subs, subs), [(i, i) for i in xrange(5)])
+        self.assertEqual(diff.SubtitleDiff(subs, subs).changes(), (0.0, 0.0))
+
+    def test_inserted_line_shifts_the_rest(self):
+        # Inserting a line at the top and pushing everything else back should
+        # only count as one new line plus retimings, not a rewrite.
+        old = _lines(4)
+        new = [(0, 500, 'Intro')] + _lines(4, shift=1000)
+
+        self.assertEqual(diff.align(old, new),
+                         [(None, 0), (0, 1), (1, 2), (2, 3), (3, 4)])
+        self.assertEqual(diff.SubtitleDiff(old, new).changes(), (1.0, 0.2))
+
+    def test_text_change_matched_by_timing(self):
+        old = _lines(3)
+        new = list(old)
+        new[1] = (1000, 1900, 'Something else')
+
+        rows = diff.SubtitleDiff(old, new).rows()
+        self.assertEqual(rows[1], (old[1], new[1], {
+            'text': True, 'time': False, 'end_time': False,
+        }))
+        self.assertEqual(diff.SubtitleDiff(old, new).changes(), (0.0, 1 / 3.))
+
+    def test_removed_and_repeated_lines(self):
+        old = [(0, 100, 'Music'), (200, 300, 'a'), (400, 500, 'Music'),
+               (600, 700, 'b')]
+        new = [(0, 100, 'Music'), (400, 500, 'Music'), (600, 700, 'b')]
+
+        self.assertEqual(diff.align(old, new),
+                         [(0, 0), (1, None), (2, 1), (3, 2)])
+
+    def test_unsynced(self):
+        old = [(None, None, 'a'), (None, None, 'b')]
+        new = [(None, None, 'a'), (None, None, 'c'), (None, None, 'b')]
+
+        self.assertEqual(diff.align(old, new), [(0, 0), (None, 1), (1, 2)])
+
+    def test_empty(self):
+        self.assertEqual(diff.SubtitleDiff([], []).changes(), (0.0, 0.0))
+        self.assertEqual(diff.SubtitleDiff([], _lines(1)).changes(),
+                         (1.0, 1.0))
+        self.assertEqual(diff.SubtitleDiff(_lines(1), []).changes(),
+                         (1.0, 1.0))
+
+
+class TestVersionDiff(TestCase):
+    def setUp(self):
+        self.video = make_video()
+        self.sl_en = make_sl(self.video, 'en')
+        diff.clear_cache()
+
+    def test_memoized_per_pair(self):
+        v1 = self.sl_en.add_version(subtitles=_lines(3))
+        v2 = self.sl_en.add_version(subtitles=_lines(4))
+
+        first = diff.version_diff(refresh(v1), refresh(v2))
+        self.assertTrue(diff.version_diff(refresh(v1), refresh(v2)) is first)
+        self.assertFalse(diff.version_diff(refresh(v2), refresh(v1)) is first)
+
+    def test_caption_diff_data(self):
+        v1 = self.sl_en.add_version(subtitles=_lines(2))
+        v2 = self.sl_en.add_version(subtitles=_lines(2) + [(5000, 6000, 'New')])
+
+        # The later version comes first, whatever the order of the arguments.
+        for args in ((v1, v2), (v2, v1)):
+            captions = get_caption_diff_data(*args)
+            self.assertEqual(captions[0][0], captions[0][1])
+            self.assertEqual(captions[2], [(5000, 6000, 'New'), None,
+                                           {'text': True, 'time': True}])
@@ -20,6 +20,7 @@
 """Basic sanity tests to make sure the subtitle models aren't completely broken."""
 
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.db import IntegrityError
 from django.test import TestCase
 
@@ -162,6 +163,48 @@ class TestSubtitleLanguage(TestCase):
         _assert_tip(False, 6)
         _assert_tip(True, 6)
 
+    def test_tip_pointers(self):
+        sl = make_sl(self.video, 'en')
+
+        def _assert_pointers(tip, public_tip, count):
+            fresh = refresh(sl)
+            self.assertEqual(fresh.tip_version_id, tip.pk if tip else None)
+            self.assertEqual(fresh.public_tip_version_id,
+                             public_tip.pk if public_tip else None)
+            self.assertEqual(fresh.tip_subtitle_count, count)
+
+        _assert_pointers(None, None, 0)
+
+        v1 = sl.add_version(subtitles=[(100, 200, "foo")])
+        _assert_pointers(v1, v1, 1)
+
+        v2 = sl.add_version(visibility='private',
+                            subtitles=[(100, 200, "foo"), (200, 300, "bar")])
+        _assert_pointers(v2, v1, 2)
+        self.assertEqual(
+            [l.pk for l in SubtitleLanguage.objects.having_nonempty_tip()],
+            [sl.pk])
+
+        # Changing the visibility of a version moves the public tip.
+        v2.visibility_override = 'public'
+        v2.save()
+        _assert_pointers(v2, v2, 2)
+
+        v2.visibility_override = 'private'
+        v2.save()
+        _assert_pointers(v2, v1, 2)
+
+        # Saving an instance loaded before a version was added doesn't clobber
+        # the pointers.
+        stale = refresh(sl)
+        v3 = sl.add_version(subtitles=[])
+        stale.subtitles_complete = True
+        stale.save()
+        _assert_pointers(v3, v3, 0)
+        self.assertEqual(stale.get_tip().pk, v3.pk)
+        self.assertEqual(
+            list(SubtitleLanguage.objects.having_nonempty_tip()), [])
+
     def test_get_version(self):
         # Actually tests the .version() method whose name we should update at
         # some point to fit with the rest.
@@ -410,15 +453,13 @@ class TestSubtitleVersion(TestCase):
         sv2 = add_subtitles(self.video, 'en', subtitles_2)
         sv3 = add_subtitles(self.video, 'en', subtitles_3)
         sv4 = add_subtitles(self.video, 'en', subtitles_4)
-        assert sv4 # Shut up, Pyflakes.
 
         self.assertEquals((1.0, 1.0), sv1.get_changes())
         # 50% of text and 50% of timing is new
         self.assertEquals((0.5, 0.5), sv2.get_changes())
         self.assertEquals((0.0, 0.5), sv3.get_changes())
-
-        # TODO: This will break.
-        # self.assertEquals((0.5, 0.0), sv4.get_changes())
+        # Only the timing of the second line changed
+        self.assertEquals((0.5, 0.0), sv4.get_changes())
 
     def test_subtitle_count(self):
         s0 = (100, 200, "a")
@@ -446,6 +487,34 @@ class TestSubtitleVersion(TestCase):
         sv4 = refresh(sv4)
         self.assertEqual(200, sv4.subtitle_count)
 
+    def test_time_bounds(self):
+        sv1 = self.sl_en.add_version(subtitles=[])
+        sv2 = self.sl_en.add_version(subtitles=[(100, 200, "a"),
+                                                (300, 400, "b")])
+        sv3 = self.sl_en.add_version(subtitles=[(100, 200, "a"),
+                                                (300, None, "b")])
+
+        self.assertEqual((None, None), refresh(sv1).get_time_bounds())
+        self.assertEqual((100, 400), refresh(sv2).get_time_bounds())
+        self.assertEqual((100, 300), refresh(sv3).get_time_bounds())
+
+        # Versions saved before the fields existed get them from the backfill.
+        SubtitleVersion.objects.filter(pk=sv2.pk).update(
+            first_start_time=None, last_end_time=None)
+        self.assertEqual((None, None), refresh(sv2).get_time_bounds())
+        call_command('backfill_time_bounds', verbosity=0)
+        self.assertEqual((100, 400), refresh(sv2).get_time_bounds())
+        self.assertEqual((None, None), refresh(sv1).get_time_bounds())
+
+    def test_tips(self):
+        self.sl_en.add_version()
+        en_tip = self.sl_en.add_version()
+        is_tip = self.sl_is.add_version()
+
+        tips = SubtitleVersion.objects.tips([self.sl_en, self.sl_is.pk])
+        self.assertEqual({self.sl_en.pk: en_tip, self.sl_is.pk: is_tip}, tips)
+        self.assertEqual({}, SubtitleVersion.objects.tips([]))
+
     def test_sibling_set(self):
         def _assert_siblings(sv, *vns):
             siblings = sv.sibling_set.order_by('version_number')
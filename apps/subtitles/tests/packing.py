@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Tests for the packed binary subtitle storage format."""
+
+from django.test import TestCase
+
+from babelsubs.storage import SubtitleSet
+
+from apps.subtitles import packing
+from apps.subtitles.models import (
+    SubtitleVersion, repack_subtitles, serialize_subtitles
+)
+from apps.subtitles.tests.utils import make_video, make_sl, refresh
+from utils.compress import compress, decompress
+
+
+STYLED_DFXP = """<tt xmlns="http://www.w3.org/ns/ttml" xmlns:tts="http://www.w3.org/ns/ttml#styling" xml:lang="en">
+  <head>
+    <styling>
+      <style xml:id="highlight" tts:color="yellow"/>
+    </styling>
+  </head>
+  <body>
+    <div>
+      <p begin="00:00:00.100" end="00:00:00.200" style="highlight">a</p>
+    </div>
+  </body>
+</tt>"""
+
+
+class TestPacking(TestCase):
+    def test_round_trip(self):
+        items = [(100, 200, u'a', {'new_paragraph': True}),
+                 (None, None, u'ünsynced', {'new_paragraph': False}),
+                 (300, 400, u'<span>b</span>', {'new_paragraph': False})]
+
+        for compress_body in (True, False):
+            packed = packing.pack(items, compress_body)
+            self.assertTrue(packing.is_packed(packed))
+            self.assertEqual(packing.unpack(packed), items)
+
+    def test_three_tuples(self):
+        packed = packing.pack([(100, 200, 'a')])
+        self.assertEqual(packing.unpack(packed),
+                         [(100, 200, u'a', {'new_paragraph': False})])
+
+    def test_empty(self):
+        self.assertEqual(packing.unpack(packing.pack([])), [])
+
+    def test_legacy_blobs_are_not_packed(self):
+        self.assertFalse(packing.is_packed(compress('<tt></tt>')))
+        self.assertFalse(packing.is_packed(''))
+        self.assertRaises(packing.PackingError, packing.unpack, compress('x'))
+
+
+class TestStorageFormats(TestCase):
+    def setUp(self):
+        self.video = make_video()
+        self.sl_en = make_sl(self.video, 'en')
+        self.subs = [(100, 200, "a"), (300, 400, "b")]
+
+    def test_new_versions_are_packed(self):
+        sv = self.sl_en.add_version(subtitles=self.subs)
+        self.assertTrue(packing.is_packed(refresh(sv).serialized_subtitles))
+
+    def test_legacy_versions_are_readable(self):
+        sv = self.sl_en.add_version(subtitles=self.subs)
+
+        legacy = serialize_subtitles(SubtitleSet.from_list('en', self.subs),
+                                     'dfxp')
+        SubtitleVersion.objects.filter(pk=sv.pk).update(
+            serialized_subtitles=legacy)
+
+        sv = refresh(sv)
+        self.assertFalse(packing.is_packed(sv.serialized_subtitles))
+        self.assertEqual(sv.get_subtitles(),
+                         SubtitleSet.from_list('en', self.subs))
+        self.assertEqual([i[:3] for i in sv.get_subtitle_items()], self.subs)
+
+    def test_styled_versions_stay_dfxp(self):
+        sv = refresh(self.sl_en.add_version(subtitles=STYLED_DFXP))
+
+        self.assertFalse(packing.is_packed(sv.serialized_subtitles))
+        self.assertTrue('tts:color="yellow"' in
+                        decompress(sv.serialized_subtitles))
+        self.assertEqual(repack_subtitles('en', sv.serialized_subtitles), None)
+
+    def test_repack_subtitles(self):
+        legacy = serialize_subtitles(SubtitleSet.from_list('en', self.subs),
+                                     'dfxp')
+        packed = repack_subtitles('en', legacy)
+
+        self.assertTrue(packing.is_packed(packed))
+        self.assertEqual([i[:3] for i in packing.unpack(packed)], self.subs)
+        self.assertEqual(repack_subtitles('en', packed), None)
+
+    def test_subtitle_items_without_dom(self):
+        sv = refresh(self.sl_en.add_version(subtitles=self.subs))
+
+        self.assertEqual([i[:3] for i in sv.get_subtitle_items()], self.subs)
+        self.assertEqual(sv.get_subtitle_count(), 2)
+
+        # Reading the items of a packed version shouldn't build a SubtitleSet.
+        self.assertEqual(sv._subtitles, None)
@@ -64,3 +64,57 @@ def get_preferred_langs(team):
         cache.set(cache_key, value, TIMEOUT)
     return value
 
+
+
+def _team_workflows_id(team_id):
+    return u"%s-workflows" % team_id
+
+
+def invalidate_workflows(team_id):
+    cache.delete(_team_workflows_id(team_id))
+
+
+def get_workflow_rows(team):
+    cache_key = _team_workflows_id(team.pk)
+    value = cache.get(cache_key)
+    if value is None:
+        from teams.models import WorkflowResolver
+        value = WorkflowResolver._load_rows(team)
+        cache.set(cache_key, value, TIMEOUT)
+    return value
+
+
+def _team_task_languages_id(team_id):
+    return u"%s-task-languages" % team_id
+
+
+def invalidate_task_languages(team_id):
+    cache.delete(_team_task_languages_id(team_id))
+
+
+def get_task_languages(team):
+    """Return the set of language codes of the team's undeleted tasks.
+
+    Task.save() clears the cached set when a task brings in a language that
+    isn't in it, and when a task is deleted, since another task may still use
+    the language.  Hard deletes clear it from a post_delete handler, but code
+    that soft-deletes tasks with update() has to call invalidate_task_languages
+    itself.  Editing the set in place would lose languages when two
+    tasks are saved at once.
+
+    """
+    cache_key = _team_task_languages_id(team.pk)
+    value = cache.get(cache_key)
+    if value is None:
+        from teams.models import Task
+        value = set(Task.objects.filter(team=team, deleted=False)
+                                .values_list('language', flat=True)
+                                .distinct())
+        cache.set(cache_key, value, TIMEOUT)
+    return value
+
+def add_task_language(team_id, language):
+    cache_key = _team_task_languages_id(team_id)
+    value = cache.get(cache_key)
+    if value is not None and language not in value:
+        cache.delete(cache_key)
@@ -0,0 +1,77 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+import datetime
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+
+from teams.models import BillingReport, Team
+
+
+class Command(BaseCommand):
+    args = '<team slug>'
+    help = ('Generate the rows of a billing report for a team and print how '
+            'long it took and how many queries it used. Nothing is saved.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', action='store', dest='days', type='int',
+                    default=30, help='Length of the report period in days.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+                    type='int', default=None,
+                    help='Number of team videos to load at once.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: benchmark_billing_report <team slug>')
+
+        try:
+            team = Team.objects.get(slug=args[0])
+        except Team.DoesNotExist:
+            raise CommandError('No team with slug %s' % args[0])
+
+        end_date = datetime.date.today()
+        start_date = end_date - datetime.timedelta(days=options['days'])
+        report = BillingReport(team=team, start_date=start_date,
+                               end_date=end_date)
+        if options['chunk_size']:
+            report.CHUNK_SIZE = options['chunk_size']
+
+        # Queries are only logged when DEBUG is on.
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+
+        try:
+            start = time.time()
+            rows = 0
+            for row in report._iter_rows('http://example.com'):
+                rows += 1
+            elapsed = time.time() - start
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+            reset_queries()
+
+        print 'Rows: %s' % rows
+        print 'Queries: %s (%.2f per row)' % (
+            queries, float(queries) / rows if rows else 0)
+        print 'Time: %.2fs' % elapsed
@@ -0,0 +1,116 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Compare OFFSET and keyset pagination of a team's task list."""
+
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.videos.templatetags.paginator import (
+    _encode_cursor, keyset_paginate, paginate)
+from teams.cache import get_task_languages, invalidate_task_languages
+from teams.models import Task, Team
+
+LANGUAGES = ['en', 'fr', 'de', 'es', 'pt-br', 'ja', 'ar', '']
+
+
+class Command(BaseCommand):
+    args = '<team slug>'
+    help = ('Time listing the open tasks of a team with OFFSET pagination '
+            'and with keyset pagination, at increasing depths.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--populate', action='store', dest='populate', type='int',
+                    default=0,
+                    help='Create this many tasks for the team first '
+                         '(e.g. 500000).'),
+        make_option('--per-page', action='store', dest='per_page',
+                    type='int', default=20, help='Tasks on each page.'),
+    )
+
+    def _populate(self, team, count):
+        team_video_ids = list(team.teamvideo_set.values_list('id', flat=True))
+        if not team_video_ids:
+            raise CommandError('The team needs at least one video.')
+
+        rng = random.Random(0)
+        for start in xrange(0, count, 1000):
+            Task.objects.bulk_create([
+                Task(team=team, team_video_id=rng.choice(team_video_ids),
+                     type=rng.choice(Task.TYPE_IDS.values()),
+                     language=rng.choice(LANGUAGES),
+                     priority=rng.choice([0, 0, 0, 1, 2]))
+                for i in xrange(start, min(start + 1000, count))])
+        invalidate_task_languages(team.pk)
+
+    def _time(self, fn, repeat=3):
+        start = time.time()
+        for i in xrange(repeat):
+            fn()
+        return (time.time() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: benchmark_task_list <team slug>')
+        try:
+            team = Team.objects.get(slug=args[0])
+        except Team.DoesNotExist:
+            raise CommandError('No team with slug %s' % args[0])
+
+        if options['populate']:
+            self._populate(team, options['populate'])
+
+        per_page = options['per_page']
+        tasks = Task.objects.filter(team=team, deleted=False, completed=None,
+                                    assignee=None)
+        order = ['-priority', '-created', '-id']
+        total = tasks.count()
+        print 'Open, unassigned tasks: %d' % total
+        print
+        print '%10s %14s %14s' % ('page', 'offset (ms)', 'keyset (ms)')
+
+        pages = (total + per_page - 1) // per_page
+        depths = sorted(set([n for n in (1, 10, 100, 1000, 10000)
+                             if n < pages] + [max(pages, 1)]))
+        for number in depths:
+            # The cursor a visitor would have after following Next this far.
+            after = None
+            if number > 1:
+                last = tasks.order_by(*order).values_list(
+                    'priority', 'created', 'id')[(number - 1) * per_page - 1]
+                after = _encode_cursor(last)
+
+            offset_ms = self._time(lambda: list(paginate(
+                tasks.order_by(*order), per_page, number)[0]
+                .values_list('id', flat=True)))
+            keyset_ms = self._time(lambda: keyset_paginate(
+                tasks.only('id', 'priority', 'created'), order, per_page,
+                after=after))
+            print '%10d %14.1f %14.1f' % (number, offset_ms, keyset_ms)
+
+        print
+        distinct_ms = self._time(lambda: list(
+            Task.objects.filter(team=team, deleted=False)
+                        .values_list('language', flat=True).distinct()))
+        get_task_languages(team)
+        cached_ms = self._time(lambda: get_task_languages(team))
+        print 'Task languages: DISTINCT %.1f ms, cached %.1f ms' % (
+            distinct_ms, cached_ms)
@@ -39,21 +39,22 @@ from auth.models import CustomUser as User
 from auth.providers import get_authentication_provider
 from messages import tasks as notifier
 from apps.subtitles import shims
-from teams.moderation_const import WAITING_MODERATION, UNMODERATED, APPROVED
+from teams.moderation_const import WAITING_MODERATION
 from teams.permissions_const import (
     TEAM_PERMISSIONS, PROJECT_PERMISSIONS, ROLE_OWNER, ROLE_ADMIN, ROLE_MANAGER,
     ROLE_CONTRIBUTOR
 )
 from videos.tasks import upload_subtitles_to_original_service
-from teams.tasks import update_one_team_video
-from utils import DEFAULT_PROTOCOL
+from teams.tasks import update_one_team_video, queue_team_video_index_update
+from utils import DEFAULT_PROTOCOL, rowcounts
 from utils.amazon import S3EnabledImageField, S3EnabledFileField
 from utils.panslugify import pan_slugify
 from utils.searching import get_terms
 from videos.models import Video, SubtitleVersion
 from subtitles.models import (
     SubtitleVersion as NewSubtitleVersion,
-    SubtitleLanguage as NewSubtitleLanguage
+    SubtitleLanguage as NewSubtitleLanguage,
+    deserialize_subtitle_items, get_time_bounds
 )
 from subtitles import pipeline
 
@@ -273,7 +274,7 @@ class Team(models.Model):
         TODO: Refactor this behaviour into something less confusing.
 
         """
-        return Workflow.get_for_target(self.id, 'team')
+        return Workflow.get_resolver(self).for_team()
 
     @property
     def auth_provider(self):
@@ -759,8 +760,10 @@ class TeamVideo(models.Model):
         from teams.signals import api_teamvideo_new
         from teams.signals import video_moved_from_team_to_team
         from videos import metadata_manager
+        from teams.cache import invalidate_task_languages
         # For now, we'll just delete any tasks associated with the moved video.
         self.task_set.update(deleted=True)
+        invalidate_task_languages(self.team_id)
 
         # We move the video by just switching the team, instead of deleting and
         # recreating it.
@@ -779,6 +782,8 @@ class TeamVideo(models.Model):
         video = self.video
 
         video.newsubtitleversion_set.all().update(visibility='public')
+        for language in video.newsubtitlelanguage_set.all():
+            language.update_tip_pointers()
         video.is_public = new_team.is_visible
         video.moderated_by = new_team if new_team.moderates_videos() else None
         video.save()
@@ -830,7 +835,7 @@ def _create_translation_tasks(team_video, subtitle_version):
         # wasted tasks
         task.save(update_team_video_index=False)
 
-    update_one_team_video.delay(team_video.pk)
+    queue_team_video_index_update(team_video.pk)
 
 def autocreate_tasks(team_video):
     workflow = Workflow.get_for_team_video(team_video)
@@ -861,7 +866,7 @@ def team_video_save(sender, instance, created, **kwargs):
     TODO: Rename this to something more specific.
 
     """
-    update_one_team_video.delay(instance.id)
+    queue_team_video_index_update(instance.id)
 
 def team_video_delete(sender, instance, **kwargs):
     """Perform necessary actions for when a TeamVideo is deleted.
@@ -1308,6 +1313,16 @@ class Workflow(models.Model):
         else:
             return Team.objects.get(pk=id)
 
+    @classmethod
+    def get_resolver(cls, team):
+        """Return a WorkflowResolver for the given team.
+
+        The resolver is built from a cached copy of the team's workflows, so
+        this usually won't hit the DB at all.
+
+        """
+        return WorkflowResolver.load(team)
+
     @classmethod
     def get_for_target(cls, id, type, workflows=None):
         '''Return the most specific Workflow for the given target.
@@ -1318,48 +1333,39 @@ class Workflow(models.Model):
         the TeamVideo's team.  This will let you look it up yourself once and
         use it in many of these calls to avoid hitting the DB each time.
 
-        If workflows is not given it will be looked up with one DB query.
+        If workflows is not given the team's WorkflowResolver is used, which
+        only needs the target object itself from the DB.
 
         '''
-        if not workflows:
-            team = Workflow._get_target_team(id, type)
-            workflows = list(Workflow.objects.filter(team=team.id)
-                                             .select_related('project', 'team',
-                                                             'team_video'))
-        else:
-            team = workflows[0].team
+        if workflows:
+            resolver = WorkflowResolver(workflows[0].team, workflows)
 
-        default_workflow = Workflow(team=team)
+            if type == 'team_video':
+                workflow = resolver.by_team_video.get(id)
+                if workflow:
+                    return workflow
 
-        if not workflows:
-            return default_workflow
-
-        if type == 'team_video':
-            try:
-                return [w for w in workflows
-                        if w.team_video and w.team_video.id == id][0]
-            except IndexError:
                 # If there's no video-specific workflow for this video, there
                 # might be a workflow for its project, so we'll start looking
                 # for that instead.
-                team_video = TeamVideo.objects.get(pk=id)
-                id, type = team_video.project_id, 'project'
+                id = TeamVideo.objects.get(pk=id).project_id
+                type = 'project'
 
-        if type == 'project':
-            try:
-                return [w for w in workflows
-                        if w.project and w.project.workflow_enabled
-                        and w.project.id == id and not w.team_video][0]
-            except IndexError:
-                # If there's no project-specific workflow for this project,
-                # there might be one for its team, so we'll fall through.
-                pass
+            if type == 'project':
+                return resolver.for_project(id)
 
-        if not team.workflow_enabled:
-            return default_workflow
+            return resolver.for_team()
 
-        return [w for w in workflows
-                if (not w.project) and (not w.team_video)][0]
+        if type == 'team_video':
+            team_video = TeamVideo.objects.select_related('team').get(pk=id)
+            return WorkflowResolver.load(team_video.team).for_team_video(
+                team_video)
+        elif type == 'project':
+            project = Project.objects.select_related('team').get(pk=id)
+            return WorkflowResolver.load(project.team).for_project(project.pk)
+        else:
+            team = Team.objects.get(pk=id)
+            return WorkflowResolver.load(team).for_team()
 
 
     @classmethod
@@ -1370,7 +1376,7 @@ class Workflow(models.Model):
         for the TeamVideo's team.  This will let you look it up yourself once
         and use it in many of these calls to avoid hitting the DB each time.
 
-        If workflows is not given it will be looked up with one DB query.
+        If workflows is not given the team's WorkflowResolver is used.
 
         NOTE: This function caches the workflow for performance reasons.  If the
         workflow changes within the space of a single request that
@@ -1378,8 +1384,12 @@ class Workflow(models.Model):
 
         '''
         if not hasattr(team_video, '_cached_workflow'):
-            team_video._cached_workflow = Workflow.get_for_target(
-                    team_video.id, 'team_video', workflows)
+            if workflows:
+                resolver = WorkflowResolver(workflows[0].team, workflows)
+            else:
+                resolver = WorkflowResolver.load(team_video.team)
+
+            team_video._cached_workflow = resolver.for_team_video(team_video)
         return team_video._cached_workflow
 
     @classmethod
@@ -1390,17 +1400,24 @@ class Workflow(models.Model):
         for the Project's team.  This will let you look it up yourself once
         and use it in many of these calls to avoid hitting the DB each time.
 
-        If workflows is not given it will be looked up with one DB query.
+        If workflows is not given the team's WorkflowResolver is used.
 
         '''
-        return Workflow.get_for_target(project.id, 'project', workflows)
+        if workflows:
+            resolver = WorkflowResolver(workflows[0].team, workflows)
+        else:
+            resolver = WorkflowResolver.load(project.team)
+
+        return resolver.for_project(project.pk)
 
     @classmethod
     def add_to_team_videos(cls, team_videos):
         '''Add the appropriate Workflow objects to each TeamVideo as .workflow.
 
-        This will only perform one DB query, and it will add the most specific
-        workflow possible to each TeamVideo.
+        The team videos must all belong to the same team.  This won't perform
+        any DB queries beyond loading the team's WorkflowResolver (which is
+        usually cached), and it will add the most specific workflow possible
+        to each TeamVideo.
 
         This only exists for performance reasons.
 
@@ -1408,10 +1425,8 @@ class Workflow(models.Model):
         if not team_videos:
             return []
 
-        workflows = list(Workflow.objects.filter(team=team_videos[0].team))
-
-        for tv in team_videos:
-            tv.workflow = Workflow.get_for_team_video(tv, workflows)
+        resolver = WorkflowResolver.load(team_videos[0].team)
+        resolver.add_to_team_videos(team_videos)
 
 
     def get_specific_target(self):
@@ -1442,6 +1457,139 @@ class Workflow(models.Model):
         return self.approve_enabled or self.review_enabled
 
 
+class WorkflowResolver(object):
+    """Finds the effective Workflow for any target in a single team.
+
+    Workflows can be attached to a team, a project or a single team video, and
+    the most specific one wins.  Project workflows only count if the project
+    has workflows enabled, and the team workflow only counts if the team has
+    them enabled.  Otherwise a default (unsaved) Workflow is used.
+
+    The resolver indexes a team's workflows by target once, so every lookup
+    after that is a couple of dict lookups and never touches the DB.  Use
+    load() to get one built from the cached copy of the team's workflows.
+
+    """
+    FIELDS = ('id', 'team', 'project', 'team_video', 'autocreate_subtitle',
+              'autocreate_translate', 'review_allowed', 'approve_allowed',
+              'created', 'modified')
+
+    def __init__(self, team, workflows, enabled_projects=None):
+        """Index the given workflows, which should all belong to `team`.
+
+        `enabled_projects` is the set of ids of projects that have workflows
+        enabled.  If it's not given it's taken from each workflow's project.
+
+        """
+        self.team = team
+
+        self.team_workflow = None
+        self.by_project = {}
+        self.by_team_video = {}
+
+        for w in workflows:
+            if w.team_video_id:
+                self.by_team_video[w.team_video_id] = w
+            elif w.project_id:
+                if enabled_projects is None:
+                    enabled = w.project.workflow_enabled
+                else:
+                    enabled = w.project_id in enabled_projects
+
+                if enabled:
+                    self.by_project[w.project_id] = w
+            else:
+                self.team_workflow = w
+
+    @classmethod
+    def _load_rows(cls, team):
+        """Return the data the resolver needs for the team, in a cacheable form."""
+        return list(Workflow.objects.filter(team=team.pk)
+                                    .values(*(cls.FIELDS +
+                                              ('project__workflow_enabled',))))
+
+    @classmethod
+    def load(cls, team):
+        """Return a WorkflowResolver for the team using the cached workflows.
+
+        The cache is cleared whenever a Workflow or Project of the team is
+        saved or deleted.
+
+        """
+        from teams.cache import get_workflow_rows
+
+        workflows = []
+        enabled_projects = set()
+
+        for row in get_workflow_rows(team):
+            workflow = Workflow(id=row['id'],
+                                team_id=row['team'],
+                                project_id=row['project'],
+                                team_video_id=row['team_video'],
+                                autocreate_subtitle=row['autocreate_subtitle'],
+                                autocreate_translate=row['autocreate_translate'],
+                                review_allowed=row['review_allowed'],
+                                approve_allowed=row['approve_allowed'],
+                                created=row['created'],
+                                modified=row['modified'])
+
+            # Share the team object rather than loading it again later.
+            workflow.team = team
+            workflows.append(workflow)
+
+            if row['project__workflow_enabled']:
+                enabled_projects.add(row['project'])
+
+        return cls(team, workflows, enabled_projects)
+
+    def for_team(self):
+        """Return the team-wide Workflow."""
+        if self.team.workflow_enabled and self.team_workflow:
+            return self.team_workflow
+
+        return Workflow(team=self.team)
+
+    def for_project(self, project_id):
+        """Return the most specific Workflow for the given project id."""
+        return self.by_project.get(project_id) or self.for_team()
+
+    def for_team_video(self, team_video):
+        """Return the most specific Workflow for the given TeamVideo."""
+        return (self.by_team_video.get(team_video.pk)
+                or self.for_project(team_video.project_id))
+
+    def add_to_team_videos(self, team_videos):
+        """Resolve the workflows for many team videos at once.
+
+        Each TeamVideo gets the workflow as .workflow, and it's also cached
+        the same way Workflow.get_for_team_video caches it.
+
+        """
+        for tv in team_videos:
+            tv.workflow = tv._cached_workflow = self.for_team_video(tv)
+
+    def enabled_workflows(self):
+        """Return the workflows that are in effect anywhere in the team.
+
+        That's the team workflow and those of projects with workflows enabled.
+        Video-specific workflows aren't included.
+
+        """
+        workflows = [self.for_team()]
+        workflows.extend(self.by_project.values())
+        return workflows
+
+
+def invalidate_workflow_cache(sender, instance, **kwargs):
+    from teams.cache import invalidate_workflows
+    invalidate_workflows(instance.team_id)
+
+post_save.connect(invalidate_workflow_cache, Workflow, dispatch_uid='teams.workflow.invalidate_workflow_cache')
+post_delete.connect(invalidate_workflow_cache, Workflow, dispatch_uid='teams.workflow.invalidate_workflow_cache')
+post_save.connect(invalidate_workflow_cache, Project, dispatch_uid='teams.project.invalidate_workflow_cache')
+post_delete.connect(invalidate_workflow_cache, Project, dispatch_uid='teams.project.invalidate_workflow_cache')
+
+
 # Tasks
 class TaskManager(models.Manager):
     def not_deleted(self):
@@ -2074,12 +2222,26 @@ class Task(models.Model):
 
         result = super(Task, self).save(*args, **kwargs)
 
+        from teams.cache import add_task_language, invalidate_task_languages
+        if self.deleted:
+            invalidate_task_languages(self.team_id)
+        else:
+            add_task_language(self.team_id, self.language)
+
         if update_team_video_index:
-            update_one_team_video.delay(self.team_video.pk)
+            queue_team_video_index_update(self.team_video_id)
 
         return result
 
 
+def invalidate_task_languages_cache(sender, instance, **kwargs):
+    # Tasks are hard-deleted along with their team video.
+    from teams.cache import invalidate_task_languages
+    invalidate_task_languages(instance.team_id)
+
+post_delete.connect(invalidate_task_languages_cache, Task, dispatch_uid='teams.task.invalidate_task_languages_cache')
+
+
 # Settings
 class SettingManager(models.Manager):
     use_for_related_fields = True
@@ -2402,6 +2564,14 @@ class BillingReport(models.Model):
             upload_to='teams/billing/')
     processed = models.DateTimeField(blank=True, null=True)
 
+    # How many team videos to load at once when generating the report.  Each
+    # chunk takes a constant number of queries, and only one chunk is held in
+    # memory at a time.
+    CHUNK_SIZE = getattr(settings, 'BILLING_REPORT_CHUNK_SIZE', 200)
+
+    HEADER = ['Video title', 'Video URL', 'Video language',
+              'Billable minutes', 'Version created', 'Language number']
+
     def __unicode__(self):
         return "%s (%s - %s)" % (self.team.slug,
                 self.start_date.strftime('%Y-%m-%d'),
@@ -2415,35 +2585,41 @@ class BillingReport(models.Model):
         almost_midnight = datetime.time(23, 59, 59)
         return datetime.datetime.combine(self.end_date, almost_midnight)
 
-    def _should_bill(self, language, version, start, end):
+    def _should_bill(self, language, version, start, end,
+                     approve_enabled=False):
         if not version:
             return False
 
-        if version.moderation_status not in [APPROVED, UNMODERATED]:
+        # Versions that are still waiting for review (or were rejected) are
+        # private.
+        if not version.is_public():
             return False
 
-        # 97% is done according to our contracts
-        if version.moderation_status == UNMODERATED:
-            if not language.is_complete and language.percent_done < 97:
-                return False
+        # Without a review step we only bill for languages the subtitler has
+        # marked as complete.
+        if not approve_enabled and not language.subtitles_complete:
+            return False
 
-        if (version.datetime_started <= start or
-                version.datetime_started >= end):
+        if version.created <= start or version.created >= end:
             return False
 
         return True
 
-    def _get_lang_data(self, languages, start_date):
-        workflow = self.team.get_workflow()
+    def _get_lang_data(self, languages, start_date, tips=None):
+        """Return ([(language, tip), ...], old_version_counter).
+
+        `tips` can be a dict of language id -> tip version (as returned by
+        NewSubtitleVersion.objects.tips) to avoid a query per language.
 
+        """
         # TODO:
-        # These do the same for now.  If a workflow is enabled, we should get
-        # the first approved version.  Not sure how to do that yet.
-        if workflow.approve_enabled:
+        # If a workflow is enabled, we should get the first approved version.
+        # Not sure how to do that yet, so we use the tip either way.
+        if tips is None:
             lang_data = [(language, language.get_tip()) for
                                                 language in languages]
         else:
-            lang_data = [(language, language.get_tip()) for
+            lang_data = [(language, tips.get(language.pk)) for
                                                 language in languages]
 
         old_version_counter = 1
@@ -2459,73 +2635,140 @@ class BillingReport(models.Model):
 
         return result, old_version_counter
 
-    def _get_row_data(self, host, header=None):
-        if not header:
-            header = []
+    def _video_title(self, video, languages, public_tips):
+        """Return the same thing as video.title_display_unabridged().
+
+        Uses the already-fetched languages and tips, so it doesn't need any
+        queries for the usual case.
+
+        """
+        for language in languages:
+            if language.language_code == video.primary_audio_language_code:
+                tip = public_tips.get(language.pk)
+                if tip and tip.title and tip.title.strip():
+                    return tip.title
+                break
+
+        if video.title and video.title.strip():
+            return video.title
+
+        return video.title_display_unabridged()
+
+    def _iter_rows(self, host):
+        """Yield the rows of the report (without the header).
 
-        rows = [header]
+        Team videos are processed CHUNK_SIZE at a time, with a fixed number of
+        queries per chunk, rather than several queries per video and language.
 
+        """
         start_date = self.start_datetime()
         end_date = self.end_datetime()
+        approve_enabled = self.team.get_workflow().approve_enabled
+
+        tv_ids = list(TeamVideo.objects.filter(team=self.team)
+                                       .order_by('video__title')
+                                       .values_list('pk', flat=True))
 
-        tvs = TeamVideo.objects.filter(team=self.team).order_by('video__title')
+        for i in xrange(0, len(tv_ids), self.CHUNK_SIZE):
+            chunk_ids = tv_ids[i:i + self.CHUNK_SIZE]
 
-        for tv in tvs:
-            languages = tv.video.newsubtitlelanguage_set.all()
+            tvs = TeamVideo.objects.filter(pk__in=chunk_ids).select_related(
+                'video')
+            tvs = dict((tv.pk, tv) for tv in tvs)
 
-            lang_data, old_version_counter = self._get_lang_data(languages,
-                    start_date)
+            languages = {}
+            for language in NewSubtitleLanguage.objects.filter(
+                    video__in=[tv.video_id for tv in tvs.values()]):
+                languages.setdefault(language.video_id, []).append(language)
 
-            for language, v in lang_data:
+            lang_ids = [l.pk for ls in languages.values() for l in ls]
+            tips = NewSubtitleVersion.objects.tips(lang_ids)
+            public_tips = NewSubtitleVersion.objects.tips(lang_ids, public=True)
 
-                if not self._should_bill(language, v, start_date, end_date):
+            billed = []
+            for tv_id in chunk_ids:
+                tv = tvs.get(tv_id)
+                if tv is None:
+                    # Deleted while we were generating the report.
                     continue
 
-                subs = v.ordered_subtitles()
+                video_languages = languages.get(tv.video_id, [])
 
-                if len(subs) == 0:
-                    continue
+                lang_data, old_version_counter = self._get_lang_data(
+                    video_languages, start_date, tips)
 
-                start = subs[0].start_time
-                end = subs[-1].end_time
+                for language, v in lang_data:
+                    if not self._should_bill(language, v, start_date, end_date,
+                                             approve_enabled):
+                        continue
 
-                # The -1 value for the end_time isn't allowed anymore but some
-                # legacy data will still have it.
-                if end == -1:
-                    end = subs[-1].start_time
+                    if not v.subtitle_count:
+                        continue
 
-                if not end:
-                    end = subs[-1].start_time
+                    billed.append((tv, video_languages, language, v,
+                                   old_version_counter))
+                    old_version_counter += 1
 
-                rows.append([
-                    tv.video.title_display_unabridged().encode('utf-8'),
+            bounds = self._time_bounds([v for _, _, _, v, _ in billed])
+
+            titles = {}
+            for tv, video_languages, language, v, counter in billed:
+                if tv.pk not in titles:
+                    titles[tv.pk] = self._video_title(tv.video, video_languages,
+                                                      public_tips)
+                start, end = bounds[v.pk]
+
+                yield [
+                    titles[tv.pk].encode('utf-8'),
                     host + tv.video.get_absolute_url(),
-                    language.language,
-                    round((float(end) - float(start)) / (60 * 1000), 2),
-                    v.datetime_started.strftime("%Y-%m-%d %H:%M:%S"),
-                    old_version_counter,
-                ])
+                    language.language_code,
+                    round((float(end or 0) - float(start or 0))
+                          / (60 * 1000), 2),
+                    v.created.strftime("%Y-%m-%d %H:%M:%S"),
+                    counter,
+                ]
 
-                old_version_counter += 1
+    def _time_bounds(self, versions):
+        """Return a dict of version pk -> (start, end) in ms.
 
-        return rows
+        Versions saved before the bounds were denormalized have them NULL.
+        Their subtitles are fetched in one query and decoded instead, so they
+        aren't billed as 0 minutes.
+
+        """
+        bounds = {}
+        missing = []
+        for v in versions:
+            start, end = v.get_time_bounds()
+            if start is None and end is None:
+                missing.append(v.pk)
+            bounds[v.pk] = (start, end)
+
+        if missing:
+            rows = (NewSubtitleVersion.objects.filter(pk__in=missing)
+                                              .values_list('pk',
+                                                           'serialized_subtitles'))
+            for pk, serialized in rows:
+                bounds[pk] = get_time_bounds(
+                    deserialize_subtitle_items(serialized))
+
+        return bounds
 
     def process(self):
         domain = Site.objects.get_current().domain
         protocol = getattr(settings, 'DEFAULT_PROTOCOL')
         host = '%s://%s' % (protocol, domain)
 
-        header = ['Video title', 'Video URL', 'Video language',
-                'Billable minutes', 'Version created', 'Language number']
-
-        rows = self._get_row_data(host, header)
-
         fn = '/tmp/bill-%s-%s-%s-%s.csv' % (self.team.slug, self.start_str,
                 self.end_str, self.pk)
 
+        # Write rows as we generate them, so big teams don't have to fit the
+        # whole report in memory.
         with open(fn, 'w') as f:
             writer = csv.writer(f)
-            writer.writerows(rows)
+            writer.writerow(self.HEADER)
+            for row in self._iter_rows(host):
+                writer.writerow(row)
 
         self.csv_file = File(open(fn, 'r'))
         self.processed = datetime.datetime.utcnow()
@@ -2556,3 +2799,7 @@ class Partner(models.Model):
     def is_admin(self, user):
         return user in self.admins.all()
 
+
+rowcounts.register('teams.Task', Task.objects.count).track(Task)
+rowcounts.register('teams.Team', Team.objects.count).track(Team)
+rowcounts.register('teams.TeamMember', TeamMember.objects.count).track(TeamMember)
@@ -58,18 +58,7 @@ def get_member(user, team):
     if not user.is_authenticated():
         return None
 
-    if hasattr(user, '_cached_teammember') and user._cached_teammember.get(team.pk):
-        return user._cached_teammember[team.pk]
-    else:
-        if not hasattr(user, '_cached_teammember'):
-            user._cached_teammember = {}
-
-        try:
-            user._cached_teammember[team.pk] = team.members.get(user=user)
-        except TeamMember.DoesNotExist:
-            user._cached_teammember[team.pk] = None
-
-        return user._cached_teammember[team.pk]
+    return get_permission_context(user, team).member
 
 def get_role(member):
     """Return the member's general role in the team.
@@ -88,29 +77,208 @@ def get_role_for_target(user, team, project=None, lang=None):
     `lang` should be a string (the language code).
 
     """
-    member = get_member(user, team)
-    role = get_role(member)
-    narrowings = get_narrowings(member)
+    return get_permission_context(user, team).role_for(project, lang)
+
+
+# Permission contexts
+class PermissionContext(object):
+    """Everything needed to answer permission checks for one user in one team.
+
+    The user's membership, narrowings, the team's workflows and language
+    preferences are each loaded (at most) once and then reused by every can_*
+    check for that user and team.  Without this, pages that check permissions
+    for every task or video in a list (like the tasks page) end up running the
+    same handful of queries for every row.
+
+    Don't create these directly -- use get_permission_context(), which caches
+    them on the user object (so in practice they live for one request).  If
+    you change someone's membership and then check their permissions with the
+    same user object, call clear_permission_context() in between.
+
+    """
+    def __init__(self, user, team):
+        self.user = user
+        self.team = team
+
+        self._review_versions = {}
+
+    # Membership
+    @property
+    def member(self):
+        if not hasattr(self, '_member'):
+            if not self.user.is_authenticated():
+                self._member = None
+            else:
+                try:
+                    self._member = self.team.members.get(user=self.user)
+                except TeamMember.DoesNotExist:
+                    self._member = None
+
+        return self._member
+
+    @property
+    def role(self):
+        return get_role(self.member)
+
+    @property
+    def narrowings(self):
+        if not hasattr(self, '_narrowings'):
+            self._narrowings = get_narrowings(self.member)
+
+            self._project_narrowings = set(n.project_id for n in
+                                           self._narrowings if n.project_id)
+            self._language_narrowings = set(n.language for n in
+                                            self._narrowings if n.language)
+
+        return self._narrowings
+
+    def role_for(self, project=None, lang=None):
+        """Return the role the user effectively has for the given target.
+
+        `lang` should be a string (the language code).
+
+        """
+        role = self.role
+
+        # If the user has no narrowings, just return their overall role.
+        if not self.narrowings:
+            return role
+
+        # The default project is the same as "no project".
+        if project and project.is_default_project:
+            project = None
+
+        # Otherwise the narrowings must match the target.
+        if (self._project_narrowings and
+                (not project or project.pk not in self._project_narrowings)):
+            return ROLE_CONTRIBUTOR
+
+        if self._language_narrowings and lang not in self._language_narrowings:
+            return ROLE_CONTRIBUTOR
 
-    # If the user has no narrowings, just return their overall role.
-    if not narrowings:
         return role
 
-    # Otherwise the narrowings must match the target.
-    project_narrowings = [n.project for n in narrowings if n.project]
-    lang_narrowings = [n.language for n in narrowings if n.language]
+    @property
+    def admin_owner_count(self):
+        if not hasattr(self, '_admin_owner_count'):
+            self._admin_owner_count = self.team.members.filter(
+                user__is_active=True, role__in=(ROLE_ADMIN, ROLE_OWNER)
+            ).count()
 
-    # The default project is the same as "no project".
-    if project and project.is_default_project:
-        project = None
+        return self._admin_owner_count
+
+    # Team settings
+    @property
+    def workflow_resolver(self):
+        if not hasattr(self, '_workflow_resolver'):
+            self._workflow_resolver = Workflow.get_resolver(self.team)
+
+        return self._workflow_resolver
+
+    def workflow_for(self, team_video):
+        """Return the most specific Workflow for the given team video.
+
+        Like Workflow.get_for_team_video, this caches the workflow on the team
+        video.
+
+        """
+        if not hasattr(team_video, '_cached_workflow'):
+            team_video._cached_workflow = (
+                self.workflow_resolver.for_team_video(team_video))
+
+        return team_video._cached_workflow
+
+    @property
+    def writable_langs(self):
+        if not hasattr(self, '_writable_langs'):
+            self._writable_langs = self.team.get_writable_langs()
+
+        return self._writable_langs
 
-    if project_narrowings and project not in project_narrowings:
-        return ROLE_CONTRIBUTOR
+    # Subtitles
+    def review_version_for(self, team_video, lang):
+        """Return the tip version of `lang` for the team video, or None."""
 
-    if lang_narrowings and lang not in lang_narrowings:
-        return ROLE_CONTRIBUTOR
+        key = (team_video.video_id, lang)
+        if key not in self._review_versions:
+            self._review_versions[key] = team_video.video.latest_version(
+                language_code=lang, public_only=False)
 
-    return role
+        return self._review_versions[key]
+
+    # Bulk loading
+    def prime_team_videos(self, team_videos):
+        """Resolve the workflows for many team videos at once.
+
+        After this checks on these team videos won't need any workflow
+        queries.
+
+        """
+        self.workflow_resolver.add_to_team_videos(team_videos)
+
+    def prime_tasks(self, tasks):
+        """Load everything needed to check permissions on many tasks at once.
+
+        This resolves the workflows of the tasks' team videos and loads the
+        versions that review checks look at, with a fixed number of queries.
+        The tasks should have their team_video (and its video) selected.
+
+        """
+        from subtitles.models import (
+            SubtitleLanguage as NewSubtitleLanguage,
+            SubtitleVersion as NewSubtitleVersion
+        )
+
+        self.prime_team_videos(task.team_video for task in tasks)
+
+        wanted = set((task.team_video.video_id, task.language)
+                     for task in tasks if task.language)
+        wanted -= set(self._review_versions)
+        if not wanted:
+            return
+
+        languages = NewSubtitleLanguage.objects.filter(
+            video__in=set(video_id for video_id, _ in wanted),
+            language_code__in=set(lang for _, lang in wanted))
+
+        language_ids = {}
+        for sl in languages.order_by('pk'):
+            language_ids.setdefault((sl.video_id, sl.language_code), sl.pk)
+
+        tips = NewSubtitleVersion.objects.tips(language_ids.values())
+
+        for key in wanted:
+            self._review_versions[key] = tips.get(language_ids.get(key))
+
+def get_permission_context(user, team):
+    """Return the (cached) PermissionContext for the given user and team."""
+
+    if not hasattr(user, '_permission_contexts'):
+        user._permission_contexts = {}
+
+    if team.pk not in user._permission_contexts:
+        user._permission_contexts[team.pk] = PermissionContext(user, team)
+
+    return user._permission_contexts[team.pk]
+
+def clear_permission_context(user, team=None):
+    """Forget the cached PermissionContext(s) for the given user.
+
+    If a team is given only its context is cleared.
+
+    """
+    contexts = getattr(user, '_permission_contexts', None)
+    if not contexts:
+        return
+
+    if team is None:
+        contexts.clear()
+    else:
+        contexts.pop(team.pk, None)
+
+def _get_workflow(user, team_video):
+    return get_permission_context(user, team_video.team).workflow_for(
+        team_video)
 
 
 def roles_user_can_assign(team, user, to_user=None):
@@ -157,6 +325,7 @@ def save_role(team, member, role, projects, languages, user=None):
     if can_assign_role(team, user, role, member.user):
         member.role = role
         member.save()
+        clear_permission_context(member.user, team)
 
         set_narrowings(member, projects, languages, user)
         return True
@@ -249,6 +418,9 @@ def set_narrowings(member, project_pks, languages, author=None):
     _add_language_narrowings(member, languages_to_create, author)
     _del_language_narrowings(member, languages_to_delete)
 
+    member._cached_narrowings = None
+    clear_permission_context(member.user, member.team)
+
 
 # Roles
 def add_role(team, cuser, added_by, role, project=None, lang=None):
@@ -262,11 +434,14 @@ def add_role(team, cuser, added_by, role, project=None, lang=None):
     if project or lang:
         add_narrowing_to_member(member, project, lang, added_by)
 
+    clear_permission_context(cuser, team)
+
     return member
 
 def remove_role(team, user, role, project=None, lang=None):
     role = role or ROLE_CONTRIBUTOR
     team.members.filter(user=user, role=role).delete()
+    clear_permission_context(user, team)
 
 
 # Various permissions
@@ -438,7 +613,7 @@ def can_view_tasks_tab(team, user):
     if not user or not user.is_authenticated():
         return False
 
-    return team.members.filter(user=user).exists()
+    return get_member(user, team) is not None
 
 def can_invite(team, user):
     """Return whether the given user can send an invite for the given team."""
@@ -460,7 +635,7 @@ def can_change_video_settings(user, team_video):
     return role in [ROLE_MANAGER, ROLE_ADMIN, ROLE_OWNER]
 
 
-def can_review_own_subtitles(role, team_video):
+def can_review_own_subtitles(role, team_video, context=None):
     '''Return True if a user with the given role can review their own subtitles.
 
     This is a hacky special case.  When the following is true:
@@ -471,15 +646,21 @@ def can_review_own_subtitles(role, team_video):
     Then we let that admin/owner review their own subtitles.  Otherwise no
     one can review their own subs.
 
+    If a PermissionContext for the team is given the admin/owner count is
+    taken from it.
+
     '''
 
     if role == ROLE_OWNER:
         return True
 
     if role == ROLE_ADMIN:
-        admin_owner_count = team_video.team.members.filter(
-            user__is_active=True, role__in=(ROLE_ADMIN, ROLE_OWNER)
-        ).count()
+        if context is not None:
+            admin_owner_count = context.admin_owner_count
+        else:
+            admin_owner_count = team_video.team.members.filter(
+                user__is_active=True, role__in=(ROLE_ADMIN, ROLE_OWNER)
+            ).count()
 
         if admin_owner_count == 1:
             return True
@@ -487,8 +668,9 @@ def can_review_own_subtitles(role, team_video):
     return False
 
 def can_review(team_video, user, lang=None, allow_own=False):
-    workflow = Workflow.get_for_team_video(team_video)
-    role = get_role_for_target(user, team_video.team, team_video.project, lang)
+    context = get_permission_context(user, team_video.team)
+    workflow = context.workflow_for(team_video)
+    role = context.role_for(team_video.project, lang)
 
     if not workflow.review_allowed:
         return False
@@ -509,14 +691,13 @@ def can_review(team_video, user, lang=None, allow_own=False):
         return True
 
     # Users usually cannot review their own subtitles.
-    if not hasattr(team_video, '_cached_version_for_review'):
-        team_video._cached_version_for_review = team_video.video.latest_version(
-            language_code=lang, public_only=False)
+    if not lang:
+        return True
 
-    subtitle_version = team_video._cached_version_for_review
+    subtitle_version = context.review_version_for(team_video, lang)
 
-    if lang and subtitle_version.author_id == user.id:
-        if can_review_own_subtitles(role, team_video):
+    if subtitle_version and subtitle_version.author_id == user.id:
+        if can_review_own_subtitles(role, team_video, context):
             return True
         else:
             return False
@@ -524,8 +705,9 @@ def can_review(team_video, user, lang=None, allow_own=False):
     return True
 
 def can_approve(team_video, user, lang=None):
-    workflow = Workflow.get_for_team_video(team_video)
-    role = get_role_for_target(user, team_video.team, team_video.project, lang)
+    context = get_permission_context(user, team_video.team)
+    workflow = context.workflow_for(team_video)
+    role = context.role_for(team_video.project, lang)
 
     if not workflow.approve_allowed:
         return False
@@ -596,7 +778,7 @@ def can_publish_edits_immediately(team_video, user, lang):
     lang should be a language code string.
 
     """
-    workflow = Workflow.get_for_team_video(team_video)
+    workflow = _get_workflow(user, team_video)
 
     if workflow.approve_allowed:
         return can_approve(team_video, user, lang)
@@ -617,7 +799,7 @@ def can_unpublish_subs(team_video, user, lang):
     lang should be a language code string.
 
     """
-    workflow = Workflow.get_for_team_video(team_video)
+    workflow = _get_workflow(user, team_video)
 
     if workflow.approve_allowed:
         return can_approve(team_video, user, lang)
@@ -727,13 +909,13 @@ def can_delete_task(task, user):
 
     # Allow stray review tasks to be deleted.
     if task.type == Task.TYPE_IDS['Review']:
-        workflow = Workflow.get_for_team_video(task.team_video)
+        workflow = _get_workflow(user, task.team_video)
         if not workflow.review_allowed:
             return can_delete
 
     # Allow stray approve tasks to be deleted.
     if task.type == Task.TYPE_IDS['Approve']:
-        workflow = Workflow.get_for_team_video(task.team_video)
+        workflow = _get_workflow(user, task.team_video)
         if not workflow.approve_allowed:
             return can_delete
 
@@ -817,7 +999,13 @@ def can_create_task_translate(team_video, user=None, workflows=None):
         if not team_video.subtitles_finished():
             return []
 
-    candidate_languages = set(team_video.team.get_writable_langs())
+    if user:
+        writable_langs = get_permission_context(
+            user, team_video.team).writable_langs
+    else:
+        writable_langs = team_video.team.get_writable_langs()
+
+    candidate_languages = set(writable_langs)
 
     existing_translate_tasks = team_video.task_set.all_translate()
     existing_translate_languages = set(t.language for t in existing_translate_tasks)
@@ -86,19 +86,135 @@ class TeamVideoLanguagesIndex(SearchIndex):
     # * Fully translated, if a translation
     num_completed_langs = IntegerField()
 
+    def prefetch(self, team_videos):
+        """Load everything prepare() needs for many TeamVideos at once.
+
+        This takes a fixed number of queries no matter how many team videos
+        are given, instead of several queries for each one.  The team videos
+        should have their video, team and project selected (load() does
+        that for you).
+
+        The data is stored on each TeamVideo as _index_data and used up by the
+        next prepare() call.
+
+        """
+        from apps.subtitles.models import SubtitleVersion
+        from apps.videos.models import VideoUrl
+
+        team_videos = list(team_videos)
+        video_ids = [tv.video_id for tv in team_videos]
+        if not video_ids:
+            return team_videos
+
+        languages = {}
+        for sl in SubtitleLanguage.objects.filter(video__in=video_ids).order_by('pk'):
+            languages.setdefault(sl.video_id, []).append(sl)
+
+        language_ids = [sl.pk for sls in languages.values() for sl in sls]
+        tips = SubtitleVersion.objects.tips(language_ids)
+        public_tips = SubtitleVersion.objects.tips(language_ids, public=True)
+
+        # Only complete languages need their subtitles, to check whether
+        # they're synced.
+        complete_tip_ids = [public_tips[sl.pk].pk
+                            for sls in languages.values() for sl in sls
+                            if sl.subtitles_complete and sl.pk in public_tips]
+        synced = set(v.subtitle_language_id for v in
+                     SubtitleVersion.objects.filter(pk__in=complete_tip_ids)
+                     if v.is_synced())
+
+        # VideoUrls are ordered primary first, so the first one for each video
+        # is the one title_display falls back to.
+        first_urls, primary_urls = {}, {}
+        for vurl in VideoUrl.objects.filter(video__in=video_ids):
+            first_urls.setdefault(vurl.video_id, vurl)
+            if vurl.primary:
+                primary_urls.setdefault(vurl.video_id, vurl)
+
+        task_counts = dict(models.Task.objects.incomplete()
+                                 .filter(team_video__in=team_videos)
+                                 .values_list('team_video')
+                                 .annotate(Count('id')))
+
+        for tv in team_videos:
+            video = tv.video
+            sls = languages.get(video.pk, [])
+
+            for sl in sls:
+                # Avoid a query when building the language URLs.
+                sl.video = video
+
+            original_sl = None
+            for sl in sls:
+                if sl.language_code == video.primary_audio_language_code:
+                    original_sl = sl
+                    break
+            # Prime Video.subtitle_language()'s cache.
+            video._original_subtitle = original_sl
+
+            # Same as video.title_display_unabridged(), without the queries.
+            original_tip = original_sl and public_tips.get(original_sl.pk)
+            if original_tip and original_tip.title and original_tip.title.strip():
+                title = original_tip.title
+            elif video.title and video.title.strip():
+                title = video.title
+            else:
+                first_url = first_urls.get(video.pk)
+                title = video.title_from_url(first_url and first_url.url)
+
+            vurl = primary_urls.get(video.pk)
+
+            tv._index_data = {
+                'original_sl': original_sl,
+                'title': title,
+                'video_url': vurl.effective_url if vurl else None,
+                'completed_sls': [sl for sl in sls if sl.pk in synced],
+                'num_total_langs': len([sl for sl in sls
+                                        if sl.pk in tips
+                                        and tips[sl.pk].subtitle_count > 0]),
+                'task_count': task_counts.get(tv.pk, 0),
+            }
+
+        return team_videos
+
+    def load(self, team_video_ids):
+        """Return the TeamVideos with the given ids, prefetched for indexing."""
+        team_videos = (models.TeamVideo.objects
+                             .filter(pk__in=team_video_ids)
+                             .select_related('video', 'team', 'project')
+                             .prefetch_related('video__subtitlelanguage_set'))
+        return self.prefetch(team_videos)
+
+    def update_many(self, team_video_ids):
+        """Reindex the given team videos with a single request to Solr.
+
+        Ids of team videos that no longer exist are ignored.
+
+        """
+        team_videos = self.load(team_video_ids)
+        if team_videos:
+            self.backend.update(self, team_videos)
+        return len(team_videos)
+
     def prepare(self, obj):
+        # Prefetched data is only used once, so that reindexing the same
+        # object later doesn't pick up stale values.
+        if not hasattr(obj, '_index_data'):
+            self.prefetch([obj])
+        data = obj.__dict__.pop('_index_data')
+
         self.prepared_data = super(TeamVideoLanguagesIndex, self).prepare(obj)
         self.prepared_data['team_id'] = obj.team.id
         self.prepared_data['team_video_pk'] = obj.id
         self.prepared_data['video_pk'] = obj.video.id
         self.prepared_data['video_id'] = obj.video.video_id
         self.prepared_data['video_title'] = obj.video.title.strip()
-        self.prepared_data['video_url'] = obj.video.get_video_url()
+        self.prepared_data['video_url'] = data['video_url']
 
-        original_sl = obj.video.subtitle_language()
+        original_sl = data['original_sl']
 
         if original_sl:
-            self.prepared_data['original_language_display'] = original_sl.get_language_code_display
+            self.prepared_data['original_language_display'] = original_sl.get_language_code_display()
             self.prepared_data['original_language'] = original_sl.language_code
         else:
             self.prepared_data['original_language_display'] = ''
@@ -106,7 +222,7 @@ class TeamVideoLanguagesIndex(SearchIndex):
 
         self.prepared_data['absolute_url'] = obj.get_absolute_url()
         self.prepared_data['thumbnail'] = obj.get_thumbnail()
-        self.prepared_data['title'] = obj.video.title_display_unabridged()
+        self.prepared_data['title'] = data['title']
         self.prepared_data['description'] = obj.description
         self.prepared_data['is_complete'] = obj.video.complete_date is not None
         self.prepared_data['video_complete_date'] = obj.video.complete_date
@@ -115,10 +231,9 @@ class TeamVideoLanguagesIndex(SearchIndex):
         self.prepared_data['project_slug'] = obj.project.slug
         self.prepared_data['team_video_create_date'] = obj.created
 
-        completed_sls = obj.video.completed_subtitle_languages()
-        all_sls = obj.video.newsubtitlelanguage_set.having_nonempty_tip()
+        completed_sls = data['completed_sls']
 
-        self.prepared_data['num_total_langs'] = len(all_sls)
+        self.prepared_data['num_total_langs'] = data['num_total_langs']
         self.prepared_data['num_completed_langs'] = len(completed_sls)
 
         self.prepared_data['video_completed_langs'] = \
@@ -126,12 +241,10 @@ class TeamVideoLanguagesIndex(SearchIndex):
         self.prepared_data['video_completed_lang_urls'] = \
             [sl.get_absolute_url() for sl in completed_sls]
 
-        self.prepared_data['task_count'] = models.Task.objects.incomplete().filter(team_video=obj).count()
-
-        team_video = obj.video.get_team_video()
+        self.prepared_data['task_count'] = data['task_count']
 
-        self.prepared_data['is_public'] =  team_video.team.is_visible 
-        self.prepared_data["owned_by_team_id"] = team_video.team.id if team_video else None
+        self.prepared_data['is_public'] = obj.team.is_visible
+        self.prepared_data["owned_by_team_id"] = obj.team.id
 
         return self.prepared_data
 
@@ -8,31 +8,32 @@ from django.contrib.sites.models import Site
 from django.db.models import F
 from django.utils.translation import ugettext_lazy as _
 from haystack import site
+from redis.exceptions import ConnectionError as RedisConnectionError
 
-from utils import send_templated_email
+from utils import rowcounts, send_templated_email
 from utils.metrics import Gauge, Meter
+from utils.redis_utils import default_connection
 from widget.video_cache import (
-    invalidate_cache as invalidate_video_cache,
-    invalidate_video_moderation,
-    invalidate_video_visibility
+    invalidate_cache_many as invalidate_video_cache_many,
+    invalidate_video_moderation_many,
+    invalidate_video_visibility_many
 )
 
 from utils.metrics import Timer
-from apps.videos.tasks import video_changed_tasks
 
 @task()
 def invalidate_video_caches(team_id):
     """Invalidate all TeamVideo caches for all the given team's videos."""
     from apps.teams.models import Team
     team = Team.objects.get(pk=team_id)
-    for video_id in team.teamvideo_set.values_list('video__video_id', flat=True):
-        invalidate_video_cache(video_id)
+    invalidate_video_cache_many(
+        team.teamvideo_set.values_list('video__video_id', flat=True))
 
 @task()
 def invalidate_video_moderation_caches(team):
     """Invalidate the moderation status caches for all the given team's videos."""
-    for video_id in team.teamvideo_set.values_list('video__video_id', flat=True):
-        invalidate_video_moderation(video_id)
+    invalidate_video_moderation_many(
+        team.teamvideo_set.values_list('video__video_id', flat=True))
 
 @task()
 def update_video_moderation(team):
@@ -44,21 +45,56 @@ def update_video_moderation(team):
 
 @task()
 def invalidate_video_visibility_caches(team):
-    for video_id in team.teamvideo_set.values_list("video__video_id", flat=True):
-        invalidate_video_visibility(video_id)
+    invalidate_video_visibility_many(
+        team.teamvideo_set.values_list("video__video_id", flat=True))
+
+# How many videos each follow-up task of update_video_public_field handles.
+PUBLIC_FIELD_CHUNK_SIZE = getattr(settings, 'TEAM_PUBLIC_FIELD_CHUNK_SIZE', 500)
 
 @task()
 def update_video_public_field(team_id):
+    """Make the team's videos public or private to match the team.
+
+    All the videos are updated with a single UPDATE.  Clearing their caches
+    and reindexing them is split into chunks that run as separate tasks, so
+    big teams don't tie up a single worker.
+
+    """
     from apps.teams.models import Team
+    from apps.videos.models import Video
 
     with Timer("update-video-public-field-time"):
         team = Team.objects.get(pk=team_id)
 
-        for team_video in team.teamvideo_set.all():
-            video = team_video.video
-            video.is_public = team.is_visible
-            video.save()
-            video_changed_tasks(video.id)
+        Video.objects.filter(teamvideo__team=team).update(
+            is_public=team.is_visible)
+
+        rows = list(team.teamvideo_set.values_list(
+            'pk', 'video_id', 'video__video_id'))
+        Meter('teams.update-video-public-field.videos').inc(len(rows))
+
+        for i in xrange(0, len(rows), PUBLIC_FIELD_CHUNK_SIZE):
+            team_video_pks, video_pks, video_ids = zip(
+                *rows[i:i + PUBLIC_FIELD_CHUNK_SIZE])
+            update_video_public_field_chunk.delay(
+                list(team_video_pks), list(video_pks), list(video_ids))
+            Meter('teams.update-video-public-field.chunks-queued').inc()
+
+@task()
+def update_video_public_field_chunk(team_video_pks, video_pks, video_ids):
+    """Do the follow-up work for a chunk of videos whose visibility changed."""
+    from apps.teams.models import TeamVideo
+    from apps.videos.models import Video
+
+    invalidate_video_cache_many(video_ids)
+
+    for model, pks in ((TeamVideo, team_video_pks), (Video, video_pks)):
+        search_index = site.get_index(model)
+        search_index.backend.update(search_index,
+                                    model.objects.filter(pk__in=pks))
+
+    Meter('teams.update-video-public-field.chunks-done').inc()
+    Meter('teams.update-video-public-field.videos-done').inc(len(video_pks))
 
 @periodic_task(run_every=crontab(minute=0, hour=7))
 def expire_tasks():
@@ -120,14 +156,82 @@ def add_videos_notification(*args, **kwargs):
 def update_one_team_video(team_video_id):
     """Update the Solr index for the given team video."""
     from teams.models import TeamVideo
+
+    tv_search_index = site.get_index(TeamVideo)
+    tv_search_index.update_many([team_video_id])
+
+
+# Debounced team video indexing.
+#
+# Saving a team video, or any of its tasks, used to queue a separate Celery
+# task and Solr request every time.  Busy videos get saved many times in a
+# row, so instead we collect the ids in a Redis set and schedule one flush
+# TEAM_VIDEO_INDEX_DEBOUNCE seconds after the first one is queued.  The flush
+# reindexes everything that was queued in the meantime, once, in batches.
+INDEX_DEBOUNCE = getattr(settings, 'TEAM_VIDEO_INDEX_DEBOUNCE', 10)
+INDEX_BATCH_SIZE = getattr(settings, 'TEAM_VIDEO_INDEX_BATCH_SIZE', 100)
+
+INDEX_QUEUE_KEY = 'teams:team-video-index:queue'
+INDEX_FLUSH_KEY = 'teams:team-video-index:flush-scheduled'
+
+def queue_team_video_index_update(*team_video_ids):
+    """Reindex the given team videos in Solr soon.
+
+    Ids queued again before the flush runs are only indexed once.  If Redis
+    is unavailable the team videos are indexed right away instead.
+
+    """
+    if not team_video_ids:
+        return
+
     try:
-        team_video = TeamVideo.objects.get(id=team_video_id)
-    except TeamVideo.DoesNotExist:
+        pipe = default_connection.pipeline(transaction=False)
+        for team_video_id in team_video_ids:
+            pipe.sadd(INDEX_QUEUE_KEY, team_video_id)
+        # The flag expires in case the flush somehow never runs, so that a
+        # later update can schedule a new one.  It's set along with its
+        # expiry in one command, so it can't be left behind without one.
+        pipe.execute_command('SET', INDEX_FLUSH_KEY, 1, 'NX', 'EX',
+                             INDEX_DEBOUNCE * 10)
+        schedule = bool(pipe.execute()[-1])
+    except RedisConnectionError:
+        Meter('teams.team-video-index.redis-unavailable').inc()
+        for team_video_id in team_video_ids:
+            update_one_team_video.delay(team_video_id)
         return
 
+    Meter('teams.team-video-index.queued').inc(len(team_video_ids))
+
+    if schedule:
+        flush_team_video_index_queue.apply_async(countdown=INDEX_DEBOUNCE)
+
+@task()
+def flush_team_video_index_queue():
+    """Reindex all the team videos queued by queue_team_video_index_update."""
+    from teams.models import TeamVideo
+
+    # Read and clear the queue atomically, along with the flag, so that
+    # anything queued after this point schedules a new flush.
+    pipe = default_connection.pipeline()
+    pipe.smembers(INDEX_QUEUE_KEY)
+    pipe.delete(INDEX_QUEUE_KEY)
+    pipe.delete(INDEX_FLUSH_KEY)
+    team_video_ids = sorted(int(pk) for pk in pipe.execute()[0])
+
     tv_search_index = site.get_index(TeamVideo)
-    tv_search_index.backend.update(
-        tv_search_index, [team_video])
+
+    with Timer('teams.team-video-index.flush-time'):
+        for i in xrange(0, len(team_video_ids), INDEX_BATCH_SIZE):
+            try:
+                tv_search_index.update_many(
+                    team_video_ids[i:i + INDEX_BATCH_SIZE])
+            except Exception:
+                # Don't lose the ids we haven't indexed yet.
+                Meter('teams.team-video-index.flush-failed').inc()
+                queue_team_video_index_update(*team_video_ids[i:])
+                raise
+
+    Meter('teams.team-video-index.flushed').inc(len(team_video_ids))
 
 
 @task()
@@ -161,10 +265,10 @@ def api_notify_on_application_activity(team_pk, event_name, application_pk):
 
 @periodic_task(run_every=timedelta(seconds=5))
 def gauge_teams():
-    from teams.models import Task, Team, TeamMember
-    Gauge('teams.Task').report(Task.objects.count())
-    Gauge('teams.Team').report(Team.objects.count())
-    Gauge('teams.TeamMember').report(TeamMember.objects.count())
+    # Importing the models registers their row counters.
+    import teams.models
+    for name in ('teams.Task', 'teams.Team', 'teams.TeamMember'):
+        Gauge(name).report(rowcounts.value(name))
 
 
 @task()
@@ -410,11 +410,9 @@ def can_leave_team(team, user):
 
 @tag(register, [Variable(), Variable()])
 def can_create_any_task_for_teamvideo(context, team_video, user):
-    workflows = context.get('team_workflows')
-
-    if can_create_task_subtitle(team_video, user, workflows):
+    if can_create_task_subtitle(team_video, user):
         result = True
-    elif can_create_task_translate(team_video, user, workflows):
+    elif can_create_task_translate(team_video, user):
         result = True
     else:
         result = False
@@ -426,34 +424,14 @@ def can_create_any_task_for_teamvideo(context, team_video, user):
 
 @register.filter
 def review_enabled(team):
-    w = Workflow.get_for_target(team.id, 'team')
-
-    if w.review_enabled:
-        return True
-
-    for p in team.project_set.all():
-        if p.workflow_enabled:
-            w = Workflow.get_for_project(p)
-            if w.review_enabled:
-                return True
-
-    return False
+    return any(w.review_enabled for w in
+               Workflow.get_resolver(team).enabled_workflows())
 
 
 @register.filter
 def approve_enabled(team):
-    w = Workflow.get_for_target(team.id, 'team')
-
-    if w.approve_enabled:
-        return True
-
-    for p in team.project_set.all():
-        if p.workflow_enabled:
-            w = Workflow.get_for_project(p)
-            if w.approve_enabled:
-                return True
-
-    return False
+    return any(w.approve_enabled for w in
+               Workflow.get_resolver(team).enabled_workflows())
 
 @register.filter
 def can_perform_task(task, user):
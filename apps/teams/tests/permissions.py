@@ -35,7 +35,8 @@ from apps.teams.permissions import (
     can_create_task_translate, can_join_team, can_edit_video, can_approve,
     roles_user_can_invite, can_add_video_somewhere, can_assign_tasks,
     can_create_and_edit_translations, save_role, can_remove_video,
-    can_delete_team, can_delete_video
+    can_delete_team, can_delete_video, get_permission_context,
+    clear_permission_context
 )
 
 
@@ -87,21 +88,14 @@ class BaseTestPermission(TestCase):
 
     @contextmanager
     def role(self, r, project=None):
+        # add_role and remove_role clear the user's permission context.
         add_role(self.team, self.user, self.owner, r, project=project)
 
-        # Handle the caching in permissions.get_role_for_target().
-        if hasattr(self.user, '_cached_teammember'):
-            delattr(self.user, '_cached_teammember')
-
         try:
             yield
         finally:
             remove_role(self.team, self.user, r, project=project)
 
-        # Handle the caching in permissions.get_role_for_target().
-        if hasattr(self.user, '_cached_teammember'):
-            delattr(self.user, '_cached_teammember')
-
 
 class TestRules(BaseTestPermission):
     fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
@@ -930,6 +924,38 @@ class TestRules(BaseTestPermission):
 
     # TODO: Review/approve task tests.
 
+    def test_permission_context(self):
+        user, team_video = self.user, self.nonproject_video
+
+        self.team.workflow_enabled = True
+        self.team.save()
+
+        workflow = Workflow.get_for_team_video(team_video)
+        workflow.approve_allowed = Workflow.APPROVE_IDS["Manager must approve"]
+        workflow.save()
+
+        with self.role(ROLE_MANAGER):
+            context = get_permission_context(user, self.team)
+            self.assertEqual(context.role, ROLE_MANAGER)
+            self.assertTrue(can_approve(team_video, user))
+
+            # Everything the checks need has been loaded now.
+            with self.assertNumQueries(0):
+                self.assertTrue(get_permission_context(user, self.team)
+                                is context)
+                self.assertTrue(can_approve(team_video, user))
+                self.assertTrue(can_assign_tasks(self.team, user))
+                self.assertTrue(can_view_tasks_tab(self.team, user))
+
+        # Changing the role through the permissions API resets the context.
+        self.assertFalse(can_view_tasks_tab(self.team, user))
+
+        TeamMember.objects.create(team=self.team, user=user,
+                                  role=ROLE_ADMIN)
+        self.assertFalse(can_view_tasks_tab(self.team, user))
+        clear_permission_context(user, self.team)
+        self.assertTrue(can_view_tasks_tab(self.team, user))
+
 class TestViews(BaseTestPermission):
     fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
 
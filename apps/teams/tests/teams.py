@@ -3,6 +3,7 @@
 import os, re, json
 from datetime import datetime, timedelta, date
 
+from django.core.cache import cache
 from django.core import mail
 from django.core.urlresolvers import reverse
 from django.conf import settings
@@ -19,13 +20,19 @@ from apps.teams.permissions import add_role
 from apps.teams.tests.teamstestsutils import refresh_obj, reset_solr
 from apps.teams.models import (
     Team, Invite, TeamVideo, Application, TeamMember,
-    TeamLanguagePreference, Project, Partner, TeamNotificationSetting
+    TeamLanguagePreference, Project, Partner, TeamNotificationSetting,
+    Workflow, Task
+)
+from apps.teams.cache import (
+    _team_task_languages_id, get_task_languages, invalidate_task_languages
 )
 from apps.teams.templatetags import teams_tags
+from apps.videos.templatetags.paginator import keyset_paginate
 from apps.videos.search_indexes import VideoIndex
 from apps.videos import metadata_manager
 from apps.videos.models import Video, SubtitleLanguage
 from messages.models import Message
+from widget import video_cache
 from widget.tests import create_two_sub_session, RequestMockup
 
 from subtitles.pipeline import add_subtitles
@@ -170,6 +177,66 @@ class TestTasks(TestCase):
         tv = TeamVideo(team=self.team, video=self.sl.video, added_by=self.team.users.all()[:1].get())
         tv.save()
 
+    def _make_task(self, **kwargs):
+        task = Task(team=self.team, team_video=self.tv,
+                    type=Task.TYPE_IDS['Subtitle'], **kwargs)
+        task.save()
+        return task
+
+    def test_keyset_pagination(self):
+        for i in xrange(7):
+            self._make_task(priority=i % 2)
+
+        tasks = Task.objects.filter(team=self.team, deleted=False)
+        order = ['-priority', '-created', '-id']
+        expected = list(tasks.order_by(*order))
+
+        # Walk forwards page by page, then back again.
+        pages = []
+        page, info = keyset_paginate(tasks, order, 3)
+        self.assertFalse(info['has_previous'])
+        pages.append(page)
+        while info['has_next']:
+            page, info = keyset_paginate(tasks, order, 3,
+                                         after=info['next_cursor'])
+            pages.append(page)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertTrue(all(len(p) == 3 for p in pages[:-1]))
+
+        for previous in reversed(pages[:-1]):
+            page, info = keyset_paginate(tasks, order, 3,
+                                         before=info['previous_cursor'])
+            self.assertEqual(page, previous)
+        self.assertFalse(info['has_previous'])
+
+        # Junk cursors give the first page.
+        page, info = keyset_paginate(tasks, order, 3, after='junk')
+        self.assertEqual(page, pages[0])
+
+    def test_task_languages(self):
+        invalidate_task_languages(self.team.pk)
+        self._make_task(language='en')
+        self.assertTrue('en' in get_task_languages(self.team))
+
+        # Saving a task in a language that's already there keeps the set.
+        self._make_task(language='en')
+        self.assertTrue(cache.get(_team_task_languages_id(self.team.pk))
+                        is not None)
+
+        task = self._make_task(language='fr')
+        self.assertTrue('fr' in get_task_languages(self.team))
+
+        task.deleted = True
+        task.save()
+        self.assertFalse('fr' in get_task_languages(self.team))
+        self.assertTrue('en' in get_task_languages(self.team))
+
+        # Deleting the team video deletes its tasks.
+        self.tv.delete()
+        self.assertEqual(get_task_languages(self.team),
+                         set(Task.objects.filter(team=self.team, deleted=False)
+                                         .values_list('language', flat=True)))
+
 
 class TeamVideoTest(TestCase):
 
@@ -245,6 +312,34 @@ class TeamVideoTest(TestCase):
             self.assertTrue(video.is_public)
             self.assertTrue(self._search_for_video(video))
 
+    def test_update_video_public_field(self):
+        video_ids = list(self.team.teamvideo_set.values_list(
+            'video__video_id', flat=True))
+        self.assertTrue(video_ids)
+
+        def check(is_public):
+            # The videos are updated without Video.save(), so the task has to
+            # clear the caches itself.  test_save_updates_is_visible covers
+            # the search index.
+            for video in Video.objects.filter(video_id__in=video_ids):
+                self.assertEqual(video.is_public, is_public)
+            for video_id in video_ids:
+                self.assertEqual(video_cache.get_visibility_policies(
+                    video_id)['is_public'], is_public)
+                self.assertEqual(video_cache.get_widget_bundle(
+                    video_id)['visibility_policy']['is_public'], is_public)
+
+        # Warm the caches.
+        check(True)
+
+        Team.objects.filter(pk=self.team.pk).update(is_visible=False)
+        tasks.update_video_public_field.delay(self.team.pk)
+        check(False)
+
+        Team.objects.filter(pk=self.team.pk).update(is_visible=True)
+        tasks.update_video_public_field.delay(self.team.pk)
+        check(True)
+
     def test_wrong_project_team_fails(self):
         video = Video.objects.filter(teamvideo__isnull=True)[0]
         project = Project.objects.create(slug="one-project", team=self.team)
@@ -1090,6 +1185,184 @@ class TestLanguagePreference(TestCase):
         self.assertIn("en", cached)
 
 
+class TestWorkflowResolver(TestCase):
+    fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
+
+    def setUp(self):
+        self.team = Team.objects.all()[0]
+        self.team.workflow_enabled = True
+        self.team.save()
+
+        self.project = Project.objects.create(team=self.team, name='Project',
+                                              workflow_enabled=True)
+        self.team_videos = []
+        for i in xrange(3):
+            video, _ = Video.get_or_create_for_url(
+                'http://www.example.com/workflow-%s.mp4' % i)
+            self.team_videos.append(TeamVideo.objects.create(
+                team=self.team, video=video, added_by=User.objects.all()[0]))
+
+        from apps.teams.cache import invalidate_workflows
+        invalidate_workflows(self.team.pk)
+
+    def _resolve(self, team_video):
+        team_video = TeamVideo.objects.select_related('team').get(
+            pk=team_video.pk)
+        return Workflow.get_for_team_video(team_video)
+
+    def test_most_specific_workflow(self):
+        tv_default, tv_project, tv_specific = self.team_videos
+        tv_project.project = self.project
+        tv_project.save()
+
+        team_workflow = Workflow.objects.create(team=self.team)
+        project_workflow = Workflow.objects.create(team=self.team,
+                                                   project=self.project)
+        video_workflow = Workflow.objects.create(team=self.team,
+                                                 team_video=tv_specific)
+
+        self.assertEqual(team_workflow.pk, self._resolve(tv_default).pk)
+        self.assertEqual(project_workflow.pk, self._resolve(tv_project).pk)
+        self.assertEqual(video_workflow.pk, self._resolve(tv_specific).pk)
+
+        # Projects without workflows enabled fall back to the team.
+        self.project.workflow_enabled = False
+        self.project.save()
+        self.assertEqual(team_workflow.pk, self._resolve(tv_project).pk)
+
+        # Teams without workflows enabled get an unsaved default.
+        self.team.workflow_enabled = False
+        self.team.save()
+        self.assertEqual(None, self._resolve(tv_default).pk)
+
+    def test_cache_invalidation(self):
+        tv = self.team_videos[0]
+        self.assertEqual(None, self._resolve(tv).pk)
+
+        workflow = Workflow.objects.create(team=self.team, review_allowed=10)
+        self.assertEqual(workflow.pk, self._resolve(tv).pk)
+        self.assertEqual(10, self._resolve(tv).review_allowed)
+
+        workflow.review_allowed = 20
+        workflow.save()
+        self.assertEqual(20, self._resolve(tv).review_allowed)
+
+        workflow.delete()
+        self.assertEqual(None, self._resolve(tv).pk)
+
+    def test_add_to_team_videos(self):
+        workflow = Workflow.objects.create(team=self.team)
+        team_videos = list(TeamVideo.objects.filter(team=self.team)
+                                            .select_related('team'))
+
+        Workflow.get_resolver(self.team)
+        with self.assertNumQueries(0):
+            Workflow.add_to_team_videos(team_videos)
+
+        for tv in team_videos:
+            self.assertEqual(workflow.pk, tv.workflow.pk)
+
+
+class TestTeamVideoIndexing(TestCase):
+    fixtures = ["staging_users.json", "staging_videos.json", "staging_teams.json"]
+
+    # Team videos + prefetch_related languages, plus the languages, tips,
+    # public tips (two each), complete versions, URLs and task counts.
+    PREFETCH_QUERIES = 10
+
+    def setUp(self):
+        from haystack import site
+        self.index = site.get_index(TeamVideo)
+        self.team = Team.objects.get(pk=1)
+
+    def _count_queries(self, f, *args):
+        from django.db import connection
+
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            result = f(*args)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+
+        return len(connection.queries) - start, result
+
+    def test_prefetch_query_count(self):
+        # The number of queries needed to prefetch a batch of team videos
+        # shouldn't depend on the size of the batch.
+        for i in xrange(10):
+            video, _ = Video.get_or_create_for_url(
+                'http://www.example.com/index-%s.mp4' % i)
+            TeamVideo.objects.create(team=self.team, video=video,
+                                     added_by=User.objects.all()[0])
+            add_subtitles(video, 'en', [(0, 1000, 'Hello', {})])
+
+        ids = list(TeamVideo.objects.values_list('pk', flat=True))
+        self.assertTrue(len(ids) > 10)
+
+        queries, team_videos = self._count_queries(self.index.load, ids)
+
+        self.assertEqual(len(ids), len(team_videos))
+        self.assertTrue(queries <= self.PREFETCH_QUERIES,
+                        'Prefetching %s team videos took %s queries' % (
+                            len(ids), queries))
+
+    def test_prepare_matches_models(self):
+        tv = TeamVideo.objects.filter(team=self.team)[0]
+        add_subtitles(tv.video, 'en', [(0, 1000, 'Hello', {})],
+                      complete=True)
+        add_subtitles(tv.video, 'fr', [(0, None, 'Bonjour', {})],
+                      complete=True)
+
+        tv = TeamVideo.objects.get(pk=tv.pk)
+        data = self.index.prepare(self.index.load([tv.pk])[0])
+
+        video = Video.objects.get(pk=tv.video.pk)
+        completed = video.completed_subtitle_languages()
+
+        self.assertEqual(['en'], data['video_completed_langs'])
+        self.assertEqual([sl.language_code for sl in completed],
+                         data['video_completed_langs'])
+        self.assertEqual(video.newsubtitlelanguage_set.having_nonempty_tip().count(),
+                         data['num_total_langs'])
+        self.assertEqual(video.get_video_url(), data['video_url'])
+        self.assertEqual(video.title_display_unabridged(), data['title'])
+        self.assertEqual(tv.task_set.incomplete().count(), data['task_count'])
+
+    def test_queued_updates_are_flushed(self):
+        tv = TeamVideo.objects.filter(team=self.team)[0]
+
+        # Celery runs eagerly in the tests, so the flush happens right away
+        # and leaves nothing queued.
+        tasks.queue_team_video_index_update(tv.pk, tv.pk)
+        from utils.redis_utils import default_connection
+        self.assertEqual(0, default_connection.scard(tasks.INDEX_QUEUE_KEY))
+        self.assertEqual(None, default_connection.get(tasks.INDEX_FLUSH_KEY))
+
+    def test_failed_flush_requeues(self):
+        from utils.redis_utils import default_connection
+        tvs = list(TeamVideo.objects.filter(team=self.team)[:2])
+        calls = []
+
+        def update_many(ids):
+            calls.append(list(ids))
+            if len(calls) == 1:
+                raise IOError('Solr is down')
+            return len(ids)
+        self.index.update_many = update_many
+
+        # The flush fails and queues the ids again, which (eagerly) flushes
+        # them again.
+        try:
+            tasks.queue_team_video_index_update(*[tv.pk for tv in tvs])
+        finally:
+            del self.index.update_many
+
+        self.assertEqual(calls, [sorted(tv.pk for tv in tvs)] * 2)
+        self.assertEqual(0, default_connection.scard(tasks.INDEX_QUEUE_KEY))
+
+
 class TestInvites(TestCase):
 
     def setUp(self):
@@ -1483,3 +1756,21 @@ class BillingTest(TestCase):
         self.assertEquals(1, len(data))
         v = data[0][1]
         self.assertEquals(v.version_number, 9)
+
+    def test_time_bounds_of_old_versions(self):
+        from apps.teams.models import BillingReport
+        from apps.subtitles.models import SubtitleVersion
+
+        team = Team.objects.all()[0]
+        language = SubtitleLanguage.objects.all()[0]
+        v = add_subtitles(language.video, language.language,
+                          [(0, 1000, 'hello', {}), (2000, 3000, 'world', {})])
+
+        # Versions saved before the bounds were denormalized.
+        SubtitleVersion.objects.filter(pk=v.pk).update(
+            first_start_time=None, last_end_time=None)
+        v = SubtitleVersion.objects.get(pk=v.pk)
+
+        b = BillingReport.objects.create(team=team,
+                start_date=date(2012, 1, 1), end_date=date(2012, 1, 2))
+        self.assertEqual(b._time_bounds([v]), {v.pk: (0, 3000)})
@@ -41,7 +41,7 @@ from django.views.generic.list_detail import object_list
 import teams.moderation_const as MODERATION
 import widget
 from apps.auth.models import UserLanguage, CustomUser as User
-from apps.videos.templatetags.paginator import paginate
+from apps.videos.templatetags.paginator import keyset_paginate, paginate
 from messages import tasks as notifier
 from accountlinker.models import ThirdPartyAccount
 from teams.forms import (
@@ -62,8 +62,9 @@ from teams.permissions import (
     roles_user_can_assign, can_join_team, can_edit_video, can_delete_tasks,
     can_perform_task, can_rename_team, can_change_team_settings,
     can_perform_task_for, can_delete_team, can_review, can_approve,
-    can_delete_video, can_remove_video
+    can_delete_video, can_remove_video, get_member, get_permission_context
 )
+from teams.cache import invalidate_task_languages
 from teams.signals import api_teamvideo_new, api_subtitles_rejected
 from teams.tasks import (
     invalidate_video_caches, invalidate_video_moderation_caches,
@@ -277,7 +278,7 @@ def settings_guidelines(request, slug):
 @login_required
 def settings_permissions(request, slug):
     team = Team.get(slug, request.user)
-    workflow = Workflow.get_for_target(team.id, 'team')
+    workflow = team.get_workflow()
     moderated = team.moderates_videos()
 
     if not can_change_team_settings(team, request.user):
@@ -501,9 +502,6 @@ def detail(request, slug, project_slug=None, languages=None):
     team_video_md_list, pagination_info = paginate(qs, per_page, request.GET.get('page'))
     extra_context.update(pagination_info)
     extra_context['team_video_md_list'] = team_video_md_list
-    extra_context['team_workflows'] = list(
-        Workflow.objects.filter(team=team.id)
-                        .select_related('project', 'team', 'team_video'))
 
     if not filtered and not query:
         if project:
@@ -515,6 +513,7 @@ def detail(request, slug, project_slug=None, languages=None):
     if is_editor:
         team_video_ids = [record.team_video_pk for record in team_video_md_list]
         team_videos = list(TeamVideo.objects.filter(id__in=team_video_ids).select_related('video', 'team', 'project'))
+        Workflow.add_to_team_videos(team_videos)
         team_videos = dict((tv.pk, tv) for tv in team_videos)
         for record in team_video_md_list:
             if record:
@@ -1040,15 +1039,13 @@ def _get_or_create_workflow(team_slug, project_id, team_video_id):
     return workflow
 
 def _task_languages(team, user):
-    languages = filter(None, Task.objects.filter(team=team, deleted=False)
-                                         .values_list('language', flat=True)
-                                         .distinct())
+    from teams.cache import get_task_languages
+    languages = filter(None, get_task_languages(team))
 
     language_labels = dict(get_language_choices(with_empty=True))
 
     # TODO: Handle the team language setting here once team settings are
     # implemented.
-    languages = list(set(languages))
     lang_data = []
     for l in languages:
         if language_labels.get(l):
@@ -1118,6 +1115,11 @@ def _tasks_list(request, team, project, filters, user):
     return tasks
 
 def _order_tasks(request, tasks):
+    '''Return the tasks to list and the order to list them in.
+
+    The order always ends with the id so it can be used for keyset pagination.
+
+    '''
     sort = request.GET.get('sort', '-created')
     # Most teams won't use priorities. For those who do, that should be
     # the default sorting.
@@ -1132,8 +1134,8 @@ def _order_tasks(request, tasks):
     elif sort == '-expires':
         tasks = tasks.exclude(expiration_date=None)
         order_clause.append('-expiration_date')
-    tasks = tasks.order_by(*order_clause)
-    return tasks
+    order_clause.append('-id' if order_clause[-1].startswith('-') else 'id')
+    return tasks, order_clause
 
 def _get_task_filters(request):
     return { 'language': request.GET.get('lang'),
@@ -1154,7 +1156,7 @@ def team_tasks(request, slug):
     project_slug = request.GET.get('project')
 
     user = request.user if request.user.is_authenticated() else None
-    member = team.members.get(user=user) if user else None
+    member = get_member(request.user, team)
     languages = _task_languages(team, request.user)
     languages = sorted(languages, key=lambda l: l['name'])
     filters = _get_task_filters(request)
@@ -1176,9 +1178,14 @@ def team_tasks(request, slug):
         else:
             project = None
 
-    tasks = _order_tasks(request,
-                         _tasks_list(request, team, project, filters, user))
-    tasks, pagination_info = paginate(tasks, TASKS_ON_PAGE, request.GET.get('page'))
+    tasks, order_clause = _order_tasks(
+        request, _tasks_list(request, team, project, filters, user))
+    # Page through the tasks by seeking past the last one shown instead of
+    # with an OFFSET, which gets slower the further in you go.
+    tasks, pagination_info = keyset_paginate(
+        tasks.only('id', 'priority', 'created', 'expiration_date'),
+        order_clause, TASKS_ON_PAGE,
+        after=request.GET.get('after'), before=request.GET.get('before'))
 
     # We pull out the task IDs here for performance.  It's ugly, I know.
     #
@@ -1187,7 +1194,8 @@ def team_tasks(request, slug):
     # two queries they'll both be fast.
     #
     # Thanks, MySQL.
-    task_ids = list(tasks.values_list('id', flat=True))
+    task_ids = [t.pk for t in tasks]
+    positions = dict((pk, i) for i, pk in enumerate(task_ids))
     tasks = list(Task.objects.filter(id__in=task_ids).select_related(
             'team_video__video',
             'team_video__team',
@@ -1196,7 +1204,11 @@ def team_tasks(request, slug):
             'team',
             'new_subtitle_version__subtitle_language',
             'new_subtitle_version__author'))
-    tasks.sort(key=lambda t: task_ids.index(t.pk))
+    tasks.sort(key=lambda t: positions[t.pk])
+
+    # The template checks several permissions for every task.  Load what
+    # those checks need for the whole page up front.
+    get_permission_context(request.user, team).prime_tasks(tasks)
 
     if filters.get('team_video'):
         filters['team_video'] = TeamVideo.objects.get(pk=filters['team_video'])
@@ -1693,6 +1705,7 @@ def _propagate_unpublish_to_tasks(team_video, language_pk, language_code):
         tasks_to_delete = tasks_to_delete.filter(language=language_code)
 
     tasks_to_delete.update(deleted=True)
+    invalidate_task_languages(team_video.team_id)
 
 def unpublish(request, slug):
     team = get_object_or_404(Team, slug=slug)
@@ -17,10 +17,15 @@
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
 import sys, os, shutil, subprocess, logging, time
+import errno
+import hashlib
+import json
+import multiprocessing
 import re
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.contrib.sites.models import Site
 from django.template.loader import render_to_string
 
@@ -55,6 +60,17 @@ FLOWPLAYER_JS = os.path.join(
     settings.PROJECT_ROOT, "media/flowplayer/flowplayer-3.2.6.min.js")
 COMPILER_PATH = os.path.join(settings.PROJECT_ROOT,  "closure", "compiler.jar")
 
+# Compiler output, keyed by a hash of everything that goes into it.  This
+# lives next to the commit dirs so that it's kept between builds, and starts
+# with a dot so that _remove_cache_dirs_before leaves it alone.
+BUILD_CACHE_DIR = os.path.join(
+    settings.STATIC_ROOT, settings.COMPRESS_OUTPUT_DIRNAME, ".build-cache")
+# Entries that haven't been used for this many days are removed.
+BUILD_CACHE_DAYS = 14
+# Written to the cache dir, for send_to_s3.  Maps each file's path, relative
+# to the cache dir, to the sha1 of its contents.
+MANIFEST_NAME = ".manifest.json"
+
 
 DIRS_TO_COMPILE = []
 SKIP_COPING_ON = DIRS_TO_COMPILE + [
@@ -124,6 +140,38 @@ def get_cache_dir():
             settings.STATIC_ROOT,
             settings.COMPRESS_OUTPUT_DIRNAME, LAST_COMMIT_GUID))
 
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _make_dirs(path):
+    # Bundles are compiled in parallel, so another one may get there first.
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+_tool_stamps = {}
+
+def _tool_stamp(path):
+    """Identify a compiler jar by the sha1 of its contents.
+
+    The mtime changes on every checkout, so it would throw the cache away for
+    nothing.  The digest is remembered, since every bundle asks for it.
+    """
+    if path not in _tool_stamps:
+        _tool_stamps[path] = file_digest(path)
+    return _tool_stamps[path]
+
+def _compile_bundle(args):
+    """Compile one bundle in a pool process."""
+    state, bundle_name, bundle_type, files = args
+    command = Command()
+    command.__dict__.update(state)
+    command.compile_media_bundle(bundle_name, bundle_type, files)
+    return bundle_name
+
 def sorted_ls(path):
     """
     Returns contents of dir from older to newer
@@ -151,8 +199,55 @@ class Command(BaseCommand):
         optparse.make_option('--compilation-level',
             action='store', dest='compilation_level', default='ADVANCED_OPTIMIZATIONS',
             help="How aggressive is compilation. Possible values: ADVANCED_OPTIMIZATIONS, WHITESPACE_ONLY and SIMPLE_OPTIMIZATIONS"),
+        optparse.make_option('--workers',
+            action='store', dest='workers', type='int', default=multiprocessing.cpu_count(),
+            help="How many bundles to compile at once."),
+        optparse.make_option('--no-build-cache',
+            action='store_false', dest='use_build_cache', default=True,
+            help="Compile every bundle, even if its inputs haven't changed."),
         )
 
+    def _build_key(self, *parts):
+        """Return the build cache key for a compiler run.
+
+        `parts` has to cover everything the output depends on: the compiler,
+        its flags and the contents of the input files.
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update("%d:" % len(part))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _cache_get(self, key):
+        if not self.use_build_cache:
+            return None
+        path = os.path.join(BUILD_CACHE_DIR, key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path, None)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _cache_put(self, key, data):
+        if not self.use_build_cache or not data:
+            return
+        _make_dirs(BUILD_CACHE_DIR)
+        path = os.path.join(BUILD_CACHE_DIR, key)
+        temp_path = "%s.%s" % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+    def _prune_build_cache(self):
+        if not os.path.exists(BUILD_CACHE_DIR):
+            return
+        cutoff = time.time() - BUILD_CACHE_DAYS * 24 * 60 * 60
+        for name in os.listdir(BUILD_CACHE_DIR):
+            path = os.path.join(BUILD_CACHE_DIR, name)
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+
     def _append_version_for_debug(self, descriptor, file_type):
         """
         We append the /*unisubs.static_version="{{commit guid}"*/ to the end of the
@@ -177,17 +272,22 @@ class Command(BaseCommand):
         else:
             dir_path = os.path.join(self.temp_dir, "css-compressed")
             concatenated_path =  os.path.join(dir_path, "%s.%s" % (bundle_name, bundle_type))
-        if os.path.exists(dir_path) is False:
-            os.makedirs(dir_path)
+        _make_dirs(dir_path)
         out = open(concatenated_path, 'w')
         out.write("".join(buffer))
         out.close()
         if bundle_type == "css":
             filename = "%s.css" % ( bundle_name)
             cmd_str = "%s --type=%s %s" % (settings.COMPRESS_YUI_BINARY, bundle_type, concatenated_path)
-        if self.verbosity > 1:
-            logging.info( "calling %s" % cmd_str)
-        output, err_data  = call_command(cmd_str)
+        key = self._build_key(settings.COMPRESS_YUI_BINARY, bundle_type, *buffer)
+        output = self._cache_get(key)
+        if output is not None:
+            logging.info("Using cached %s" % filename)
+        else:
+            if self.verbosity > 1:
+                logging.info( "calling %s" % cmd_str)
+            output, err_data  = call_command(cmd_str)
+            self._cache_put(key, output)
 
 
         out = open(concatenated_path, 'w')
@@ -223,8 +323,7 @@ class Command(BaseCommand):
             compiled_js = os.path.join(self.temp_dir, name)
         else:
             compiled_js = os.path.join(self.temp_dir, "js" , output_file_name)
-        if not os.path.exists(os.path.dirname(compiled_js)):
-            os.makedirs(os.path.dirname(compiled_js))
+        _make_dirs(os.path.dirname(compiled_js))
         compiler_jar = COMPILER_PATH
 
         logging.info("Calculating closure dependencies")
@@ -250,15 +349,15 @@ class Command(BaseCommand):
         output_lines = filter(lambda s: s.find("@fileoverview") == -1,
                               output.split("\n"))
 
-        calcdeps_js = os.path.join(JS_LIB, 'js', 'unisubs-calcdeps.js')
-        calcdeps_file = open(calcdeps_js, "w")
+        # One per bundle, since bundles are compiled in parallel.
+        calcdeps_js = os.path.join(
+            self.temp_dir, "{0}-calcdeps.js".format(bundle_name))
         if 'ignore_closure' in bundle_settings:
-            calcdeps_file.write("\n")
+            calcdeps_text = "\n"
         else:
-            calcdeps_file.write("\n".join(output_lines))
-        calcdeps_file.close()
-
-        logging.info("Compiling {0}".format(output_file_name))
+            calcdeps_text = "\n".join(output_lines)
+        with open(calcdeps_js, "w") as calcdeps_file:
+            calcdeps_file.write(calcdeps_text)
 
         debug_arg = ''
         if not debug:
@@ -275,15 +374,29 @@ class Command(BaseCommand):
                     (compiler_jar, calcdeps_js, deps, compiled_js,
                      debug_arg, extra_defines_arg, optimization_type)
 
-        if self.verbosity > 1:
-            logging.info( "calling %s" % cmd_str)
-        output,err = call_command(cmd_str)
-        if err:
-            # if an error comes up, is will look like:
-            sys.stderr.write("Error compiling : %s \n%s" % (bundle_name, err))
-
-        with open(compiled_js, 'r') as compiled_js_file:
-            compiled_js_text = compiled_js_file.read()
+        # The command line, minus the paths that change from build to build.
+        key = self._build_key(_tool_stamp(compiler_jar), debug_arg,
+                              extra_defines_arg, optimization_type,
+                              calcdeps_text,
+                              *[open(os.path.join(JS_LIB, file)).read()
+                                for file in files])
+        compiled_js_text = self._cache_get(key)
+        output, err = '', ''
+        if compiled_js_text is not None:
+            logging.info("Using cached {0}".format(output_file_name))
+        else:
+            logging.info("Compiling {0}".format(output_file_name))
+            if self.verbosity > 1:
+                logging.info( "calling %s" % cmd_str)
+            output,err = call_command(cmd_str)
+            if err:
+                # if an error comes up, is will look like:
+                sys.stderr.write("Error compiling : %s \n%s" % (bundle_name, err))
+
+            with open(compiled_js, 'r') as compiled_js_file:
+                compiled_js_text = compiled_js_file.read()
+            self._cache_put(key, compiled_js_text)
+        os.remove(calcdeps_js)
 
         with open(compiled_js, 'w') as compiled_js_file:
 
@@ -330,6 +443,13 @@ class Command(BaseCommand):
             file_name = os.path.join(self.temp_dir, output_override)
         uncompiled_file_name = os.path.join(
                 self.temp_dir, "js", "{0}-uncompiled.js".format(bundle_name))
+        key = self._build_key(_tool_stamp(COMPILER_PATH),
+                              self.compilation_level, rendered)
+        compiled = self._cache_get(key)
+        if compiled is not None:
+            with open(file_name, 'w') as f:
+                f.write(compiled)
+            return
         with open(uncompiled_file_name, 'w') as f:
             f.write(rendered)
         cmd_str = ("java -jar {0} --js {1} --js_output_file {2} "
@@ -337,6 +457,9 @@ class Command(BaseCommand):
             COMPILER_PATH, uncompiled_file_name, file_name, self.compilation_level)
         call_command(cmd_str)
         os.remove(uncompiled_file_name)
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as f:
+                self._cache_put(key, f.read())
 
     def compile_media_bundle(self, bundle_name, bundle_type, files):
         getattr(self, "compile_%s_bundle" % bundle_type)(bundle_name, bundle_type, files)
@@ -435,13 +558,37 @@ class Command(BaseCommand):
             f.write(rendered)
 
     def _compile_media_bundles(self, restrict_bundles, args):
+        """Compile the bundles, `workers` at a time.
+
+        Bundles don't depend on each other, so each one is compiled in its own
+        process.  Bundles whose inputs haven't changed since a previous build
+        are taken from BUILD_CACHE_DIR instead of being compiled again.
+        """
         bundles = settings.MEDIA_BUNDLES
-        for bundle_name, data in bundles.items():
-            if restrict_bundles and bundle_name not in args:
-                continue
-            self.compile_media_bundle(
-                bundle_name, data['type'], data["files"])
-            print "Compiled %s"  % bundle_name
+        state = {
+            'temp_dir': self.temp_dir,
+            'verbosity': self.verbosity,
+            'compilation_level': self.compilation_level,
+            'use_build_cache': self.use_build_cache,
+        }
+        jobs = [(state, bundle_name, data['type'], data["files"])
+                for bundle_name, data in bundles.items()
+                if not restrict_bundles or bundle_name in args]
+
+        if self.workers > 1 and len(jobs) > 1:
+            # Don't share the database connection with the pool.
+            connection.close()
+            pool = multiprocessing.Pool(min(self.workers, len(jobs)))
+            try:
+                compiled = pool.imap_unordered(_compile_bundle, jobs)
+                for bundle_name in compiled:
+                    print "Compiled %s"  % bundle_name
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                print "Compiled %s"  % _compile_bundle(job)
 
     def _remove_cache_dirs_before(self, num_to_keep):
         """
@@ -470,6 +617,17 @@ class Command(BaseCommand):
             to_path = os.path.join(cache_dir, filename)
             shutil.move(from_path,  to_path)
 
+    def _write_manifest(self):
+        """Record the sha1 of every file in the cache dir, for send_to_s3."""
+        cache_dir = get_cache_dir()
+        files = {}
+        for (dirpath, dirnames, filenames) in os.walk(cache_dir):
+            for file_name in filenames:
+                path = os.path.join(dirpath, file_name)
+                files[path[len(cache_dir) + 1:]] = file_digest(path)
+        files.pop(MANIFEST_NAME, None)
+        with open(os.path.join(cache_dir, MANIFEST_NAME), 'w') as f:
+            json.dump({'commit': LAST_COMMIT_GUID, 'files': files}, f)
 
     def _copy_files_with_public_urls_from_cache_dir_to_static_dir(self):
         cache_dir = get_cache_dir()
@@ -516,6 +674,8 @@ class Command(BaseCommand):
         self.test_str_version = bool(options.get('test_str_version'))
         self.keeps_previous = bool(options.get('keeps_previous'))
         self.compilation_level = options.get('compilation_level')
+        self.workers = int(options.get('workers') or 1)
+        self.use_build_cache = bool(options.get('use_build_cache'))
         restrict_bundles = bool(args)
 
         os.chdir(settings.PROJECT_ROOT)
@@ -529,8 +689,11 @@ class Command(BaseCommand):
             self._remove_cache_dirs_before(1)
 
         self._copy_temp_dir_to_cache_dir()
+        self._write_manifest()
         self._copy_files_with_public_urls_from_cache_dir_to_static_dir()
         self._make_mirosubs_copies_of_files_with_public_urls()
+        if self.use_build_cache:
+            self._prune_build_cache()
 
         if self.test_str_version:
             self.test_string_version()
@@ -20,10 +20,18 @@ AWS_BUCKET_NAME = ''
 For example it wil sync anything in
 STATIC_ROOT/static-cache/0234dsd/*
 
+compile_media writes a manifest of the sha1 of every file it outputs.  After
+a sync, the manifest is stored in the bucket as static-cache/manifest.json,
+along with the prefix it was uploaded to.  On the next sync, files that haven't
+changed since then are copied from the previous prefix within S3 instead of
+being uploaded again, and the files with no unique url are skipped.  Use
+--force to upload everything.
+
 
 """
 import datetime
 import email
+import json
 import mimetypes
 import optparse
 import os
@@ -40,7 +48,8 @@ try:
 except ImportError:
     raise ImportError, "The boto Python library is not installed."
 
-from apps.unisubs_compressor.management.commands.compile_media import get_cache_dir
+from apps.unisubs_compressor.management.commands.compile_media import (
+    get_cache_dir, file_digest, MANIFEST_NAME)
 from deploy.git_helpers import get_current_commit_hash
 from compile_media import NO_UNIQUE_URL
 
@@ -82,6 +91,8 @@ class Command(BaseCommand):
     )
 
     upload_count = 0
+    copy_count = 0
+    fail_count = 0
     skip_count = 0
 
     option_list = BaseCommand.option_list + (
@@ -95,8 +106,8 @@ class Command(BaseCommand):
             action='store_true', dest='expires', default=True,
             help="Enables setting a far future expires header."),
         optparse.make_option('--force',
-            action='store_true', dest='force', default=True,
-            help="Skip the file mtime check to force upload of all files.")
+            action='store_true', dest='force', default=False,
+            help="Upload all files, even the ones that haven't changed since the last sync.")
     )
 
     help = 'Syncs the complete STATIC_ROOT structure and files to S3 into the given bucket name.'
@@ -144,6 +155,7 @@ class Command(BaseCommand):
 
         print
         print "%d files uploaded." % (self.upload_count)
+        print "%d files copied." % (self.copy_count)
         print "%d files skipped." % (self.skip_count)
 
     def sync_s3(self):
@@ -151,6 +163,7 @@ class Command(BaseCommand):
         Walks the media directory and syncs files to S3
         """
         bucket, key = self.open_s3()
+        self.load_manifests(bucket)
         os.path.walk(self.DIRECTORY, self.upload_s3,
             (bucket, key, self.AWS_BUCKET_NAME, self.DIRECTORY))
          
@@ -160,6 +173,44 @@ class Command(BaseCommand):
         self.sync_no_unique_url_items(bucket, key)
 
         self.prefix = old_prefix
+        self.save_manifest(bucket)
+
+    def manifest_key(self):
+        from django.conf import settings
+        return '%s/manifest.json' % settings.COMPRESS_OUTPUT_DIRNAME
+
+    def load_manifests(self, bucket):
+        """
+        Loads the manifest compile_media wrote and the one saved by the
+        last sync.  Without both every file is uploaded.
+        """
+        self.manifest = {}
+        self.public_manifest = {}
+        self.previous = {'prefix': None, 'files': {}, 'public': {}}
+
+        path = os.path.join(self.DIRECTORY, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)['files']
+        if self.do_force or not self.manifest:
+            return
+
+        previous = bucket.get_key(self.manifest_key())
+        if previous is not None:
+            self.previous.update(json.loads(previous.get_contents_as_string()))
+
+    def save_manifest(self, bucket):
+        if self.fail_count:
+            # The next sync has to upload the files that failed.
+            print "Not saving the manifest, %d uploads failed." % self.fail_count
+            return
+        key = boto.s3.key.Key(bucket)
+        key.name = self.manifest_key()
+        key.set_contents_from_string(json.dumps({
+            'prefix': self.prefix,
+            'files': self.manifest,
+            'public': self.public_manifest,
+        }), {'Content-Type': 'application/json'}, replace=True)
 
     def sync_no_unique_url_items(self, bucket, key):
         from django.conf import settings
@@ -169,6 +220,11 @@ class Command(BaseCommand):
             fname = os.path.basename(file_name)
             base_dir = os.path.join(settings.STATIC_ROOT, os.path.dirname(file_name))
             full_path = os.path.join(settings.STATIC_ROOT, file_name)
+            digest = file_digest(full_path)
+            self.public_manifest[file_name] = digest
+            if self.previous['public'].get(file_name) == digest:
+                self.skip_count += 1
+                return
             self.upload_one(
                 bucket, key, self.AWS_BUCKET_NAME, outside_dir, full_path, file_name,
                 add_no_cache if item['no-cache'] else None)
@@ -231,8 +287,16 @@ class Command(BaseCommand):
 
             
             file_key = filename[len(root_dir):]
-            if self.prefix:
-                file_key = '%s/%s' % (self.prefix, file_key)
+            if file_key == MANIFEST_NAME:
+                continue
+            action, previous_key, file_key = self.plan_file(file_key)
+
+            if action == 'skip':
+                self.skip_count += 1
+                continue
+            elif action == 'copy':
+                self.copy_one(bucket, previous_key, file_key)
+                continue
                            
             cache_strategy = None
             if self.do_expires:
@@ -240,6 +304,43 @@ class Command(BaseCommand):
             self.upload_one(bucket, key, bucket_name, root_dir, filename, file_key, cache_strategy)                    
 
 
+    def plan_file(self, file_key):
+        """
+        Compares a file against the manifest of the last sync.  Returns
+        (action, previous key, key) where action is 'skip' if the file is
+        already there, 'copy' if it's unchanged but under the previous
+        prefix, and 'upload' otherwise.
+        """
+        digest = self.manifest.get(file_key)
+        unchanged = digest and self.previous['files'].get(file_key) == digest
+        previous_key = file_key
+        if self.prefix:
+            file_key = '%s/%s' % (self.prefix, file_key)
+        if self.previous['prefix']:
+            previous_key = '%s/%s' % (self.previous['prefix'], previous_key)
+
+        if not unchanged:
+            return 'upload', previous_key, file_key
+        elif previous_key == file_key:
+            return 'skip', previous_key, file_key
+        else:
+            return 'copy', previous_key, file_key
+
+    def copy_one(self, bucket, from_key, file_key):
+        """
+        Copies an unchanged file from the last sync, within S3.  The headers
+        set when it was uploaded are copied along with it.
+        """
+        if self.verbosity > 0:
+            print "Copying %s from %s..." % (file_key, from_key)
+        try:
+            bucket.copy_key(file_key, bucket.name, from_key, preserve_acl=True)
+        except boto.exception.S3ResponseError, e:
+            print "Failed: %s" % e
+            raise
+        else:
+            self.copy_count += 1
+
     def upload_one(self, bucket, key, bucket_name, root_dir, filename, 
                    file_key, cache_strategy=None):
         if self.verbosity > 0:
@@ -269,6 +370,7 @@ class Command(BaseCommand):
             key.make_public()
         except boto.s3.connection.BotoClientError, e:
             print "Failed: %s" % e
+            self.fail_count += 1
         except Exception, e:
             print e
             raise
@@ -0,0 +1,128 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from unisubs_compressor.management.commands import compile_media, send_to_s3
+
+
+class BuildCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_cache_dir = compile_media.BUILD_CACHE_DIR
+        compile_media.BUILD_CACHE_DIR = os.path.join(self.dir, 'cache')
+        self.command = compile_media.Command()
+        self.command.use_build_cache = True
+
+    def tearDown(self):
+        compile_media.BUILD_CACHE_DIR = self.old_cache_dir
+        shutil.rmtree(self.dir)
+
+    def test_build_key(self):
+        key = self.command._build_key('compiler', '--debug', 'var a;')
+        self.assertEqual(key,
+                         self.command._build_key('compiler', '--debug', 'var a;'))
+        self.assertNotEqual(key,
+                            self.command._build_key('compiler', '', 'var a;'))
+        # Parts are length prefixed, so moving a boundary changes the key.
+        self.assertNotEqual(self.command._build_key('ab', 'c'),
+                            self.command._build_key('a', 'bc'))
+
+    def test_cache_round_trip(self):
+        key = self.command._build_key('a')
+        self.assertEqual(self.command._cache_get(key), None)
+
+        self.command._cache_put(key, 'compiled')
+        self.assertEqual(self.command._cache_get(key), 'compiled')
+        self.assertEqual(os.listdir(compile_media.BUILD_CACHE_DIR), [key])
+
+    def test_cache_disabled(self):
+        key = self.command._build_key('a')
+        self.command._cache_put(key, 'compiled')
+
+        self.command.use_build_cache = False
+        self.assertEqual(self.command._cache_get(key), None)
+        self.command._cache_put(self.command._build_key('b'), 'compiled')
+        self.assertEqual(os.listdir(compile_media.BUILD_CACHE_DIR), [key])
+
+    def test_empty_output_is_not_cached(self):
+        key = self.command._build_key('a')
+        self.command._cache_put(key, '')
+        self.assertEqual(self.command._cache_get(key), None)
+
+    def test_tool_stamp_follows_contents(self):
+        path = os.path.join(self.dir, 'compiler.jar')
+        with open(path, 'wb') as f:
+            f.write('jar')
+        stamp = compile_media._tool_stamp(path)
+        compile_media._tool_stamps.clear()
+
+        # Touching the jar doesn't change its stamp.
+        os.utime(path, (0, 0))
+        self.assertEqual(compile_media._tool_stamp(path), stamp)
+        compile_media._tool_stamps.clear()
+
+        with open(path, 'wb') as f:
+            f.write('new jar')
+        self.assertNotEqual(compile_media._tool_stamp(path), stamp)
+        compile_media._tool_stamps.clear()
+
+
+class ManifestDiffTest(TestCase):
+    def setUp(self):
+        self.command = send_to_s3.Command()
+        self.command.prefix = 'static-cache/new'
+        self.command.manifest = {
+            'js/a.js': 'aaa',
+            'js/b.js': 'bbb',
+            'js/c.js': 'ccc',
+        }
+        self.command.previous = {
+            'prefix': 'static-cache/old',
+            'files': {
+                'js/a.js': 'aaa',
+                'js/b.js': 'old',
+            },
+            'public': {},
+        }
+
+    def test_unchanged_files_are_copied(self):
+        self.assertEqual(self.command.plan_file('js/a.js'),
+                         ('copy', 'static-cache/old/js/a.js',
+                          'static-cache/new/js/a.js'))
+
+    def test_changed_and_new_files_are_uploaded(self):
+        self.assertEqual(self.command.plan_file('js/b.js')[0], 'upload')
+        self.assertEqual(self.command.plan_file('js/c.js')[0], 'upload')
+        # Not in the manifest compile_media wrote.
+        self.assertEqual(self.command.plan_file('js/d.js')[0], 'upload')
+
+    def test_same_prefix_is_skipped(self):
+        self.command.prefix = 'static-cache/old'
+        self.assertEqual(self.command.plan_file('js/a.js'),
+                         ('skip', 'static-cache/old/js/a.js',
+                          'static-cache/old/js/a.js'))
+
+    def test_no_previous_sync(self):
+        self.command.previous = {'prefix': None, 'files': {}, 'public': {}}
+        self.assertEqual(self.command.plan_file('js/a.js'),
+                         ('upload', 'js/a.js', 'static-cache/new/js/a.js'))
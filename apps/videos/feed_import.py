@@ -0,0 +1,292 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Importing videos from feeds in bulk.
+
+Most of the time spent importing a feed is waiting on other sites: fetching
+the feed, and then asking the provider about every video in it.  The
+FeedImporter runs the import in stages:
+
+1. fetch: fetch and parse the feeds in a bounded pool of threads.  Building
+   the video types also happens here, which for some providers (YouTube)
+   is where the metadata is requested.
+2. dedupe: look up the videos we already have in one query.
+3. metadata: call VideoType.fetch_values() for the new videos in the pool.
+4. create: bulk create the Video and VideoUrl rows, plus their actions and
+   followers, in one transaction.  The tasks and hooks for the new videos
+   are only run once it has committed, so that workers can see the rows.
+5. team: bulk create the TeamVideo rows, if importing into a team.
+
+The worker threads never touch the database; everything that does runs in the
+calling thread.  How long each stage took is recorded in `timings` and sent to
+Riemann.
+
+"""
+
+import logging
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+
+from utils.metrics import ManualTimer
+from videos.feed_parser import FeedParser
+from videos.models import Action, Video, VideoFeed, VideoUrl, create_video_id
+
+logger = logging.getLogger(__name__)
+
+FEED_IMPORT_WORKERS = getattr(settings, 'FEED_IMPORT_WORKERS', 8)
+STAGES = ('fetch', 'dedupe', 'metadata', 'create', 'team')
+
+
+def _read_feed(url):
+    """Return the video types in a feed and the link of the last one."""
+    video_types, last_link = [], ''
+    for vt, info, entry in FeedParser(url).items():
+        if vt:
+            video_types.append(vt)
+            last_link = entry.get('link', '')
+    return video_types, last_link
+
+def _fetch_values(vt):
+    video = Video()
+    try:
+        vt.fetch_values(video)
+    except Exception:
+        logger.exception('Error fetching metadata for %s',
+                         vt.convert_to_video_url())
+    return video
+
+def _lookup_key(vt):
+    """Return the (field, value) pair a video type's URL is looked up by.
+
+    Like Video.get_or_create_for_url, we also look for existing videos by this
+    (usually the provider's video id) when the URL doesn't match.
+
+    """
+    kwargs = vt.create_kwars()
+    if len(kwargs) == 1:
+        return kwargs.items()[0]
+    return None
+
+
+class FeedImporter(object):
+    """Import the videos from a list of feed URLs.
+
+    After run(), `videos` is a list of (video, created) pairs like
+    Video.get_or_create_for_url returns, in feed order, and `team_videos` the
+    TeamVideos that were added to the team.
+
+    """
+    def __init__(self, user=None, team=None, workers=FEED_IMPORT_WORKERS):
+        self.user = user
+        self.team = team
+        self.workers = workers
+        self.videos = []
+        self.team_videos = []
+        self.timings = {}
+
+    def _timed(self, stage, fn, *args):
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.time() - start
+            self.timings[stage] = elapsed
+            ManualTimer('feed-import.' + stage).record(elapsed * 1000)
+
+    def run(self, urls):
+        pool = ThreadPool(max(1, min(self.workers, len(urls) or 1)))
+        try:
+            video_types = self._timed('fetch', self._fetch, pool, urls)
+            existing = self._timed('dedupe', self._dedupe, video_types)
+            new_types = [vt for vt in video_types
+                         if vt.convert_to_video_url() not in existing]
+            new_videos = self._timed('metadata', pool.map, _fetch_values,
+                                     new_types)
+        finally:
+            pool.close()
+            pool.join()
+
+        created = self._timed('create', self._create, new_types, new_videos)
+        self._created(new_types, created)
+
+        for vt in video_types:
+            url = vt.convert_to_video_url()
+            if url in existing:
+                self.videos.append((existing[url], False))
+            else:
+                self.videos.append((created[url], True))
+
+        if self.team and self.user:
+            self._timed('team', self._add_to_team)
+
+        logger.info('Imported %s videos from %s feeds: %s', len(self.videos),
+                    len(urls), ', '.join('%s %.2fs' % (s, self.timings[s])
+                                         for s in STAGES if s in self.timings))
+        return self.videos
+
+    def _fetch(self, pool, urls):
+        video_types = []
+        for url, (feed_types, last_link) in zip(urls,
+                                                pool.map(_read_feed, urls)):
+            video_types.extend(feed_types)
+            self._save_feed(url, last_link)
+
+        # The same video can be in several feeds.
+        seen = set()
+        unique = []
+        for vt in video_types:
+            url = vt.convert_to_video_url()
+            if url not in seen:
+                seen.add(url)
+                unique.append(vt)
+        return unique
+
+    def _save_feed(self, url, last_link):
+        try:
+            vf = VideoFeed.objects.get(url=url)
+        except VideoFeed.DoesNotExist:
+            vf = VideoFeed(url=url)
+        vf.user = self.user
+        vf.last_link = last_link
+        vf.save()
+
+    def _dedupe(self, video_types):
+        """Return a dict mapping video URLs we already have to their Video."""
+        if not video_types:
+            return {}
+
+        urls = set()
+        keys = {}
+        for vt in video_types:
+            urls.add(vt.convert_to_video_url())
+            key = _lookup_key(vt)
+            if key and key[0] != 'url':
+                keys.setdefault((vt.abbreviation, key[0]), set()).add(key[1])
+
+        query = Q(url__in=urls)
+        for (abbreviation, field), values in keys.items():
+            query |= Q(type=abbreviation, **{'%s__in' % field: values})
+
+        fields = set(field for abbreviation, field in keys)
+        by_url, by_key = {}, {}
+        for video_url in VideoUrl.objects.filter(query).select_related('video'):
+            by_url[video_url.url] = video_url.video
+            for field in fields:
+                by_key[(video_url.type, field, getattr(video_url, field))] = (
+                    video_url.video)
+
+        existing = {}
+        for vt in video_types:
+            url = vt.convert_to_video_url()
+            key = _lookup_key(vt)
+            video = by_url.get(url)
+            if video is None and key:
+                video = by_key.get((vt.abbreviation,) + key)
+            if video is not None:
+                existing[url] = video
+
+        if self.user and self.user.notify_by_message:
+            for video in existing.values():
+                video.followers.add(self.user)
+        return existing
+
+    @transaction.commit_on_success
+    def _create(self, video_types, videos):
+        """Save the new videos, returning a dict mapping their URLs to them."""
+        if not videos:
+            return {}
+
+        for video in videos:
+            video.user = self.user
+            create_video_id(Video, video)
+        Video.objects.bulk_create(videos)
+        saved = dict((v.video_id, v) for v in Video.objects.filter(
+            video_id__in=[v.video_id for v in videos]))
+        videos = [saved[v.video_id] for v in videos]
+
+        now = datetime.now()
+        video_urls = []
+        for vt, video in zip(video_types, videos):
+            video_urls.append(VideoUrl(
+                video=video, url=vt.convert_to_video_url(),
+                type=vt.abbreviation, videoid=vt.video_id or '',
+                original=True, primary=True, added_by=self.user, created=now,
+                owner_username=getattr(vt, 'username', None)))
+        VideoUrl.objects.bulk_create(video_urls)
+
+        Action.objects.bulk_create([
+            Action(video=video, action_type=Action.ADD_VIDEO, user=self.user,
+                   created=video.created or now)
+            for video in videos])
+
+        if self.user and self.user.notify_by_message:
+            Video.followers.through.objects.bulk_create([
+                Video.followers.through(video_id=video.pk,
+                                        customuser_id=self.user.pk)
+                for video in videos])
+            self.user.videos.through.objects.bulk_create([
+                self.user.videos.through(video_id=video.pk,
+                                         customuser_id=self.user.pk)
+                for video in videos])
+
+        return dict((vt.convert_to_video_url(), video)
+                    for vt, video in zip(video_types, videos))
+
+    def _created(self, video_types, created):
+        """Queue the tasks for the new videos, after they are committed."""
+        from videos.tasks import save_thumbnail_in_s3
+        for vt in video_types:
+            video = created[vt.convert_to_video_url()]
+            save_thumbnail_in_s3.delay(video.pk)
+            vt.video_created(video)
+            video.update_search_index()
+
+    def _add_to_team(self):
+        from teams.models import TeamVideo
+        from teams.signals import api_teamvideo_new
+
+        videos = dict((video.pk, video) for video, created in self.videos)
+        # A video can only be in one team.
+        taken = set(TeamVideo.objects.filter(video__in=videos.keys())
+                                     .values_list('video_id', flat=True))
+        project = self.team.default_project
+        now = datetime.now()
+
+        TeamVideo.objects.bulk_create([
+            TeamVideo(video=video, team=self.team, added_by=self.user,
+                      project=project, description=video.description,
+                      created=now)
+            for pk, video in videos.items() if pk not in taken])
+
+        self.team_videos = list(
+            TeamVideo.objects.filter(team=self.team, video__in=videos.keys())
+                             .exclude(video__in=taken)
+                             .select_related('team', 'video'))
+
+        # bulk_create doesn't send post_save, but the index updates and task
+        # creation hang off it.
+        for tv in self.team_videos:
+            post_save.send(sender=TeamVideo, instance=tv, created=True,
+                           raw=False, using='default')
+            api_teamvideo_new.send(tv)
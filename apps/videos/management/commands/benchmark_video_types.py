@@ -0,0 +1,100 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Measure how long it takes to find the video type for a URL."""
+
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from videos.types import video_type_registrar
+
+# Building types for these doesn't talk to the provider, so they can go
+# through resolve().
+OFFLINE_TEMPLATES = [
+    'http://media.example.com/talks/%d.mp4',
+    'https://cdn.example.org/video/%d.webm',
+    'http://example.net/flash/%d.flv',
+    'http://podcasts.example.com/episode-%d.mp3',
+]
+# Only matched; building the type would fetch its metadata.
+ONLINE_TEMPLATES = [
+    'http://www.youtube.com/watch?v=vid%07d',
+    'http://youtu.be/vid%07d',
+    'http://vimeo.com/%d',
+    'http://blip.tv/some-show/episode-%d',
+    'http://link.brightcove.com/services/player/bcpid%d',
+]
+# Nothing matches these.
+UNKNOWN_TEMPLATES = [
+    'http://www.example.com/page-%d.html',
+    'http://news.example.org/story/%d',
+]
+
+
+def legacy_match(url):
+    """VideoTypeRegistrar.video_type_for_url's loop before the host index."""
+    for video_type in video_type_registrar.itervalues():
+        if video_type.matches_video_url(url):
+            return video_type
+
+
+class Command(BaseCommand):
+    help = ('Time matching a corpus of mixed provider URLs to video types, '
+            'with and without the host index and the resolve cache.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--urls', action='store', dest='urls', type='int',
+                    default=20000, help='Number of URLs in the corpus.'),
+        make_option('--distinct', action='store', dest='distinct', type='int',
+                    default=2000,
+                    help='Number of distinct URLs, to exercise the cache.'),
+    )
+
+    def _time(self, name, fn, urls):
+        start = time.time()
+        for url in urls:
+            fn(url)
+        us = (time.time() - start) / len(urls) * 1000000
+        print '%-28s %10.2f us/url' % (name, us)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        templates = OFFLINE_TEMPLATES + ONLINE_TEMPLATES + UNKNOWN_TEMPLATES
+        distinct = [rng.choice(templates) % i
+                    for i in xrange(options['distinct'])]
+        urls = [rng.choice(distinct) for i in xrange(options['urls'])]
+        offline = [url for url in urls
+                   if any(url.startswith(t.split('%')[0])
+                          for t in OFFLINE_TEMPLATES)]
+
+        for url in distinct:
+            assert legacy_match(url) == video_type_registrar.match(url), url
+
+        print '%d URLs (%d distinct):' % (len(urls), len(distinct))
+        self._time('loop over all types (old)', legacy_match, urls)
+        self._time('host index', video_type_registrar.match, urls)
+
+        print
+        print '%d URLs that build their type offline:' % len(offline)
+        video_type_registrar.clear_cache()
+        self._time('video_type_for_url',
+                   video_type_registrar.video_type_for_url, offline)
+        self._time('resolve, warm', video_type_registrar.resolve, offline)
@@ -0,0 +1,39 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sitemaps import SitemapBuilder
+
+
+class Command(BaseCommand):
+    help = ('Build the video sitemap shards and the sitemap index. Only '
+            'shards whose videos changed since the last build are written.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force',
+                    default=False, help='Rebuild every shard.'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        rebuilt = SitemapBuilder().build(force=options['force'])
+        print 'Rebuilt %s shards in %.1fs' % (rebuilt, time.time() - start)
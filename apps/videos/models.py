@@ -26,7 +26,6 @@ from datetime import datetime, date, timedelta
 import time
 
 from django.utils.safestring import mark_safe
-from django.core.cache import cache
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
 from django.db.models import Q
@@ -46,10 +45,13 @@ from videos.types import video_type_registrar
 from videos.feed_parser import FeedParser
 from comments.models import Comment
 from libs.bulkops import insert_many
-from statistic import st_widget_view_statistic
-from statistic.tasks import st_sub_fetch_handler_update, st_video_view_handler_update
+from statistic import (
+    st_sub_fetch_handler, st_video_view_handler, st_widget_view_statistic
+)
+from statistic import buffer as statistic_buffer
 from widget import video_cache
 from utils.redis_utils import RedisSimpleField
+from utils import rowcounts
 from utils.amazon import S3EnabledImageField
 from utils.panslugify import pan_slugify
 
@@ -201,22 +203,33 @@ class Video(models.Model):
 
             {'month': 100, 'week': 5, 'year': 10223, 'total': 20333}
 
-        Caches this map in memcache for two hours.
+        The per-day sums are cached by the statistic handler until the next
+        migration touches this video.
 
         """
         if not hasattr(self, '_video_views_statistic'):
-            cache_key = 'video_views_statistic_%s' % self.pk
-            views_st = cache.get(cache_key)
-
-            if not views_st:
-                views_st = st_widget_view_statistic.get_views(video=self)
-                views_st['total'] = self.widget_views_count
-                cache.set(cache_key, views_st, 60*60*2)
-
+            views_st = st_widget_view_statistic.get_views(video=self)
+            views_st['total'] = self.widget_views_count
             self._video_views_statistic = views_st
 
         return self._video_views_statistic
 
+    @classmethod
+    def prefetch_views(cls, videos):
+        """Fill in the views property of many videos with a single query.
+
+        Meant for listing pages, which would otherwise query every video's
+        statistic separately.
+
+        """
+        videos = [v for v in videos if not hasattr(v, '_video_views_statistic')]
+        views = st_widget_view_statistic.get_views_many(videos)
+
+        for video in videos:
+            views_st = views[video.pk]
+            views_st['total'] = video.widget_views_count
+            video._video_views_statistic = views_st
+
     def title_display(self, truncate=True):
         v = self.latest_version()
 
@@ -227,27 +240,33 @@ class Video(models.Model):
         else:
             try:
                 url = self.videourl_set.all()[:1].get().url
-                if not url:
-                    return 'No title'
             except models.ObjectDoesNotExist:
-                return 'No title'
+                url = None
 
-            url = url.strip('/')
-
-            if url.startswith('http://'):
-                url = url[7:]
-
-            parts = url.split('/')
-            if len(parts) > 1:
-                title = '%s/.../%s' % (parts[0], parts[-1])
-            else:
-                title = url
+            title = self.title_from_url(url)
 
         if truncate and len(title) > 35:
             title = title[:35] + '...'
 
         return title
 
+    @staticmethod
+    def title_from_url(url):
+        """Return a title to display for a video that only has a URL."""
+        if not url:
+            return 'No title'
+
+        url = url.strip('/')
+
+        if url.startswith('http://'):
+            url = url[7:]
+
+        parts = url.split('/')
+        if len(parts) > 1:
+            return '%s/.../%s' % (parts[0], parts[-1])
+        else:
+            return url
+
     def title_display_unabridged(self):
         """
         This is just a wrapper around ``title_display`` for use in templates
@@ -255,17 +274,29 @@ class Video(models.Model):
         return self.title_display(False)
 
     def update_view_counter(self):
-        """Queue a Celery task that will increment the number of views for this video."""
+        """Count a view of this video.
+
+        Views are buffered in process and written to Redis in batches, see
+        statistic.buffer.
+
+        """
         try:
-            st_video_view_handler_update.delay(video_id=self.video_id)
+            statistic_buffer.count(st_video_view_handler, video_id=self.video_id)
         except:
             client.captureException()
 
     def update_subtitles_fetched(self, lang=None):
-        """Queue a Celery task that will increment the number of times this video's subtitles were fetched."""
+        """Count a fetch of this video's subtitles.
+
+        Like views, fetches are buffered and written to Redis in batches.
+
+        """
         try:
-            sl_pk = lang.pk if lang else None
-            st_sub_fetch_handler_update.delay(video_id=self.video_id, sl_pk=sl_pk)
+            # The key is worked out right away, so pass the language code
+            # rather than the pk, which would have to be looked up.
+            statistic_buffer.count(
+                st_sub_fetch_handler, video_id=self.video_id,
+                language_code=lang.language_code if lang else None)
             if lang:
                 from videos.tasks import update_subtitles_fetched_counter_for_sl
 
@@ -2562,3 +2593,5 @@ class VideoFeed(models.Model):
 
         return checked_entries
 
+
+rowcounts.register('videos.Video', Video.objects.count).track(Video)
@@ -72,6 +72,18 @@ class VideoIndex(CelerySearchIndex):
     def index_queryset(self):
         return self.model.objects.order_by('-id')
 
+    def prefetch(self, videos):
+        """Load the view counts of many videos with a single query.
+
+        The popular video listings are sorted by the view counts in the
+        index, so they're reindexed in bulk whenever the statistic is
+        migrated (see update_search_index_for_qs).
+
+        """
+        videos = list(videos)
+        Video.prefetch_views(videos)
+        return videos
+
     @classmethod
     def public(self):
         """
@@ -29,14 +29,14 @@ from django.db.models import ObjectDoesNotExist
 from haystack import site
 from raven.contrib.django.models import client
 
-from messages.models import Message
+from messages.tasks import create_messages, send_templated_email_to_many
 from utils import send_templated_email, DEFAULT_PROTOCOL
+from utils import rowcounts
 from utils.metrics import Gauge, Meter
 from videos.models import VideoFeed, Video
 from subtitles.models import (
     SubtitleLanguage, SubtitleVersion, get_caption_diff_data
 )
-from videos.feed_parser import FeedParser
 
 celery_logger = logging.getLogger('celery.task')
 
@@ -188,52 +188,25 @@ def send_change_title_email(video_id, user_id, old_title, new_title):
 @task()
 def import_videos_from_feeds(urls, user_id=None, team_id=None):
     from auth.models import CustomUser as User
-    from teams.models import Team, TeamVideo
+    from teams.models import Team
     from messages import tasks as notifier
-    from teams.signals import api_teamvideo_new
     from teams.permissions import can_add_video
+    from videos.feed_import import FeedImporter
 
     try:
         user = User.objects.get(id=user_id)
     except ObjectDoesNotExist:
         user = None
 
-    videos = []
-    last_entry = dict()
-
-    for url in urls:
-        feed_parser = FeedParser(url)
-
-        for vt, info, entry in feed_parser.items():
-            if not vt: 
-                continue
-
-            videos.append(Video.get_or_create_for_url(vt=vt, user=user))
-            last_entry = entry
-        else:
-            _save_video_feed(url, last_entry.get('link', ''), user)
-
     try:
         team = Team.objects.get(id=team_id)
-        project = team.default_project
 
         if not can_add_video(team, user):
             team = None
     except Team.DoesNotExist:
         team = None
 
-    if team and user:
-        for video, created in videos:
-            try:
-                tv = TeamVideo.objects.get(video=video, team=team)
-            except TeamVideo.DoesNotExist:
-                tv = TeamVideo(video=video, team=team, added_by=user,
-                               project=project)
-                tv.title = video.title
-                tv.description = video.description
-                tv.save()
-
-                api_teamvideo_new.send(tv)
+    videos = FeedImporter(user=user, team=team).run(urls)
 
     if user:
         notifier.videos_imported_message.delay(user_id, len(videos))
@@ -287,6 +260,8 @@ def _make_caption_data(new_version, old_version):
 
 
 def _send_letter_caption(caption_version):
+    from auth.models import CustomUser as User
+
     domain = Site.objects.get_current().domain
 
     language = caption_version.subtitle_language
@@ -338,7 +313,12 @@ def _send_letter_caption(caption_version):
     followers = set(video.notification_list(caption_version.author))
     followers.update(language.notification_list(caption_version.author))
 
-    for item in qs:
+    # Everything but the editor-specific bits, for the followers that didn't
+    # edit the subtitles themselves.
+    shared_context = dict(context)
+
+    editors_to_message = []
+    for item in qs.select_related('author'):
         if item.author and item.author in followers:
             if item.author.notify_by_email:
                 context['your_version'] = item
@@ -350,20 +330,18 @@ def _send_letter_caption(caption_version):
                                  'videos/email_notification.html',
                                  context, fail_silently=not settings.DEBUG)
             if item.author.notify_by_message:
-                # TODO: Add body
-                Message.objects.create(user=item.author, subject=subject,
-                        content='')
+                editors_to_message.append(item.author)
 
             followers.discard(item.author)
 
-    for user in followers:
-        context['user'] = user
-        context['hash'] = user.hash_for_video(context['video'].video_id)
-        context['user_is_rtl'] = user.guess_is_rtl()
-        Meter('templated-emails-sent-by-type.videos.new-edits-non-editors').inc()
-        send_templated_email(user, subject,
-                             'videos/email_notification_non_editors.html',
-                             context, fail_silently=not settings.DEBUG)
+    # TODO: Add body
+    create_messages(editors_to_message, subject, content='')
+
+    sent = send_templated_email_to_many(
+        User.objects.filter(pk__in=[u.pk for u in followers]), subject,
+        'videos/email_notification_non_editors.html', shared_context,
+        video.video_id)
+    Meter('templated-emails-sent-by-type.videos.new-edits-non-editors').inc(sent)
 
 
 def _update_captions_in_original_service(version_pk):
@@ -406,7 +384,7 @@ def delete_captions_in_original_service(language_pk):
         return
     
     ThirdPartyAccount.objects.mirror_on_third_party(
-        language.video, language.language, DELETE_LANGUAGE_ACTION)
+        language.video, language.language_code, DELETE_LANGUAGE_ACTION)
 
 @task
 def delete_captions_in_original_service_by_code(language_code, video_pk):
@@ -428,21 +406,16 @@ def delete_captions_in_original_service_by_code(language_code, video_pk):
     ThirdPartyAccount.objects.mirror_on_third_party(
         video, language_code, DELETE_LANGUAGE_ACTION)
 
-def _save_video_feed(feed_url, last_entry_url, user):
-    """ Creates or updates a videofeed given some url """
-    try:
-        vf = VideoFeed.objects.get(url=feed_url)
-    except VideoFeed.DoesNotExist:
-        vf = VideoFeed(url=feed_url)
 
-    vf.user = user
-    vf.last_link = last_entry_url
-    vf.save()
+@periodic_task(run_every=crontab(minute=30))
+def build_sitemaps():
+    from sitemaps import SitemapBuilder
+
+    SitemapBuilder().build()
 
 
 @periodic_task(run_every=timedelta(seconds=5))
 def gauge_videos():
-    Gauge('videos.Video').report(Video.objects.count())
-    Gauge('videos.Video-captioned').report(Video.objects.exclude(newsubtitlelanguage_set=None).count())
-    Gauge('videos.SubtitleVersion').report(SubtitleVersion.objects.count())
-    Gauge('videos.SubtitleLanguage').report(SubtitleLanguage.objects.count())
+    for name in ('videos.Video', 'videos.Video-captioned',
+                 'videos.SubtitleVersion', 'videos.SubtitleLanguage'):
+        Gauge(name).report(rowcounts.value(name))
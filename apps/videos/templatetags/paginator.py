@@ -15,8 +15,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see 
 # http://www.gnu.org/licenses/agpl-3.0.html.
+import base64
+import json
+
 from django import template
 from django.core.paginator import Paginator, EmptyPage
+from django.db.models import Q
 
 register = template.Library()
 
@@ -48,6 +52,83 @@ def paginate(items, per_page, page):
         'previous': page_obj.previous_page_number(),
     }
 
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps([unicode(v) for v in values]))
+
+def _decode_cursor(model, fields, cursor):
+    """Return the values encoded in a cursor, or None if it's not valid."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if len(values) != len(fields):
+            return None
+        return [model._meta.get_field(name).to_python(value)
+                for (name, desc), value in zip(fields, values)]
+    except Exception:
+        return None
+
+def _keyset_filter(fields, values, forwards):
+    """Return a Q matching the rows after (or before) the given sort values."""
+    q = None
+    for i, (name, desc) in enumerate(fields):
+        lookup = 'lt' if desc == forwards else 'gt'
+        clause = Q(**{'%s__%s' % (name, lookup): values[i]})
+        for (prior, _), value in zip(fields[:i], values[:i]):
+            clause &= Q(**{prior: value})
+        q = clause if q is None else q | clause
+    return q
+
+def keyset_paginate(items, order_by, per_page, after=None, before=None):
+    """Paginate a queryset by seeking past the last row shown, not by OFFSET.
+
+    `order_by` is a list of field names like for QuerySet.order_by.  The
+    fields must never be NULL and, taken together, must identify one row, so
+    end it with 'id'.  `after` and `before` are the cursors from the
+    pagination info of a previous call.
+
+    Unlike paginate() this doesn't count the rows or number the pages, but
+    each page costs the same however deep into the list it is.  It returns
+    the list of items on the page and the pagination info for the template.
+
+    """
+    fields = [(f.lstrip('-'), f.startswith('-')) for f in order_by]
+    forwards = bool(after) or not before
+    cursor = _decode_cursor(items.model, fields, after if forwards else before)
+    if cursor is None:
+        forwards = True
+    else:
+        items = items.filter(_keyset_filter(fields, cursor, forwards))
+
+    if forwards:
+        items = items.order_by(*order_by)
+    else:
+        items = items.order_by(*[f[1:] if f.startswith('-') else '-' + f
+                                 for f in order_by])
+
+    page = list(items[:per_page + 1])
+    more = len(page) > per_page
+    page = page[:per_page]
+    if not forwards:
+        page.reverse()
+
+    def cursor_for(item):
+        return _encode_cursor([getattr(item, name) for name, desc in fields])
+
+    if not page:
+        has_next = has_previous = False
+    elif forwards:
+        has_next, has_previous = more, cursor is not None
+    else:
+        has_next, has_previous = cursor is not None, more
+
+    return page, {
+        'has_next': has_next,
+        'has_previous': has_previous,
+        'is_paginated': has_next or has_previous,
+        'next_cursor': cursor_for(page[-1]) if page else None,
+        'previous_cursor': cursor_for(page[0]) if page else None,
+        'results_per_page': per_page,
+    }
+
 def paginator(context, anchor='', adjacent_pages=3):
     """
     To be used in conjunction with the object_list generic view.
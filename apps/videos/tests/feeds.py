@@ -17,14 +17,18 @@
 # along with this program. If not, see
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
+import os
 import feedparser
 from StringIO import StringIO
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
+from apps.auth.models import CustomUser as User
+from apps.teams.models import Team, TeamVideo
+from apps.videos.feed_import import FeedImporter, STAGES
 from apps.videos.feed_parser import FeedParser
-from apps.videos.models import Video, VideoFeed
+from apps.videos.models import Video, VideoFeed, VideoUrl
 from apps.videos.types.vimeo import VimeoVideoType
 
 
@@ -89,6 +93,68 @@ class TestFeedsSubmit(TestCase):
 
         feedparser._open_resource = base_open_resource
 
+class TestFeedImporter(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='importer',
+                                        notify_by_message=True)
+        self.team = Team.objects.create(name='Importers', slug='importers')
+        self.lectures = self._feed('feed-lectures.rss')
+        self.highlights = self._feed('feed-highlights.rss')
+
+    def _feed(self, filename):
+        return os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            'fixtures', filename)
+
+    def _url(self, video):
+        return VideoUrl.objects.get(video=video, primary=True).url
+
+    def test_import(self):
+        existing, _ = Video.get_or_create_for_url(
+            'http://example.com/lectures/lecture-1.mp4')
+
+        importer = FeedImporter(user=self.user, team=self.team, workers=2)
+        videos = importer.run([self.lectures, self.highlights])
+
+        # Oldest entries first, and lecture 2 only once even though it's in
+        # both feeds.
+        self.assertEqual([self._url(video) for video, created in videos], [
+            'http://example.com/lectures/lecture-1.mp4',
+            'http://example.com/lectures/lecture-2.mp4',
+            'http://example.com/lectures/lecture-3.mp4',
+            'http://example.com/highlights/interview.webm',
+        ])
+        self.assertEqual(videos[0], (existing, False))
+        self.assertEqual([created for video, created in videos[1:]],
+                         [True, True, True])
+
+        for video, created in videos[1:]:
+            self.assertEqual(video.user, self.user)
+            self.assertTrue(video.video_id)
+            self.assertTrue(video.followers.filter(pk=self.user.pk).exists())
+
+        self.assertEqual(len(importer.team_videos), 4)
+        self.assertEqual(
+            set(TeamVideo.objects.filter(team=self.team)
+                                 .values_list('video_id', flat=True)),
+            set(video.pk for video, created in videos))
+        self.assertEqual(set(importer.timings), set(STAGES))
+
+        self.assertEqual(VideoFeed.objects.get(url=self.lectures).last_link,
+                         'http://example.com/lectures/lecture-3.mp4')
+
+    def test_reimport(self):
+        FeedImporter(user=self.user, team=self.team).run([self.lectures])
+        video_count = Video.objects.count()
+
+        importer = FeedImporter(user=self.user, team=self.team)
+        videos = importer.run([self.lectures, self.highlights])
+
+        self.assertEqual([created for video, created in videos],
+                         [False, False, False, True])
+        self.assertEqual(Video.objects.count(), video_count + 1)
+        self.assertEqual(len(importer.team_videos), 1)
+        self.assertEqual(TeamVideo.objects.filter(team=self.team).count(), 4)
+
 class TestFeedParser(TestCase):
     # TODO: add test for MediaFeedEntryParser. I just can't find RSS link for it
     # RSS should look like this http://www.dailymotion.com/rss/ru/featured/channel/tech/1
@@ -309,6 +309,86 @@ class VideoTypeRegistrarTest(TestCase):
         self.assertRaises(VideoTypeError, video_type_registrar.video_type_for_url,
                           'http://youtube.com/v=100500')
 
+    def _make_registrar(self):
+        registrar = VideoTypeRegistrar()
+        tried = []
+
+        class HostVideoType(VideoType):
+            abbreviation = 'host'
+            name = 'Host'
+            hosts = ('example.com',)
+            created = []
+
+            def __init__(self, url):
+                if url.endswith('/bad'):
+                    raise VideoTypeError('bad video')
+                self.url = url
+                self.created.append(url)
+
+            @property
+            def video_id(self):
+                return self.convert_to_video_url().rsplit('/', 1)[-1]
+
+            @classmethod
+            def matches_video_url(cls, url):
+                tried.append((cls.abbreviation, url))
+                return True
+
+        class AnyHostVideoType(VideoType):
+            abbreviation = 'any'
+            name = 'Any'
+
+            @classmethod
+            def matches_video_url(cls, url):
+                tried.append((cls.abbreviation, url))
+                return url.endswith('.mp4')
+
+        registrar.register(HostVideoType)
+        registrar.register(AnyHostVideoType)
+        return registrar, HostVideoType, AnyHostVideoType, tried
+
+    def test_dispatch_by_host(self):
+        registrar, HostVideoType, AnyHostVideoType, tried = \
+                self._make_registrar()
+
+        self.assertEqual(registrar.match('http://www.example.com/1'),
+                         HostVideoType)
+        self.assertEqual(registrar.match('http://other.com/1.mp4'),
+                         AnyHostVideoType)
+        self.assertEqual(registrar.match('http://notexample.com/1'), None)
+        self.assertEqual(registrar.match(''), None)
+
+        # The host type is never tried for URLs on other hosts.
+        self.assertFalse(('host', 'http://other.com/1.mp4') in tried)
+        self.assertFalse(('host', 'http://notexample.com/1') in tried)
+
+        self.assertEqual(video_type_registrar.match(
+            'http://example.com/video.mp4'), HtmlFiveVideoType)
+        self.assertEqual(video_type_registrar.match(
+            'http://vimeo.com/22070806'), VimeoVideoType)
+        self.assertEqual(video_type_registrar.match(
+            'http://example.com/page.html'), None)
+
+    def test_resolve(self):
+        registrar, HostVideoType, AnyHostVideoType, tried = \
+                self._make_registrar()
+
+        self.assertEqual(registrar.resolve('http://example.com/a?x=1'),
+                         (HostVideoType, 'http://example.com/a', 'a'))
+        self.assertEqual(registrar.resolve('http://other.com/b.mp4'),
+                         (AnyHostVideoType, 'http://other.com/b.mp4', None))
+        self.assertEqual(registrar.resolve('http://other.com/page'), None)
+        self.assertRaises(VideoTypeError, registrar.resolve,
+                          'http://example.com/bad')
+        self.assertEqual(HostVideoType.created, ['http://example.com/a?x=1'])
+
+        # Resolved URLs are cached.
+        del tried[:]
+        self.assertEqual(registrar.resolve('http://example.com/a?x=1'),
+                         (HostVideoType, 'http://example.com/a', 'a'))
+        self.assertEqual(tried, [])
+        self.assertEqual(len(HostVideoType.created), 1)
+
 class BrightcoveVideoTypeTest(TestCase):
     def setUp(self):
         self.vt = BrightcoveVideoType
@@ -18,10 +18,14 @@
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
 from datetime import datetime
+import gzip
 import json
+import shutil
+import tempfile
 
 from django.core import mail
 from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
 from django.core.urlresolvers import reverse
 from django.db.models import ObjectDoesNotExist
 from vidscraper.sites import blip
@@ -39,6 +43,7 @@ from apps.videos.tests.data import (
 )
 from apps.widget import video_cache
 from apps.widget.tests import create_two_sub_session, RequestMockup
+from sitemaps import SitemapBuilder
 
 
 class TestViews(WebUseTest):
@@ -417,3 +422,57 @@ class TestViews(WebUseTest):
             response = self.client.post(url)
             self.assertEqual(response.status_code, 200)
 
+
+class TestSitemapBuilder(WebUseTest):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(self.dir)
+        self.builder = SitemapBuilder(storage=self.storage, shard_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read(self, name):
+        return gzip.GzipFile(fileobj=self.storage.open(name)).read()
+
+    def test_shards(self):
+        expected = {}
+        for pk in Video.objects.values_list('pk', flat=True):
+            shard = str(pk // 2)
+            expected[shard] = expected.get(shard, 0) + 1
+
+        shards = dict(self.builder.shards())
+        self.assertEqual(dict((shard, fingerprint[0])
+                              for shard, fingerprint in shards.items()),
+                         expected)
+
+    def test_write_replaces_file(self):
+        self.builder._write('sitemaps/test.xml.gz', 'old')
+        self.builder._write('sitemaps/test.xml.gz', 'new')
+        self.assertEqual(self.storage.open('sitemaps/test.xml.gz').read(),
+                         'new')
+        self.assertEqual(self.storage.listdir('sitemaps')[1],
+                         ['test.xml.gz'])
+
+    def test_build(self):
+        shards = dict(self.builder.shards())
+        self.assertEqual(self.builder.build(), len(shards))
+
+        video = Video.objects.order_by('pk')[0]
+        shard = str(video.pk // 2)
+        self.assertTrue(video.video_id in
+                        self._read('sitemaps/video-%s.xml.gz' % shard))
+        self.assertTrue('?p=%s' % shard in
+                        self._read('sitemaps/sitemap.xml.gz'))
+
+        # Nothing changed, so nothing is rebuilt.
+        self.assertEqual(self.builder.build(), 0)
+
+        # Saving a video only rebuilds its shard.
+        video.title = 'New title'
+        video.save()
+        self.assertEqual(self.builder.build(), 1)
+
+        self.assertEqual(self.builder.build(force=True), len(shards))
@@ -17,12 +17,21 @@
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
 from urlparse import urlparse
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
+from apps.subtitles.cache import LRUCache
+
+RESOLVE_CACHE_SIZE = getattr(settings, 'VIDEO_TYPE_CACHE_SIZE', 1000)
+
 class VideoType(object):
 
     abbreviation = None
     name = None    
+    # The hosts this type's URLs are on; subdomains are included.  None means
+    # URLs on any host can match (e.g. by file extension).
+    hosts = None
     
     def __init__(self, url):
         self.url = url
@@ -51,32 +60,111 @@ class VideoType(object):
     def create_kwars(self):
         return { 'url': self.convert_to_video_url() } 
     
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
+        """Fill in the title, description, etc. of a video from the provider.
+
+        This must not save the video or touch the database in any other way,
+        so that it can run in a worker thread (see videos.feed_import).
+
+        """
         return video_obj
+
+    def set_values(self, video_obj):
+        return self.fetch_values(video_obj)
+
+    def video_created(self, video_obj):
+        """Called once a new video for this type has been saved."""
+        pass
     
     @classmethod
     def format_url(cls, url):
         parsed_url = urlparse(url)
         return '%s://%s%s' % (parsed_url.scheme or 'http', parsed_url.netloc, parsed_url.path)    
     
+def _host(url):
+    netloc = urlparse(url).netloc.lower()
+    return netloc.rsplit('@', 1)[-1].split(':', 1)[0]
+
 class VideoTypeRegistrar(dict):
-    
+    """The registered video types, by abbreviation.
+
+    Looking up the type for a URL goes through an index of the hosts each type
+    declares in `hosts`, so that only the types that could possibly match are
+    tried (plus the ones like HTML5 that match URLs on any host).  Successful
+    lookups are also remembered in a small LRU, keyed by URL.
+
+    """
     domains = []
     
     def __init__(self, *args, **kwargs):
         super(VideoTypeRegistrar, self).__init__(*args, **kwargs)
         self.choices = []
+        self._by_host = {}
+        self._any_host = []
+        self._order = {}
+        self._resolved = LRUCache(RESOLVE_CACHE_SIZE)
         
     def register(self, video_type):
         self[video_type.abbreviation] = video_type
         self.choices.append((video_type.abbreviation, video_type.name))
         domain = getattr(video_type, 'site', None)
         domain and self.domains.append(domain)
-        
-    def video_type_for_url(self, url):
-        for video_type in self.itervalues():
+
+        if video_type.hosts:
+            for host in video_type.hosts:
+                self._by_host.setdefault(host, []).append(video_type)
+        else:
+            self._any_host.append(video_type)
+        # Try the candidates in the same order as iterating over all the types
+        # would, so that the index doesn't change which type wins.
+        self._order = dict((vt, i) for i, vt in enumerate(self.itervalues()))
+        self._resolved.clear()
+
+    def _candidates(self, url):
+        labels = _host(url).split('.')
+        candidates = set(self._any_host)
+        for i in xrange(len(labels)):
+            candidates.update(self._by_host.get('.'.join(labels[i:]), ()))
+        return sorted(candidates, key=self._order.get)
+
+    def match(self, url):
+        """Return the VideoType class for a URL, or None.
+
+        Unlike video_type_for_url this doesn't build an instance, which for
+        some types means a request to the provider.
+
+        """
+        if not url:
+            return None
+        resolved = self._resolved.get(url)
+        if resolved:
+            return resolved[0]
+        for video_type in self._candidates(url):
             if video_type.matches_video_url(url):
-                return video_type(url)
+                return video_type
+
+    def video_type_for_url(self, url):
+        video_type = self.match(url)
+        if video_type:
+            vt = video_type(url)
+            self._resolved.set(url, (video_type, vt.convert_to_video_url(),
+                                     vt.video_id))
+            return vt
+
+    def resolve(self, url):
+        """Return (VideoType class, normalized URL, video id) for a URL.
+
+        Returns None if no type matches.  Results are cached, so resolving the
+        same URL again is cheap.
+
+        """
+        resolved = self._resolved.get(url) if url else None
+        if resolved is None and self.video_type_for_url(url):
+            resolved = self._resolved.get(url)
+        return resolved
+
+    def clear_cache(self):
+        self._resolved.clear()
             
 class VideoTypeError(Exception):
     pass
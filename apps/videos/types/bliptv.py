@@ -30,6 +30,7 @@ class BlipTvVideoType(VideoType):
     abbreviation = 'B'
     name = 'Blip.tv'  
     site = 'blip.tv'
+    hosts = ('blip.tv',)
 
     pattern = re.compile(r"^https?://blip.tv/(?P<subsite>[a-zA-Z0-9-]+)/(?P<file_id>[a-zA-Z0-9-]+)/?$")
     
@@ -55,7 +56,7 @@ class BlipTvVideoType(VideoType):
     def create_kwars(self):
         return {'videoid': self.video_id}
 
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         json = self.json
 
         if 'title' in json:
@@ -70,8 +71,6 @@ class BlipTvVideoType(VideoType):
         if 'thumbnailUrl' in json:
             video_obj.thumbnail = json['thumbnailUrl']
 
-        video_obj.save()
-
         return video_obj
 
     def _parse_url(self):
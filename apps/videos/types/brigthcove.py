@@ -40,6 +40,7 @@ class BrightcoveVideoType(VideoType):
     abbreviation = 'C'
     name = 'Brightcove'   
     site = 'brightcove.com'
+    hosts = ('brightcove.com', 'bcove.me')
     js_url = "http://admin.brightcove.com/js/BrightcoveExperiences_all.js"
     
     def __init__(self, url):
@@ -81,7 +82,7 @@ class BrightcoveVideoType(VideoType):
     def create_kwars(self):
         return { 'videoid': self.id }
     
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         # FIXME:
         # brighcove api is not available until you spend at least 499 / month. ?!
         # maybe we can grab this over the client and send it to the backend?
@@ -30,6 +30,7 @@ class DailymotionVideoType(VideoType):
     abbreviation = 'D'
     name = 'dailymotion.com'
     site = 'dailymotion.com'
+    hosts = ('dailymotion.com',)
 
     def __init__(self, url):
         self.url = url
@@ -59,7 +60,7 @@ class DailymotionVideoType(VideoType):
     def create_kwars(self):
         return {'videoid': self.video_id}
 
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         metadata = self.get_metadata(self.video_id)
         video_obj.description = metadata.get('description', u'')
         video_obj.title = metadata.get('title', '')
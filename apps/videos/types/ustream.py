@@ -24,6 +24,7 @@ class UstreamVideoType(VideoType):
     abbreviation = 'U'
     name = 'Ustream.tv'   
     site = 'ustream.tv'
+    hosts = ('ustream.tv',)
     
     def __init__(self, url):
         self.url = url
@@ -39,7 +40,7 @@ class UstreamVideoType(VideoType):
     def create_kwars(self):
         return { 'url': self.video_url }
     
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         video_obj.title = ustream.get_title(self.url)
         video_obj.description = ustream.get_description(self.url)
         video_obj.thumbnail = ustream.get_thumbnail_url(self.url)
@@ -24,6 +24,7 @@ class GoogleVideoType(VideoType):
     abbreviation = 'G'
     name = 'video.google.com'   
     site = 'video.google.com'
+    hosts = ('video.google.com',)
     
     def convert_to_video_url(self):
         return self.format_url(self.url)
@@ -35,7 +36,7 @@ class GoogleVideoType(VideoType):
     def create_kwars(self):
         return { 'url': self.format_url(self.url) }
     
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         video_obj.title = google_video.scrape_title(self.url)
         video_obj.description = google_video.scrape_description(self.url)
         raise Warning('GoogleVideoType does not support thumbnail loading')
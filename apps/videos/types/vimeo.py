@@ -30,6 +30,7 @@ class VimeoVideoType(VideoType):
     abbreviation = 'V'
     name = 'Vimeo.com'   
     site = 'vimeo.com'
+    hosts = ('vimeo.com',)
     
     def __init__(self, url):
         self.url = url
@@ -66,14 +67,13 @@ class VimeoVideoType(VideoType):
     def create_kwars(self):
         return { 'videoid': self.videoid }
     
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         if vimeo.VIMEO_API_KEY and vimeo.VIMEO_API_SECRET:
             try:
                 video_obj.thumbnail = vimeo.get_thumbnail_url(self.url, self.shortmem) or ''
                 video_obj.small_thumbnail = vimeo.get_small_thumbnail_url(self.url, self.shortmem) or ''
                 video_obj.title = vimeo.scrape_title(self.url, self.shortmem)
                 video_obj.description = strip_tags(vimeo.scrape_description(self.url, self.shortmem))
-                video_obj.save()
             except Exception:
                 # in case the Vimeo video is private.
                 pass
@@ -111,6 +111,7 @@ class YoutubeVideoType(VideoType):
     abbreviation = 'Y'
     name = 'Youtube'
     site = 'youtube.com'
+    hosts = ('youtube.com', 'youtu.be')
 
     # changing this will cause havock, let's talks about this first
     URL_TEMPLATE = 'http://www.youtube.com/watch?v=%s'
@@ -148,7 +149,7 @@ class YoutubeVideoType(VideoType):
     def create_kwars(self):
         return {'videoid': self.video_id}
 
-    def set_values(self, video_obj):
+    def fetch_values(self, video_obj):
         video_obj.title = self.entry.media.title.text or ''
         if self.entry.media.description:
             video_obj.description = self.entry.media.description.text or ''
@@ -159,15 +160,20 @@ class YoutubeVideoType(VideoType):
             thumbnail = max([(int(t.height), t) for t in self.entry.media.thumbnail]) 
             video_obj.thumbnail = thumbnail[1].url
         video_obj.small_thumbnail = 'http://i.ytimg.com/vi/%s/default.jpg' % self.video_id
+        return video_obj
+
+    def set_values(self, video_obj):
+        self.fetch_values(video_obj)
         video_obj.save()
+        self.video_created(video_obj)
+        return video_obj
 
+    def video_created(self, video_obj):
         try:
             self.get_subtitles(video_obj)
         except :
             logger.exception("Error getting subs from youtube:" )
 
-        return video_obj
-
     def _get_entry(self, video_id):
         try:
             return yt_service.GetYouTubeVideoEntry(video_id=str(video_id))
@@ -344,7 +350,7 @@ class YouTubeApiBridge(gdata.youtube.client.YouTubeClient):
         # TODO: The language_code here is in "unisubs" and should be encoded
         # to bcp47.
         content, title, language_code = \
-                self._prepare_subtitle_data_for_version(subtitle_version)
+                _prepare_subtitle_data_for_version(subtitle_version)
 
         if hasattr(self, "captions") is False:
             self._get_captions_info()
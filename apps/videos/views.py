@@ -715,11 +715,12 @@ def video_debug(request, video_id):
         get_subtitles_dict[l.language] = cache.get(cache_key)
     cache = {
         "get_video_urls": cache.get(vc._video_urls_key(vid)),
+        "get_widget_bundle": cache.get(vc._widget_bundle_key(vid)),
         "get_subtitles_dict": get_subtitles_dict,
         "get_video_languages": cache.get(vc._video_languages_key(vid)),
 
         "get_video_languages_verbose": cache.get(vc._video_languages_verbose_key(vid)),
-        "writelocked_langs": cache.get(vc._video_writelocked_langs_key(vid)),
+        "writelocked_langs": vc.writelocked_langs(vid),
     }
     tasks = Task.objects.filter(team_video=video)
 
@@ -0,0 +1,136 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test.client import RequestFactory
+
+from videos.models import Video
+from widget import video_cache
+from widget.rpc import Rpc
+
+
+CACHE_METHODS = ('get', 'get_many', 'set', 'set_many', 'add', 'incr',
+                 'delete', 'delete_many')
+
+class CacheCounter(object):
+    """Count the calls made to a cache object, one per round trip."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = {}
+
+    def _wrap(self, name, method):
+        def wrapper(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        for name in CACHE_METHODS:
+            setattr(self.cache, name, self._wrap(name, getattr(self.cache, name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name in CACHE_METHODS:
+            delattr(self.cache, name)
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+class Command(BaseCommand):
+    args = '<video_id>'
+    help = ('Call Rpc.show_widget for a video and print how many cache and '
+            'database round trips it takes, both cold and warm.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--language', action='store', dest='language',
+                    default=None,
+                    help='Language code to autoplay, as the embedder would.'),
+        make_option('--runs', action='store', dest='runs', type='int',
+                    default=10, help='Number of warm calls to average over.'),
+    )
+
+    def _request(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request.session = {}
+        request.browser_id = 'benchmark'
+        return request
+
+    def _show_widget(self, rpc, video_url, base_state):
+        reset_queries()
+        with CacheCounter(video_cache.cache) as counter:
+            start = time.time()
+            rpc.show_widget(self._request(), video_url, False, base_state)
+            elapsed = time.time() - start
+
+        return counter, len(connection.queries), elapsed
+
+    def _report(self, label, counter, queries, elapsed):
+        calls = ', '.join('%s: %s' % item for item in sorted(counter.calls.items()))
+        print '%s: %s cache round trips (%s), %s queries, %.1fms' % (
+            label, counter.total, calls, queries, elapsed * 1000)
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: benchmark_show_widget <video_id>')
+        if options['runs'] < 1:
+            raise CommandError('--runs must be at least 1')
+
+        try:
+            video = Video.objects.get(video_id=args[0])
+        except Video.DoesNotExist:
+            raise CommandError('No video with id %s' % args[0])
+
+        video_url = video.get_video_url()
+        base_state = None
+        if options['language']:
+            base_state = {'language_code': options['language']}
+
+        rpc = Rpc()
+
+        # Queries are only logged when DEBUG is on.
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        try:
+            video_cache.invalidate_cache(video.video_id)
+            self._report('Cold', *self._show_widget(rpc, video_url, base_state))
+
+            total_calls = total_queries = total_time = 0
+            for i in xrange(options['runs']):
+                counter, queries, elapsed = self._show_widget(rpc, video_url,
+                                                              base_state)
+                total_calls += counter.total
+                total_queries += queries
+                total_time += elapsed
+            self._report('Warm (last run)', counter, queries, elapsed)
+        finally:
+            settings.DEBUG = old_debug
+            reset_queries()
+
+        runs = float(options['runs'])
+        print 'Warm average: %.1f cache round trips, %.1f queries, %.1fms' % (
+            total_calls / runs, total_queries / runs, total_time / runs * 1000)
@@ -23,7 +23,7 @@ from django.db.models import Sum, Q
 from django.utils import translation
 from django.utils.translation import ugettext as _
 
-from statistic.tasks import st_widget_view_statistic_update
+from statistic import buffer as statistic_buffer, st_widget_view_statistic
 from subtitles import models as new_models
 from teams.models import Task, Workflow, Team
 from teams.permissions import (
@@ -99,22 +99,20 @@ class Rpc(BaseRpc):
 
 
     # Widget
-    def _check_visibility_policy_for_widget(self, request, video_id):
+    def _check_visibility_policy_for_widget(self, request, visibility_policy):
         """Return an error if the user cannot see the widget, None otherwise."""
 
-        visibility_policy = video_cache.get_visibility_policies(video_id)
-
         if not visibility_policy.get("is_public", True):
             team = Team.objects.get(id=visibility_policy['team_id'])
 
             if not team.is_member(request.user):
                 return {"error_msg": _("Video embedding disabled by owner")}
 
-    def _get_video_urls_for_widget(self, video_url, video_id):
-        """Return the video URLs, 'cleaned' video id, and error."""
+    def _get_widget_bundle(self, video_url, video_id):
+        """Return the widget bundle, 'cleaned' video id, and error."""
 
         try:
-            video_urls = video_cache.get_video_urls(video_id)
+            bundle = video_cache.get_widget_bundle(video_id)
         except models.Video.DoesNotExist:
             video_cache.invalidate_video_id(video_url)
 
@@ -123,9 +121,9 @@ class Rpc(BaseRpc):
             except Exception as e:
                 return None, None, {"error_msg": unicode(e)}
 
-            video_urls = video_cache.get_video_urls(video_id)
+            bundle = video_cache.get_widget_bundle(video_id)
 
-        return video_urls, video_id, None
+        return bundle, video_id, None
 
     def _find_remote_autoplay_language(self, request):
         language = None
@@ -135,7 +133,7 @@ class Rpc(BaseRpc):
             language = request.user.preferred_language
         return language if language != '' else None
 
-    def _get_subtitles_for_widget(self, request, base_state, video_id, is_remote):
+    def _get_subtitles_for_widget(self, request, base_state, bundle, video_id, is_remote):
         # keeping both forms valid as backwards compatibility layer
         lang_code = base_state and base_state.get("language_code", base_state.get("language", None))
 
@@ -143,18 +141,20 @@ class Rpc(BaseRpc):
             lang_pk = base_state.get('language_pk', None)
 
             if lang_pk is  None:
-                lang_pk = video_cache.pk_for_default_language(video_id, lang_code)
+                lang_pk = video_cache.bundle_language_pk(bundle, lang_code)
 
             return self._autoplay_subtitles(request.user, video_id, lang_pk,
-                                            base_state.get('revision', None))
+                                            base_state.get('revision', None),
+                                            bundle['generation'])
         else:
             if is_remote:
                 autoplay_language = self._find_remote_autoplay_language(request)
-                language_pk = video_cache.pk_for_default_language(video_id, autoplay_language)
+                language_pk = video_cache.bundle_language_pk(bundle, autoplay_language)
 
                 if autoplay_language is not None:
                     return self._autoplay_subtitles(request.user, video_id,
-                                                    language_pk, None)
+                                                    language_pk, None,
+                                                    bundle['generation'])
 
     def show_widget(self, request, video_url, is_remote, base_state=None, additional_video_urls=None):
         try:
@@ -166,12 +166,13 @@ class Rpc(BaseRpc):
         if video_id is None:
             return None
 
-        error = self._check_visibility_policy_for_widget(request, video_id)
+        bundle, video_id, error = self._get_widget_bundle(video_url, video_id)
 
         if error:
             return error
 
-        video_urls, video_id, error = self._get_video_urls_for_widget(video_url, video_id)
+        error = self._check_visibility_policy_for_widget(
+            request, bundle['visibility_policy'])
 
         if error:
             return error
@@ -179,8 +180,8 @@ class Rpc(BaseRpc):
         resp = {
             'video_id' : video_id,
             'subtitles': None,
-            'video_urls': video_urls,
-            'is_moderated': video_cache.get_is_moderated(video_id),
+            'video_urls': bundle['video_urls'],
+            'is_moderated': bundle['is_moderated'],
         }
 
         if additional_video_urls is not None:
@@ -192,16 +193,17 @@ class Rpc(BaseRpc):
         if request.user.is_authenticated():
             resp['username'] = request.user.username
 
-        resp['drop_down_contents'] = video_cache.get_video_languages(video_id)
+        resp['drop_down_contents'] = bundle['languages']
         resp['my_languages'] = get_user_languages_from_request(request)
         resp['subtitles'] = self._get_subtitles_for_widget(request, base_state,
-                                                           video_id, is_remote)
+                                                           bundle, video_id,
+                                                           is_remote)
         return resp
 
 
     # Statistics
     def track_subtitle_play(self, request, video_id):
-        st_widget_view_statistic_update.delay(video_id=video_id)
+        statistic_buffer.count(st_widget_view_statistic, video_id=video_id)
         return { 'response': 'ok' }
 
 
@@ -242,8 +244,9 @@ class Rpc(BaseRpc):
         my_languages.extend([l[:l.find('-')] for l in my_languages if l.find('-') > -1])
         video = models.Video.objects.get(video_id=video_id)
         team_video = video.get_team_video()
-        video_languages = [language_summary(l, team_video, request.user) for l
-                           in video.newsubtitlelanguage_set.all()]
+        video_languages = language_summaries(
+            list(video.newsubtitlelanguage_set.all()), team_video, request.user,
+            video=video)
 
         original_language = None
         if video.subtitle_language():
@@ -408,9 +411,11 @@ class Rpc(BaseRpc):
         if locked:
             return locked
 
-        # just lock the video *after* we verify if team moderation happened
-        language.writelock(request.user, request.browser_id)
-        language.save()
+        # just lock the video *after* we verify if team moderation happened.
+        # Someone else may have taken the lock since can_writelock().
+        if not language.writelock(request.user, request.browser_id):
+            return { "can_edit": False,
+                     "locked_by": unicode(language.get_writelock_owner()) }
 
         # Create the subtitling session and subtitle version for these edits.
         session = self._make_subtitling_session(request, language, base_language_code, video_id)
@@ -458,9 +463,6 @@ class Rpc(BaseRpc):
         if original_language_code:
             self._save_original_language(video_id, original_language_code)
 
-        # Writelock this language for this video before we successfully return.
-        video_cache.writelock_add_lang(video_id, language.language_code)
-
         return return_dict
 
 
@@ -478,9 +480,8 @@ class Rpc(BaseRpc):
             return {'response': 'cannot_resume'}
 
         if language.can_writelock(request.browser_id) and \
-                session.parent_version == language.version():
-
-            language.writelock(request.user, request.browser_id)
+                session.parent_version == language.version() and \
+                language.writelock(request.user, request.browser_id):
 
             version_for_subs, version_number = self._get_version_to_edit(language, session)
 
@@ -514,20 +515,21 @@ class Rpc(BaseRpc):
         language = SubtitlingSession.objects.get(pk=session_pk).language
         if language.can_writelock(request.browser_id):
             language.release_writelock()
-            language.save()
-            video_cache.writelocked_langs_clear(language.video.video_id)
         return { "response": "ok" }
 
     def regain_lock(self, request, session_pk):
         language = SubtitlingSession.objects.get(pk=session_pk).language
-        if not language.can_writelock(request.browser_id):
-            return { 'response': 'unlockable' }
-        else:
-            language.writelock(request.user, request.browser_id)
-            language.save()
-            video_cache.writelock_add_lang(
-                language.video.video_id, language.language_code)
+
+        # This is the editor's heartbeat, so the common case (we still hold the
+        # lock) should only cost a single Redis operation.
+        if language.renew_writelock(request.browser_id):
+            return { 'response': 'ok' }
+
+        # The lease expired, try to take it again.
+        if language.writelock(request.user, request.browser_id):
             return { 'response': 'ok' }
+        else:
+            return { 'response': 'unlockable' }
 
 
     # Permissions
@@ -1197,7 +1199,7 @@ class Rpc(BaseRpc):
             return language, None
         else:
             return None, { "can_edit": False,
-                           "locked_by": unicode(language.writelock_owner) }
+                           "locked_by": unicode(language.get_writelock_owner()) }
 
     def _save_original_language(self, video_id, language_code):
         video = models.Video.objects.get(video_id=video_id)
@@ -1213,10 +1215,12 @@ class Rpc(BaseRpc):
 
                 subtitle_language.save()
 
-    def _autoplay_subtitles(self, user, video_id, language_pk, version_number):
+    def _autoplay_subtitles(self, user, video_id, language_pk, version_number,
+                            generation=None):
         cache =  video_cache.get_subtitles_dict(video_id, language_pk, 
                                                 version_number,
-                                                lambda version: self._subtitles_dict(version=version))
+                                                lambda version: self._subtitles_dict(version=version),
+                                                generation=generation)
 
         if cache and cache.get("language", None) is not None:
             cache['language_code'] = cache['language'].language
@@ -1262,32 +1266,20 @@ class Rpc(BaseRpc):
             language.video.is_moderated,
         )
 
-def language_summary(language, team_video=-1, user=None):
-    """Return a dictionary of info about the given SubtitleLanguage.
-
-    The team video can be given to avoid an extra database lookup.
-
-    """
-    if team_video == -1:
-        team_video = language.video.get_team_video()
-
-    translation_source = language.get_translation_source_language()
-    is_translation = bool(translation_source)
+def _summarize_language(language, tip, subtitle_count, translation_source,
+                        task, in_progress, user):
     summary = {
         'pk': language.pk,
         'language': language.language_code,
-        'dependent': is_translation,
-        'subtitle_count': language.get_subtitle_count(),
-        'in_progress': language.is_writelocked,
+        'dependent': bool(translation_source),
+        'subtitle_count': subtitle_count,
+        'in_progress': in_progress,
         'disabled_from': False }
 
-    if team_video:
-        tasks = team_video.task_set.incomplete().filter(language=language.language_code)
-        if tasks:
-            task = tasks[0]
-            summary['disabled_to'] = user and user != task.assignee
+    if task:
+        summary['disabled_to'] = user and user != task.assignee
 
-    if language.get_tip():
+    if tip:
         # Languages with existing subtitles cannot be selected as a "to"
         # language in the "add new translation" dialog.  If you want to work on
         # that language, select it and hit "Improve these Subtitles" instead.
@@ -1299,8 +1291,85 @@ def language_summary(language, team_video=-1, user=None):
         summary['disabled_from'] = True
 
 
-    if is_translation:
+    if translation_source:
         summary['standard_pk'] = translation_source.pk
     summary['is_complete'] = language.subtitles_complete
 
     return summary
+
+def language_summary(language, team_video=-1, user=None):
+    """Return a dictionary of info about the given SubtitleLanguage.
+
+    The team video can be given to avoid an extra database lookup.
+
+    """
+    if team_video == -1:
+        team_video = language.video.get_team_video()
+
+    task = None
+    if team_video:
+        tasks = team_video.task_set.incomplete().filter(language=language.language_code)
+        if tasks:
+            task = tasks[0]
+
+    return _summarize_language(language, language.get_tip(),
+                               language.get_subtitle_count(),
+                               language.get_translation_source_language(),
+                               task, language.is_writelocked, user)
+
+def language_summaries(languages, team_video=None, user=None, siblings=None,
+                       video=None):
+    """Return language_summary() for each of the given SubtitleLanguages.
+
+    All the languages must belong to the same video.  This takes a fixed
+    number of queries no matter how many languages there are, so use it
+    instead of calling language_summary in a loop.  The video can be given to
+    avoid an extra database lookup.
+
+    `siblings` is the list of all the SubtitleLanguages of the video, which is
+    where translation sources are looked up.  Pass it if you already have it,
+    otherwise it will be fetched when needed.
+
+    """
+    if not languages:
+        return []
+
+    tips = new_models.SubtitleVersion.objects.tips(languages)
+
+    # Same as SubtitleLanguage.get_translation_source_language_code, but using
+    # the tips we already have.
+    source_codes = {}
+    for language in languages:
+        tip = tips.get(language.pk)
+        if tip and not language.is_forked:
+            codes = [lc for lc in tip.lineage.keys()
+                     if lc != language.language_code]
+            if codes:
+                source_codes[language.pk] = codes[0]
+
+    if source_codes and siblings is None:
+        siblings = new_models.SubtitleLanguage.objects.filter(
+            video=languages[0].video_id,
+            language_code__in=set(source_codes.values()))
+    by_code = dict((sl.language_code, sl) for sl in siblings or [])
+
+    if video is None:
+        video = languages[0].video
+    writelocked = set(video_cache.writelocked_langs(video.video_id))
+
+    tasks = {}
+    if team_video:
+        codes = [l.language_code for l in languages]
+        for task in team_video.task_set.incomplete().filter(language__in=codes):
+            tasks.setdefault(task.language, task)
+
+    summaries = []
+    for language in languages:
+        tip = tips.get(language.pk)
+        source = by_code.get(source_codes.get(language.pk))
+        summaries.append(_summarize_language(
+            language, tip, tip.subtitle_count if tip else 0, source,
+            tasks.get(language.language_code),
+            language.language_code in writelocked, user))
+
+    return summaries
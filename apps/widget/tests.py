@@ -38,7 +38,6 @@ from widget.rpc import Rpc
 from widget.null_rpc import NullRpc
 from django.core.urlresolvers import reverse
 from widget import video_cache
-from datetime import datetime, timedelta
 from django.conf import settings
 
 VIDEO_URL = 'http://videos.mozilla.org/firefox/3.5/switch/switch.ogv'
@@ -123,6 +122,7 @@ class TestRpc(TestCase):
         self.user_1 = CustomUser.objects.get(pk=4)
         self.video_pk = 12
         video_cache.invalidate_video_id(VIDEO_URL)
+        sub_models.writelocks.clear()
 
     def test_actions_for_subtitle_edit(self):
         request = RequestMockup(self.user_0)
@@ -265,6 +265,25 @@ class TestRpc(TestCase):
         self.assertEqual(False, return_value['can_edit'])
         self.assertEqual(unicode(self.user_0), return_value['locked_by'])
 
+    def test_cant_edit_when_lock_taken_after_check(self):
+        request_0 = RequestMockup(self.user_0)
+        return_value = rpc.show_widget(request_0, VIDEO_URL, False)
+        video_id = return_value['video_id']
+
+        rpc.start_editing(request_0, video_id, 'en', original_language_code='en')
+
+        # Both browsers pass the can_writelock() check, only one gets the lock.
+        can_writelock = sub_models.SubtitleLanguage.can_writelock
+        sub_models.SubtitleLanguage.can_writelock = lambda self, key: True
+        try:
+            request_1 = RequestMockup(self.user_1, "b")
+            return_value = rpc.start_editing(request_1, video_id, 'en')
+        finally:
+            sub_models.SubtitleLanguage.can_writelock = can_writelock
+
+        self.assertEqual(False, return_value['can_edit'])
+        self.assertEqual(unicode(self.user_0), return_value['locked_by'])
+
     def test_basic(self):
         request_0 = RequestMockup(self.user_0)
         return_value = rpc.show_widget(request_0, VIDEO_URL, False)
@@ -709,19 +728,28 @@ class TestRpc(TestCase):
     def test_ensure_language_locked_on_regain_lock(self):
         request = RequestMockup(self.user_0)
         session = self._start_editing(request)
-
-        now = datetime.now().replace(microsecond=0) + timedelta(seconds=20)
-        sub_models.datetime = FakeDatetime(now)
+        language = session.language
+        writelock_time = sub_models.SubtitleLanguage.objects.get(
+            pk=language.pk).writelock_time
 
         response = rpc.regain_lock(request, session.pk)
         self.assertEquals('ok', response['response'])
+        self.assertTrue(language.is_writelocked)
 
-        video = models.Video.objects.get(pk=session.video.pk)
-        language = video.subtitle_language()
+        # Heartbeats renew the lease without touching the row.
+        self.assertEquals(writelock_time, sub_models.SubtitleLanguage.objects.get(
+            pk=language.pk).writelock_time)
 
-        self.assertEquals(now, language.writelock_time)
+        request_1 = RequestMockup(self.user_1, "b")
+        response = rpc.regain_lock(request_1, session.pk)
+        self.assertEquals('unlockable', response['response'])
 
-        models.datetime = datetime
+        # If the lease is gone, regaining the lock takes it again.
+        language.release_writelock()
+        response = rpc.regain_lock(request, session.pk)
+        self.assertEquals('ok', response['response'])
+        self.assertTrue(language.can_writelock(request.browser_id))
+        self.assertFalse(language.can_writelock(request_1.browser_id))
 
     def test_title_and_description_from_video(self):
         request = RequestMockup(self.user_0)
@@ -1058,6 +1086,87 @@ class TestCache(TestCase):
         video_id = video_cache.get_video_id(url)
         video_cache.get_subtitles_dict(video_id, 0, 0, lambda x: x)
 
+    def test_invalidate_cache_changes_generation(self):
+        video = Video.objects.all()[0]
+        video_id = video.video_id
+
+        video_cache.get_video_urls(video_id)
+        old_key = video_cache._video_urls_key(video_id)
+        self.assertTrue(video_cache.cache.get(old_key) is not None)
+
+        video_cache.invalidate_cache(video_id)
+        self.assertNotEqual(old_key, video_cache._video_urls_key(video_id))
+        self.assertEqual(video_cache.cache.get(video_cache._video_urls_key(video_id)), None)
+
+    def test_invalidate_cache_many(self):
+        video_ids = list(Video.objects.values_list('video_id', flat=True)[:2])
+        old_keys = []
+        for video_id in video_ids:
+            video_cache.get_is_moderated(video_id)
+            old_keys.append(video_cache._video_is_moderated_key(video_id))
+
+        video_cache.invalidate_cache_many(video_ids)
+
+        for video_id, old_key in zip(video_ids, old_keys):
+            self.assertNotEqual(old_key,
+                                video_cache._video_is_moderated_key(video_id))
+
+    def test_invalidate_video_moderation_many(self):
+        video_id = Video.objects.all()[0].video_id
+        video_cache.get_is_moderated(video_id)
+        key = video_cache._video_is_moderated_key(video_id)
+        self.assertTrue(video_cache.cache.get(key) is not None)
+
+        video_cache.invalidate_video_moderation_many([video_id])
+        self.assertEqual(video_cache.cache.get(key), None)
+
+    def test_invalidate_many_skips_videos_without_generation(self):
+        video_id = Video.objects.all()[0].video_id
+        generation_key = video_cache._video_generation_key(video_id)
+        video_cache.cache.delete(generation_key)
+
+        video_cache.invalidate_video_moderation_many([video_id])
+        video_cache.invalidate_video_visibility_many([video_id])
+        self.assertEqual(video_cache.cache.get(generation_key), None)
+
+    def test_widget_bundle(self):
+        video = Video.objects.all()[0]
+        video_id = video.video_id
+
+        bundle = video_cache.get_widget_bundle(video_id)
+        self.assertEqual(bundle['video_urls'],
+                         [vu.effective_url for vu in video.videourl_set.all()])
+        self.assertEqual(bundle['is_moderated'], video.is_moderated)
+        self.assertEqual(bundle['languages'],
+                         video_cache.get_video_languages(video_id))
+        for language in video.newsubtitlelanguage_set.all():
+            self.assertEqual(
+                video_cache.bundle_language_pk(bundle, language.language_code),
+                video_cache.pk_for_default_language(video_id,
+                                                    language.language_code))
+
+        # A warm bundle is a single get_many and no queries.
+        calls = []
+        old_get_many = video_cache.cache.get_many
+        def get_many(keys):
+            calls.append(keys)
+            return old_get_many(keys)
+        video_cache.cache.get_many = get_many
+        try:
+            self.assertNumQueries(0, video_cache.get_widget_bundle, video_id)
+        finally:
+            del video_cache.cache.get_many
+        self.assertEqual(len(calls), 1)
+
+        # Bumping the generation makes the stored bundle stale.
+        video_cache.invalidate_cache(video_id)
+        self.assertNotEqual(video_cache.get_widget_bundle(video_id)['generation'],
+                            bundle['generation'])
+
+        video_cache.invalidate_video_moderation(video_id)
+        self.assertEqual(
+            video_cache.cache.get(video_cache._widget_bundle_key(video_id)), None)
+
 class TestCaching(TestCase):
     fixtures = ['test_widget.json']
 
@@ -1066,6 +1175,7 @@ class TestCaching(TestCase):
         self.user_1 = CustomUser.objects.get(pk=4)
         self.video_pk = 12
         video_cache.invalidate_video_id(VIDEO_URL)
+        sub_models.writelocks.clear()
 
     def test_get_from_cache(self):
         """
@@ -15,18 +15,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see
 # http://www.gnu.org/licenses/agpl-3.0.html.
-import datetime
+import random
 
-from django.conf import settings
 from django.core.cache import cache
 from django.utils.hashcompat import sha_constructor
 
+from utils.cachefill import fill, get_or_fill
 from videos.types import video_type_registrar
 from videos.types.base import VideoTypeError
 
 
 TIMEOUT = 60 * 60 * 24 * 5 # 5 days
 
+# Passed as the generation to the key functions to get the key that holds the
+# last value stored for that key in any generation.  Those are what we hand out
+# while another worker recomputes a value after an invalidation (see
+# utils.cachefill).
+STALE = 'stale'
+
 
 def get_video_id(video_url, public_only=False, referer=None):
     """
@@ -37,20 +43,17 @@ def get_video_id(video_url, public_only=False, referer=None):
     value = cache.get(cache_key)
     if bool(value):
         return value
-    else:
+
+    def compute():
         from videos.models import Video
         try:
             video, create = Video.get_or_create_for_url(video_url)
         except VideoTypeError:
             raise
 
-        if not video:
-            return None
-
-        video_id = video.video_id
+        return video.video_id if video else None
 
-        cache.set(cache_key, video_id, TIMEOUT)
-        return video_id
+    return fill(cache_key, compute, TIMEOUT, is_fresh=bool)
 
 def associate_extra_url(video_url, video_id):
     cache_key = _video_id_key(video_url)
@@ -68,49 +71,82 @@ def associate_extra_url(video_url, video_id):
 
 
 # Invalidation
-def invalidate_cache(video_id):
-    cache.delete(_video_urls_key(video_id))
+#
+# Almost every key we store for a video is namespaced by a per-video
+# generation number (see _video_generation).  Invalidating everything we have
+# cached for a video is then a single increment of that number; the old keys
+# simply become unreachable and age out of memcached on their own.
+#
+# The only keys that can't be namespaced this way are the ones that aren't
+# looked up by video_id (the video_id for a URL and the completed languages for
+# a team video), and those get deleted explicitly with delete_many.
 
-    try:
-        from apps.videos.models import Video
-        video = Video.objects.get(video_id=video_id)
-        for l in video.newsubtitlelanguage_set.all():
-            cache.delete(_subtitles_dict_key(video_id, l.pk))
-    except Video.DoesNotExist:
-        pass
+INVALIDATION_CHUNK_SIZE = 1000
 
-    for language in settings.ALL_LANGUAGES:
-        cache.delete(_subtitle_language_pk_key(video_id, language[0]))
+def _chunks(seq, size=INVALIDATION_CHUNK_SIZE):
+    seq = list(seq)
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
 
-    cache.delete(_subtitle_language_pk_key(video_id, None))
-    cache.delete(_subtitles_dict_key(video_id, None))
-    cache.delete(_subtitles_count_key(video_id))
-    cache.delete(_video_languages_key(video_id))
-    cache.delete(_video_languages_verbose_key(video_id))
-    cache.delete(_video_is_moderated_key(video_id))
-    cache.delete(_video_visibility_policy_key(video_id))
+def _unnamespaced_keys(video_ids):
+    """Return the keys for the given videos that need explicit deletes."""
+    from videos.models import VideoUrl
+    from teams.models import TeamVideo
 
-    from videos.models import Video
-    try:
-        video = Video.objects.get(video_id=video_id)
-        for url in video.videourl_set.all():
-            cache.delete(_video_id_key(url.url))
+    urls = (VideoUrl.objects.filter(video__video_id__in=video_ids)
+                            .values_list('url', flat=True))
+    team_video_ids = (TeamVideo.objects.filter(video__video_id__in=video_ids)
+                                       .values_list('id', flat=True))
 
-        team_video = video.get_team_video()
+    return ([_video_id_key(url) for url in urls] +
+            [_video_completed_languages(tv_id) for tv_id in team_video_ids])
 
-        if team_video:
-            cache.delete(_video_completed_languages(team_video.id))
-    except Video.DoesNotExist:
+def invalidate_cache(video_id):
+    try:
+        cache.incr(_video_generation_key(video_id))
+    except ValueError:
+        # No generation stored means nothing namespaced can be reached.
         pass
 
+    cache.delete_many(_unnamespaced_keys([video_id]))
+
+def invalidate_cache_many(video_ids):
+    """Invalidate the caches of many videos at once.
+
+    Dropping the generation keys has the same effect as incrementing them (the
+    next lookup will start a fresh generation), and it lets us do a whole chunk
+    of videos in a single round trip.
+
+    """
+    for chunk in _chunks(video_ids):
+        cache.delete_many([_video_generation_key(video_id)
+                           for video_id in chunk])
+        cache.delete_many(_unnamespaced_keys(chunk))
+
 def invalidate_video_id(video_url):
     cache.delete(_video_id_key(video_url))
 
 def invalidate_video_moderation(video_id):
-    cache.delete(_video_is_moderated_key(video_id))
+    invalidate_video_moderation_many([video_id])
+
+def invalidate_video_moderation_many(video_ids):
+    for chunk in _chunks(video_ids):
+        # Videos without a generation have nothing namespaced to delete, so
+        # don't start one for them.
+        generations = _existing_generations(chunk)
+        cache.delete_many([_video_is_moderated_key(video_id, generation)
+                           for video_id, generation in generations.items()] +
+                          [_widget_bundle_key(video_id) for video_id in chunk])
 
 def invalidate_video_visibility(video_id):
-    cache.delete(_video_visibility_policy_key(video_id))
+    invalidate_video_visibility_many([video_id])
+
+def invalidate_video_visibility_many(video_ids):
+    for chunk in _chunks(video_ids):
+        generations = _existing_generations(chunk)
+        cache.delete_many([_video_visibility_policy_key(video_id, generation)
+                           for video_id, generation in generations.items()] +
+                          [_widget_bundle_key(video_id) for video_id in chunk])
 
 def on_video_url_save(sender, instance, **kwargs):
     if instance.video_id:
@@ -123,69 +159,107 @@ def on_video_url_delete(sender, instance, **kwargs):
 def _video_id_key(video_url):
     return 'video_id_{0}'.format(sha_constructor(video_url).hexdigest())
 
-def _video_urls_key(video_id):
-    return 'widget_video_urls_{0}'.format(video_id)
+def _video_generation_key(video_id):
+    return 'widget_video_generation_{0}'.format(video_id)
+
+def _new_generation():
+    # Start generations at a random point rather than at 1, so that a
+    # generation key that gets evicted can't bring old entries back to life.
+    return random.randint(1, 2 ** 31)
+
+def _start_generation(video_id):
+    key = _video_generation_key(video_id)
+    generation = _new_generation()
+
+    # If someone else got there first, use theirs.
+    if not cache.add(key, generation, TIMEOUT):
+        generation = cache.get(key)
+
+    return generation
+
+def _video_generation(video_id):
+    generation = cache.get(_video_generation_key(video_id))
+
+    if generation is None:
+        generation = _start_generation(video_id)
+
+    return generation
+
+def _existing_generations(video_ids):
+    """Return a dict of video_id -> generation for the videos that have one.
+
+    This is a single get_many, and it never starts a new generation.
+
+    """
+    keys = dict((_video_generation_key(video_id), video_id)
+                for video_id in video_ids)
+    found = cache.get_many(keys.keys())
+
+    return dict((keys[key], generation) for key, generation in found.items())
+
+def _namespaced(template, video_id, generation=None, *args):
+    if generation is None:
+        generation = _video_generation(video_id)
+    return template.format(generation, video_id, *args)
 
-def _subtitles_dict_key(video_id, language_pk, version_no=None):
-    return 'widget_subtitles_{0}{1}{2}'.format(video_id, language_pk, version_no)
+def _video_urls_key(video_id, generation=None):
+    return _namespaced('widget_video_urls_{0}_{1}', video_id, generation)
 
-def _subtitles_count_key(video_id):
-    return "subtitle_count_{0}".format(video_id)
+def _subtitles_dict_key(video_id, language_pk, version_no=None, generation=None):
+    return _namespaced('widget_subtitles_{0}_{1}{2}{3}', video_id, generation,
+                       language_pk, version_no)
 
-def _video_languages_key(video_id):
-    return "widget_video_languages_{0}".format(video_id)
+def _subtitles_count_key(video_id, generation=None):
+    return _namespaced("subtitle_count_{0}_{1}", video_id, generation)
 
-def _video_languages_verbose_key(video_id):
-    return "widget_video_languages_verbose_{0}".format(video_id)
+def _video_languages_key(video_id, generation=None):
+    return _namespaced("widget_video_languages_{0}_{1}", video_id, generation)
+
+def _video_languages_verbose_key(video_id, generation=None):
+    return _namespaced("widget_video_languages_verbose_{0}_{1}", video_id,
+                       generation)
 
 def _video_completed_languages(video_id):
     return "video_completed_verbose_{0}".format(video_id)
 
-def _video_writelocked_langs_key(video_id):
-    return "writelocked_langs_{0}".format(video_id)
-
-def _subtitle_language_pk_key(video_id, language_code):
-    return "sl_pk_{0}{1}".format(video_id, language_code)
+def _subtitle_language_pk_key(video_id, language_code, generation=None):
+    return _namespaced("sl_pk_{0}_{1}{2}", video_id, generation, language_code)
 
-def _video_is_moderated_key(video_id):
-    return 'widget_video_is_moderated_{0}'.format(video_id)
+def _video_is_moderated_key(video_id, generation=None):
+    return _namespaced('widget_video_is_moderated_{0}_{1}', video_id, generation)
 
-def _video_visibility_policy_key(video_id):
-    return 'widget_video_vis_key_{0}'.format(video_id)
+def _video_visibility_policy_key(video_id, generation=None):
+    return _namespaced('widget_video_vis_key_{0}_{1}', video_id, generation)
 
+def _widget_bundle_key(video_id):
+    # Not namespaced, the bundle records its generation instead.  See
+    # get_widget_bundle.
+    return 'widget_bundle_{0}'.format(video_id)
 
 def pk_for_default_language(video_id, language_code):
-    cache_key = _subtitle_language_pk_key(video_id, language_code)
-    value = cache.get(cache_key)
-
-    if value is None:
+    def compute():
         from videos.models import Video
         sl = Video.objects.get(video_id=video_id).subtitle_language(
             language_code)
-        value = None if sl is None else sl.pk
-        cache.set(cache_key, value, TIMEOUT)
+        return None if sl is None else sl.pk
 
-    return value
+    return get_or_fill(_subtitle_language_pk_key(video_id, language_code),
+                       compute, TIMEOUT,
+                       _subtitle_language_pk_key(video_id, language_code, STALE))
 
 def get_video_urls(video_id):
-    cache_key = _video_urls_key(video_id)
-    video_urls = cache.get(cache_key)
-
-    if video_urls is None:
+    def compute():
         from videos.models import Video
-        video_urls = [vu.effective_url for vu
-                 in Video.objects.get(video_id=video_id).videourl_set.all()]
-        cache.set(cache_key, video_urls, TIMEOUT)
+        return [vu.effective_url for vu
+                in Video.objects.get(video_id=video_id).videourl_set.all()]
 
-    return video_urls
+    return get_or_fill(_video_urls_key(video_id), compute, TIMEOUT,
+                       _video_urls_key(video_id, STALE))
 
 def get_subtitles_dict(video_id, language_pk, version_number, 
-                       subtitles_dict_fn, is_remote=False):
-
-    cache_key = _subtitles_dict_key(video_id, language_pk, version_number)
-    cached_value = cache.get(cache_key)
+                       subtitles_dict_fn, is_remote=False, generation=None):
 
-    if cached_value is None:
+    def compute():
         from videos.models import Video
         from subtitles.models import SubtitleLanguage
         video = Video.objects.get(video_id=video_id)
@@ -204,21 +278,17 @@ def get_subtitles_dict(video_id, language_pk, version_number,
             version = language.version(version_number=version_number, public_only=not is_remote)
 
             if version:
-                cached_value = subtitles_dict_fn(version)
-            else:
-                cached_value = None
+                return subtitles_dict_fn(version)
 
-            cache.set(cache_key, cached_value, TIMEOUT)
-
-    return cached_value
+    return get_or_fill(
+        _subtitles_dict_key(video_id, language_pk, version_number, generation),
+        compute, TIMEOUT,
+        _subtitles_dict_key(video_id, language_pk, version_number, STALE))
 
 def get_video_languages(video_id):
-    from apps.widget.rpc import language_summary
+    from apps.widget.rpc import language_summaries
 
-    cache_key = _video_languages_key(video_id)
-    value = cache.get(cache_key)
-
-    if value is None:
+    def compute():
         from videos.models import Video
         video = Video.objects.get(video_id=video_id)
         languages = video.newsubtitlelanguage_set.having_nonempty_versions()
@@ -228,30 +298,23 @@ def get_video_languages(video_id):
         if team_video:
             languages = languages.filter(language_code__in=team_video.team.get_readable_langs())
 
-        value = [language_summary(l) for l in languages]
-        cache.set(cache_key, value, TIMEOUT)
+        return language_summaries(list(languages), team_video, video=video)
 
-    return value
+    return get_or_fill(_video_languages_key(video_id), compute, TIMEOUT,
+                       _video_languages_key(video_id, STALE))
 
 def get_video_completed_languages(team_video_id):
-    cache_key = _video_completed_languages(team_video_id)
-    languages = cache.get(cache_key)
-
-    if languages is None:
+    def compute():
         from videos.models import SubtitleLanguage
-        languages = [(sl.language, sl.language_display()) for sl in list(SubtitleLanguage.objects.filter(video__teamvideo__id=team_video_id).all())]
+        return [(sl.language, sl.language_display()) for sl in list(SubtitleLanguage.objects.filter(video__teamvideo__id=team_video_id).all())]
 
-        cache.set(cache_key, languages, TIMEOUT)
-
-    return languages
+    return get_or_fill(_video_completed_languages(team_video_id), compute,
+                       TIMEOUT)
 
 def get_video_languages_verbose(video_id, max_items=6):
     # FIXME: we should probably merge a better method with get_video_languages
     # maybe accepting a 'verbose' param?
-    cache_key = _video_languages_verbose_key(video_id)
-    data = cache.get(cache_key)
-
-    if data is None:
+    def compute():
         from videos.models import Video
         video = Video.objects.get(video_id=video_id)
         languages_with_version_total = video.subtitlelanguage_set.filter(has_version=True).order_by('-percent_done')
@@ -277,33 +340,28 @@ def get_video_languages_verbose(video_id, max_items=6):
                     'is_complete': lang.is_complete,
                     'language_url': lang.get_absolute_url(),
                 })
-        cache.set(cache_key, data, TIMEOUT)
+        return data
 
-    return data
+    return get_or_fill(_video_languages_verbose_key(video_id), compute,
+                       TIMEOUT, _video_languages_verbose_key(video_id, STALE))
 
 def get_is_moderated(video_id):
-    cache_key = _video_is_moderated_key(video_id)
-    value = cache.get(cache_key)
-
-    if value is None:
+    # No stale copies for moderation and visibility.  They're cheap to compute
+    # and we don't want to keep serving the old value once they've changed.
+    def compute():
         from videos.models import Video
-        video = Video.objects.get(video_id=video_id)
-        value = video.is_moderated
-        cache.set(cache_key, value, TIMEOUT)
+        return Video.objects.get(video_id=video_id).is_moderated
 
-    return value
+    return get_or_fill(_video_is_moderated_key(video_id), compute, TIMEOUT)
 
 def get_visibility_policies(video_id):
-    cache_key = _video_visibility_policy_key(video_id)
-    value = cache.get(cache_key)
-
-    if value is None:
+    def compute():
         from videos.models import Video
 
         try:
             video = Video.objects.get(video_id=video_id)
         except Video.DoesNotExist:
-            return {}
+            return None
 
         team_video = video.get_team_video()
 
@@ -315,48 +373,107 @@ def get_visibility_policies(video_id):
             is_public = True
             team_id = None
 
-        value = {
+        return {
             "is_public": is_public,
             "team_id": team_id
         }
 
-        cache.set(cache_key, value, TIMEOUT)
+    value = get_or_fill(_video_visibility_policy_key(video_id), compute,
+                        TIMEOUT)
+    return {} if value is None else value
 
-    return value
+# Widget bundle
+#
+# Rpc.show_widget needs the visibility policy, URLs, moderation status and
+# languages of a video, plus the pk of the language it's going to autoplay.
+# Rather than keep each of those under its own key (each with its own fallback
+# query), we keep them together in a single "bundle".
+#
+# The bundle key isn't namespaced by the video's generation, because then we'd
+# need one round trip to learn the generation and another to fetch the bundle.
+# Instead the bundle records the generation it was built for and we fetch both
+# with one get_many.  A bundle from an older generation is treated as a miss.
+
+def _build_widget_bundle(video_id, generation):
+    """Build the widget bundle for a video with a fixed number of queries."""
+    from apps.widget.rpc import language_summaries
+    from videos.models import Video
+    from subtitles.models import SubtitleLanguage
+    from teams.models import TeamVideo
+
+    video = Video.objects.get(video_id=video_id)
+    team_videos = list(TeamVideo.objects.select_related('team').filter(video=video))
+    team_video = team_videos[0] if team_videos else None
+
+    video_urls = [vu.effective_url for vu in video.videourl_set.all()]
+    languages = list(video.newsubtitlelanguage_set.all())
+
+    language_pks = {}
+    for language in languages:
+        language_pks.setdefault(language.language_code, language.pk)
+
+    nonempty = set(SubtitleLanguage.objects.having_nonempty_versions()
+                                           .filter(video=video)
+                                           .values_list('pk', flat=True))
+    shown = [l for l in languages if l.pk in nonempty]
+
+    if team_video:
+        readable = set(team_video.team.get_readable_langs())
+        shown = [l for l in shown if l.language_code in readable]
+        visibility_policy = {
+            "is_public": team_video.team.is_visible,
+            "team_id": team_video.team.id,
+        }
+    else:
+        visibility_policy = {
+            "is_public": True,
+            "team_id": None,
+        }
 
-# Writelocking
-def _writelocked_store_langs(video_id, langs):
-    cache_key = _video_writelocked_langs_key(video_id)
-    cache.set(cache_key, langs, 5 * 60)
-    return langs
+    return {
+        'generation': generation,
+        'visibility_policy': visibility_policy,
+        'video_urls': video_urls,
+        'is_moderated': video.is_moderated,
+        'languages': language_summaries(shown, team_video, siblings=languages,
+                                        video=video),
+        'language_pks': language_pks,
+        'original_language_pk': language_pks.get(
+            video.primary_audio_language_code),
+    }
 
-def writelocked_langs(video_id):
-    from videos.models import WRITELOCK_EXPIRATION, Video
-    cache_key = _video_writelocked_langs_key(video_id)
-    value = cache.get(cache_key)
+def get_widget_bundle(video_id):
+    """Return everything Rpc.show_widget needs to know about a video.
 
-    if value is None:
-        treshold = datetime.datetime.now() - datetime.timedelta(seconds=WRITELOCK_EXPIRATION)
-        video = Video.objects.get(video_id=video_id)
-        langs = list(video.subtitlelanguage_set.filter(writelock_time__gte=treshold))
-        value = _writelocked_store_langs(video_id, [x.language for x in langs])
+    On a warm cache this is a single round trip.  Raises Video.DoesNotExist
+    if the video is gone.
 
-    return value
+    """
+    generation_key = _video_generation_key(video_id)
+    bundle_key = _widget_bundle_key(video_id)
+    found = cache.get_many([generation_key, bundle_key])
+
+    generation = found.get(generation_key)
+    bundle = found.get(bundle_key)
 
-def writelock_add_lang(video_id, language_code):
-    writelocked_langs_clear(video_id)
-    langs = writelocked_langs(video_id)
+    if generation is None:
+        generation = _start_generation(video_id)
+    elif bundle is not None and bundle['generation'] == generation:
+        return bundle
 
-    if not language_code in langs:
-        langs.append(language_code)
-        _writelocked_store_langs(video_id, langs)
+    # While someone else rebuilds it, an outdated bundle is fine to hand out.
+    return fill(bundle_key, lambda: _build_widget_bundle(video_id, generation),
+                TIMEOUT, stale=bundle,
+                is_fresh=lambda b: b is not None and b['generation'] == generation)
 
-def writelock_remove_lang(video_id, language_code):
-    langs = writelocked_langs(video_id)
-    if language_code in langs:
-        langs.remove(language_code)
-        _writelocked_store_langs(video_id, langs)
+def bundle_language_pk(bundle, language_code):
+    """Like pk_for_default_language, but answered from a widget bundle."""
+    if language_code is None:
+        return bundle['original_language_pk']
+    return bundle['language_pks'].get(language_code)
 
-def writelocked_langs_clear(video_id):
-    cache_key = _video_writelocked_langs_key(video_id)
-    cache.delete(cache_key)
+# Writelocking
+def writelocked_langs(video_id):
+    """Return the codes of the languages of a video that are writelocked."""
+    from subtitles.models import writelocks
+    return writelocks.held(video_id)
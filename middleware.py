@@ -180,11 +180,11 @@ class MetricsCursorWrapper(_CursorWrapper):
 
             # This is an ugly hack to get at least a rough measurement of query
             # times for executemany() queries.
-            ms_per_query = ms / len(params_list)
-
-            for _ in xrange(len(params_list)):
-                ManualTimer('db-query-time').record(ms_per_query)
-                ManualTimer('db-query-time.%s' % op).record(ms_per_query)
+            count = len(params_list)
+            if count:
+                ms_per_query = ms / count
+                ManualTimer('db-query-time').record(ms_per_query, count)
+                ManualTimer('db-query-time.%s' % op).record(ms_per_query, count)
 
 django.db.backends.mysql.base.CursorWrapper = MetricsCursorWrapper
 
@@ -10,13 +10,70 @@ from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.core.cache import cache
 from django.core import urlresolvers
 from django.contrib.sites.models import Site
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.servers.basehttp import FileWrapper
+from django.db import connection
+from django.db.models import Count, Max
+from django.utils import simplejson as json
+from django.utils.cache import patch_vary_headers
+from utils.amazon import S3Storage, default_s3_store
 import datetime
+import gzip
+import logging
+import os
+import zlib
+from cStringIO import StringIO
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_CHANGEFREQ = "monthly"
 DEFAULT_PRIORITY = 0.6
 DEFAULT_LASTMOD = datetime.datetime(2011, 3, 1)
 
+# Video ids per prebuilt shard.  Shards are pk ranges, so they can hold fewer
+# videos than this, but never more.  The limit for a sitemap is 50000 urls.
+SITEMAP_SHARD_SIZE = getattr(settings, 'SITEMAP_SHARD_SIZE', 5000)
+SITEMAP_DIR = getattr(settings, 'SITEMAP_DIR', 'sitemaps')
+
+def sitemap_storage():
+    return default_s3_store or default_storage
+
+def _index_name():
+    return '%s/sitemap.xml.gz' % SITEMAP_DIR
+
+def _shard_name(shard):
+    return '%s/video-%s.xml.gz' % (SITEMAP_DIR, shard)
+
+def _manifest_name():
+    return '%s/manifest.json' % SITEMAP_DIR
+
+def _gzip(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def _serve(request, storage, name):
+    """Stream a prebuilt, gzipped sitemap."""
+    f = storage.open(name)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(FileWrapper(f), mimetype='application/xml')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        xml = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+        f.close()
+        response = HttpResponse(xml, mimetype='application/xml')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
 def sitemap_index(request, sitemaps):
+    storage = sitemap_storage()
+    if storage.exists(_index_name()):
+        return _serve(request, storage, _index_name())
+
+    # Nothing has been built yet.
     current_site = Site.objects.get_current()
     sites = []
     protocol = request.is_secure() and 'https' or 'http'
@@ -42,6 +99,13 @@ def sitemap_view(request, sitemaps, section=None):
     else:
         maps = sitemaps.values()
     page = request.GET.get("p", 1)
+
+    if section == 'video':
+        storage = sitemap_storage()
+        if str(page).isdigit() and storage.exists(_shard_name(page)):
+            return _serve(request, storage, _shard_name(page))
+        if storage.exists(_index_name()):
+            raise Http404("Page %s empty" % page)
     cache_key = 'sitemap_%s_%s' % (section, page)
     xml = cache.get(cache_key)
 
@@ -126,3 +190,143 @@ sitemaps = {
             'video':VideoSitemap,
             'static':StaticSitemap,
             }
+
+
+class SitemapBuilder(object):
+    """Prebuilds the video sitemaps and the sitemap index.
+
+    Videos are walked in shards of SITEMAP_SHARD_SIZE primary keys, so each
+    shard is a range scan on the primary key instead of an OFFSET.  Shard n is
+    served as page n of the video sitemap.
+
+    For each shard we keep the number of videos and the latest edited time in
+    a manifest.  Saving a video sets its edited time to now and deleting one
+    changes the count, so a shard only needs rebuilding when those change.
+
+    """
+    def __init__(self, storage=None, shard_size=SITEMAP_SHARD_SIZE,
+                 protocol='http'):
+        self.storage = storage or sitemap_storage()
+        self.shard_size = shard_size
+        self.protocol = protocol
+        self.domain = Site.objects.get_current().domain
+
+    def _write(self, name, data):
+        """Replace a file without a moment where it's missing.
+
+        S3Storage overwrites keys in place, and S3 only starts serving the new
+        object once it's complete.  For storages on a local disk we write the
+        new file next to the old one and rename it over it.
+
+        """
+        if isinstance(self.storage, S3Storage):
+            self.storage.save(name, ContentFile(data))
+            return
+
+        try:
+            path = self.storage.path(name)
+        except NotImplementedError:
+            # No way to swap it in, so this is the best we can do.
+            if self.storage.exists(name):
+                self.storage.delete(name)
+            self.storage.save(name, ContentFile(data))
+            return
+
+        tmp_name = self.storage.save(name + '.tmp', ContentFile(data))
+        try:
+            os.rename(self.storage.path(tmp_name), path)
+        except OSError:
+            self.storage.delete(tmp_name)
+            raise
+
+    def _load_manifest(self):
+        name = _manifest_name()
+        if not self.storage.exists(name):
+            return {}
+        f = self.storage.open(name)
+        try:
+            manifest = json.loads(f.read())
+        finally:
+            f.close()
+        if manifest.get('shard_size') != self.shard_size:
+            # The shards don't line up anymore.
+            return {}
+        return manifest.get('shards', {})
+
+    def shards(self):
+        """Yield (shard, fingerprint) for every shard with videos in it."""
+        # One GROUP BY over the whole table instead of a query per shard.
+        # pk - pk % size rather than DIV, which sqlite doesn't have.
+        qn = connection.ops.quote_name
+        pk = '%s.%s' % (qn(Video._meta.db_table), qn(Video._meta.pk.column))
+        shards = (Video.objects.order_by()
+                  .extra(select={'shard': '(%s - %s %%%% %%s) / %%s' % (pk, pk)},
+                         select_params=(self.shard_size, self.shard_size))
+                  .values('shard')
+                  .annotate(count=Count('pk'), lastmod=Max('edited')))
+
+        for stats in shards:
+            lastmod = stats['lastmod'] and stats['lastmod'].isoformat()
+            yield str(int(stats['shard'])), [stats['count'], lastmod]
+
+    def _shard_videos(self, shard):
+        shard = int(shard)
+        return Video.objects.filter(pk__gte=shard * self.shard_size,
+                                    pk__lt=(shard + 1) * self.shard_size)
+
+    def build_shard(self, shard):
+        sitemap = VideoSitemap()
+        urls = []
+        for video in (self._shard_videos(shard).order_by('pk')
+                      .values('video_id', 'edited')):
+            urls.append({
+                'location': '%s://%s%s' % (self.protocol, self.domain,
+                                           sitemap.location(video)),
+                'lastmod': sitemap.lastmod(video),
+                'changefreq': sitemap.changefreq,
+                'priority': str(sitemap.priority),
+            })
+        xml = smart_str(loader.render_to_string('sitemap.xml',
+                                                {'urlset': urls}))
+        self._write(_shard_name(shard), _gzip(xml))
+
+    def build_index(self, shards):
+        base = '%s://%s' % (self.protocol, self.domain)
+        video_url = urlresolvers.reverse(sitemap_view,
+                                         kwargs={'section': 'video'})
+        static_url = urlresolvers.reverse(sitemap_view,
+                                          kwargs={'section': 'static'})
+        urls = [base + static_url]
+        urls.extend('%s%s?p=%s' % (base, video_url, shard)
+                    for shard in sorted(shards, key=int))
+        xml = loader.render_to_string('sitemap_index.xml', {'sitemaps': urls})
+        self._write(_index_name(), _gzip(smart_str(xml)))
+
+    def build(self, force=False):
+        """Rebuild the shards that changed, and the index if needed.
+
+        Returns the number of shards that were rebuilt.
+
+        """
+        old = {} if force else self._load_manifest()
+        new = dict(self.shards())
+
+        changed = [shard for shard, fingerprint in new.items()
+                   if old.get(shard) != fingerprint]
+        for shard in changed:
+            self.build_shard(shard)
+
+        removed = set(old) - set(new)
+        for shard in removed:
+            self.storage.delete(_shard_name(shard))
+
+        if changed or removed or not self.storage.exists(_index_name()):
+            self.build_index(new.keys())
+
+        self._write(_manifest_name(), json.dumps({
+            'shard_size': self.shard_size,
+            'shards': new,
+        }))
+        logger.info('Rebuilt %s of %s sitemap shards, removed %s',
+                    len(changed), len(new), len(removed))
+        return len(changed)
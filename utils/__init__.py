@@ -72,6 +72,14 @@ def render_to_json(func):
         return HttpResponse(json, mimetype="application/json")
     return update_wrapper(wrapper, func)
 
+def templated_email_context(body_dict):
+    """Add the variables every templated email gets to a context dict."""
+    domain = Site.objects.get_current().domain
+    body_dict['STATIC_URL_BASE'] = settings.STATIC_URL_BASE
+    body_dict['domain'] = domain
+    body_dict['url_base'] = "%s://%s" % (DEFAULT_PROTOCOL, domain)
+    return body_dict
+
 def send_templated_email(to, subject, body_template, body_dict,
                          from_email=None, ct="html", fail_silently=False,
                          check_user_preference=True):
@@ -104,10 +112,8 @@ def send_templated_email(to, subject, body_template, body_dict,
             to.append(recipient)
     if not from_email: from_email = settings.DEFAULT_FROM_EMAIL
 
-    body_dict['STATIC_URL_BASE'] = settings.STATIC_URL_BASE
-    body_dict['domain'] = Site.objects.get_current().domain
-    body_dict['url_base'] = "%s://%s" % (DEFAULT_PROTOCOL,  Site.objects.get_current().domain)
-    message = render_to_string(body_template, body_dict)
+    message = render_to_string(body_template,
+                               templated_email_context(body_dict))
     bcc = settings.EMAIL_BCC_LIST
     email = EmailMessage(subject, message, from_email, to, bcc=bcc)
     email.content_subtype = ct
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program.  If not, see http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Filling cache keys without stampedes.
+
+The usual "get, recompute on a miss, set" pattern falls over for popular keys:
+when one gets invalidated every request that comes in before the new value is
+stored recomputes it too.  get_or_fill fixes that:
+
+* Only one worker recomputes a key at a time.  It holds a short lock, taken
+  with cache.add so it's atomic across processes.
+* Everyone else gets a stale copy of the value while that happens, if the
+  caller keeps one (see `stale_key`).  Without one they wait a little for the
+  new value to show up.
+* Timeouts are jittered, so keys that were filled together don't all expire
+  together.
+
+None is never stored, so a compute function that returns None will be called
+again next time, just like with the plain pattern.
+
+"""
+
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.metrics import Meter
+
+
+LOCK_TIMEOUT = getattr(settings, 'CACHE_FILL_LOCK_TIMEOUT', 30)
+WAIT_TIMEOUT = getattr(settings, 'CACHE_FILL_WAIT_TIMEOUT', 2.0)
+WAIT_INTERVAL = 0.05
+JITTER = 0.1
+
+
+def jittered(timeout, jitter=JITTER):
+    """Return the timeout shortened by a random amount, up to `jitter` of it."""
+    return max(1, int(timeout * (1 - jitter * random.random())))
+
+def _lock_key(key):
+    return '{0}:fill-lock'.format(key)
+
+def _store(key, stale_key, value, timeout):
+    if value is None:
+        return
+
+    values = {key: value}
+    if stale_key:
+        values[stale_key] = value
+    cache.set_many(values, jittered(timeout))
+
+def _not_none(value):
+    return value is not None
+
+def get_or_fill(key, compute, timeout, stale_key=None):
+    """Return the value of a cache key, calling compute() to fill it if needed.
+
+    `stale_key` is a key that holds the last value stored for this key.  Use
+    one for keys that get invalidated by changing the key itself (e.g. by
+    bumping a generation number that's part of it): the stale key should stay
+    the same across those changes.  While one worker is recomputing the value,
+    the others will be handed the stale copy instead of waiting.
+
+    Exceptions raised by compute() are passed on to the caller.
+
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    return fill(key, compute, timeout, stale_key=stale_key)
+
+def fill(key, compute, timeout, stale_key=None, stale=None, is_fresh=_not_none):
+    """Fill a cache key that the caller has found to be missing or out of date.
+
+    This is the second half of get_or_fill, for callers that have to look the
+    key up themselves (e.g. as part of a get_many).
+
+    `stale` is an out of date value the caller already has in hand, which will
+    be handed out instead of looking up `stale_key`.  `is_fresh` is a function
+    that tells whether a value found in the cache is good enough to return.
+
+    """
+    lock_key = _lock_key(key)
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            # Someone may have filled it between our get and our add.
+            value = cache.get(key)
+            if not is_fresh(value):
+                value = compute()
+                _store(key, stale_key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    Meter('cache-fill.contended').inc()
+
+    if stale is None and stale_key:
+        stale = cache.get(stale_key)
+    if stale is not None:
+        Meter('cache-fill.stale').inc()
+        return stale
+
+    # Wait for the worker holding the lock to finish.  If it goes away without
+    # storing anything (compute returned None or raised) stop waiting early.
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        found = cache.get_many([key, lock_key])
+        if is_fresh(found.get(key)):
+            return found[key]
+        if lock_key not in found:
+            break
+
+    # Took too long or came up empty, compute it ourselves.
+    Meter('cache-fill.fallbacks').inc()
+    value = compute()
+    _store(key, stale_key, value, timeout)
+    return value
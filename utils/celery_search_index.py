@@ -74,6 +74,10 @@ def update_search_index_for_qs(model_class, pks):
         log(u'Seacrh index is not registered for %s' % model_class)
         return None
 
+    # Indexes that can load what prepare() needs for many objects at once.
+    if hasattr(search_index, 'prefetch'):
+        qs = search_index.prefetch(qs)
+
     search_index.backend.update(search_index, qs)
 
     LogEntry(num=len(pks), time=time.time()-start).save()
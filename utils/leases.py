@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program.  If not, see http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Short-lived exclusive leases stored in Redis.
+
+A lease is held by a session (any string that identifies the holder, e.g. a
+browser id) and expires on its own unless it's renewed.  Leases live in
+groups, so that it's cheap to ask which leases in a group are currently held
+(e.g. which languages of a video are being edited).
+
+For each lease we store a Redis hash with the holder's session and owner, with
+a TTL.  For each group we store a sorted set of the names of its leases, scored
+by the time they expire.
+
+Acquiring, renewing and releasing are each a single round trip, done with
+small Lua scripts so that checking the holder and changing the lease happen
+atomically.  This needs Redis 2.6 or later.
+
+"""
+
+import time
+
+from utils.redis_utils import default_connection
+
+
+# KEYS: lease, group.  ARGV: session, owner, ttl, expires at, name.
+ACQUIRE_SCRIPT = """
+local session = redis.call('HGET', KEYS[1], 'session')
+if session and session ~= ARGV[1] then
+    return 0
+end
+redis.call('HMSET', KEYS[1], 'session', ARGV[1], 'owner', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# KEYS: lease, group.  ARGV: session, ttl, expires at, name.
+RENEW_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'session') ~= ARGV[1] then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+# KEYS: lease, group.  ARGV: session, name.
+RELEASE_SCRIPT = """
+local session = redis.call('HGET', KEYS[1], 'session')
+if session and session ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+class Lease(object):
+    def __init__(self, session, owner):
+        self.session = session
+        self.owner = owner
+
+    def __repr__(self):
+        return '<Lease session=%r owner=%r>' % (self.session, self.owner)
+
+
+class LeaseService(object):
+    """Acquire, renew and release leases that expire after `ttl` seconds."""
+
+    def __init__(self, prefix, ttl, connection=None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.r = connection or default_connection
+
+    def _lease_key(self, group, name):
+        return '%s:%s:%s' % (self.prefix, group, name)
+
+    def _group_key(self, group):
+        return '%s-group:%s' % (self.prefix, group)
+
+    def _eval(self, script, group, name, *args):
+        keys = [self._lease_key(group, name), self._group_key(group)]
+        return bool(self.r.execute_command('EVAL', script, len(keys),
+                                           *(keys + list(args))))
+
+    def acquire(self, group, name, session, owner=''):
+        """Take the lease, or renew it if `session` already holds it.
+
+        Returns whether the session holds the lease now.
+
+        """
+        return self._eval(ACQUIRE_SCRIPT, group, name, session, owner or '',
+                          self.ttl, time.time() + self.ttl, name)
+
+    def renew(self, group, name, session):
+        """Extend the lease if `session` holds it.  Returns whether it did."""
+        return self._eval(RENEW_SCRIPT, group, name, session, self.ttl,
+                          time.time() + self.ttl, name)
+
+    def release(self, group, name, session=None):
+        """Give up the lease.
+
+        If `session` is given, the lease is only released if that session holds
+        it.  Otherwise it's released no matter who holds it.  Returns whether
+        the lease is free now.
+
+        """
+        if session is None:
+            pipe = self.r.pipeline()
+            pipe.delete(self._lease_key(group, name))
+            pipe.zrem(self._group_key(group), name)
+            pipe.execute()
+            return True
+
+        return self._eval(RELEASE_SCRIPT, group, name, session, name)
+
+    def holder(self, group, name):
+        """Return the Lease currently held on the name, or None."""
+        data = self.r.hgetall(self._lease_key(group, name))
+        if not data:
+            return None
+        return Lease(data.get('session'), data.get('owner') or None)
+
+    def held(self, group):
+        """Return the names of the leases currently held in a group."""
+        return self.r.zrangebyscore(self._group_key(group), time.time(), '+inf')
+
+    def clear(self):
+        """Drop every lease.  This uses KEYS, so only use it in tests."""
+        keys = (self.r.keys('%s:*' % self.prefix) +
+                self.r.keys('%s-group:*' % self.prefix))
+        if keys:
+            self.r.delete(*keys)
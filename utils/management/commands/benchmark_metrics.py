@@ -0,0 +1,76 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Measure how much recording a metric costs."""
+
+import socket
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from utils import metrics
+
+
+class Command(BaseCommand):
+    help = ('Print the overhead per recorded metric of the buffered metrics '
+            'client, and of sending a datagram per event.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', action='store', dest='count', type='int',
+                    default=100000,
+                    help='Number of metrics to record in each run.'),
+    )
+
+    def _time(self, name, fn, count):
+        start = time.time()
+        for i in xrange(count):
+            fn()
+        us = (time.time() - start) / count * 1000000
+        print '%-36s %10.2f us' % (name, us)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        sent = []
+        aggregator = metrics.Aggregator(interval=None, transmit=sent.extend)
+
+        # Roughly what every metric used to cost: one datagram per event.  The
+        # port is the Riemann default, nothing needs to be listening.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        payload = 'x' * 100
+        def send_datagram():
+            sock.sendto(payload, ('127.0.0.1', 5555))
+
+        def timer():
+            start = time.time()
+            aggregator.count('benchmark.timer', 'meter')
+            aggregator.record('benchmark.timer', 'timer',
+                              (time.time() - start) * 1000)
+
+        print 'Overhead per recorded metric (%d runs):' % count
+        self._time('datagram per event (old)', send_datagram, count)
+        self._time('buffered meter', lambda: aggregator.count(
+            'benchmark.meter', 'meter'), count)
+        self._time('buffered histogram', lambda: aggregator.record(
+            'benchmark.histogram', 'histogram', 12.5), count)
+        self._time('buffered timer (meter + timer)', timer, count)
+
+        start = time.time()
+        aggregator.flush()
+        print '%-36s %10.2f ms (%d events)' % (
+            'flush', (time.time() - start) * 1000, len(sent))
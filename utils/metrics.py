@@ -16,7 +16,31 @@
 # along with this program.  If not, see
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
+"""Reporting metrics to Riemann.
+
+Recording a metric is cheap: it only updates an in-process buffer.  A
+background thread flushes the buffer every METRICS_FLUSH_INTERVAL seconds,
+sending the events in as few UDP datagrams as it can:
+
+* Meters and Occurrences are counters.  Each flush sends one event per name
+  with the total since the last flush.
+* Histograms and timers keep a count, sum, min and max, plus a fixed size
+  reservoir sample of the values they've seen.  Each flush sends a
+  `<name>.count`, `.mean`, `.max`, `.p50`, `.p95` and `.p99` event per name,
+  the percentiles coming from the reservoir.
+* Gauges are reported by periodic tasks, so they're sent right away.
+
+Set METRICS_FLUSH_INTERVAL to 0 to send every event as it is recorded, like
+we used to.
+
+"""
+
+import atexit
+import math
+import os
+import random
 import socket
+import threading
 import time as _time
 from contextlib import contextmanager
 from functools import wraps
@@ -24,7 +48,7 @@ from functools import wraps
 from django.conf import settings
 
 try:
-    from bernhard import Client, UDPTransport
+    from bernhard import Client, Event, Message, UDPTransport
 except ImportError:
     # Just use a dummy client if we don't have a Riemann client installed.
     class Client(object):
@@ -34,6 +58,10 @@ except ImportError:
         def send(self, *args, **kwargs):
             pass
 
+        def transmit(self, *args, **kwargs):
+            pass
+
+    Event = Message = lambda *args, **kwargs: None
     UDPTransport = None
 
 
@@ -49,6 +77,11 @@ else:
 HOST = socket.gethostname()
 ENABLED = (not RUNNING_TESTS) and getattr(settings, 'ENABLE_METRICS', False)
 RIEMANN_HOST = getattr(settings, 'RIEMANN_HOST', '127.0.0.1')
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+RESERVOIR_SIZE = getattr(settings, 'METRICS_RESERVOIR_SIZE', 128)
+
+# Events per datagram.  Keeps us well under the usual UDP size limits.
+BATCH_SIZE = 50
 
 c = Client(RIEMANN_HOST, transport=UDPTransport)
 
@@ -66,18 +99,221 @@ def find_environment_tag():
 
 ENV_TAG = find_environment_tag()
 
-def send(service, tag, metric=None):
+def _event(service, tag, metric=None):
     data = {'host': HOST, 'service': service, 'tags': [tag, ENV_TAG]}
 
     if metric:
         data['metric'] = metric
 
+    return data
+
+def send(service, tag, metric=None):
+    """Send a single event to Riemann right away."""
     if ENABLED:
         try:
-            c.send(data)
+            c.send(_event(service, tag, metric))
         except:
             pass
 
+def send_many(events):
+    """Send a list of events to Riemann, batching them into few datagrams."""
+    if not ENABLED:
+        return
+
+    for i in xrange(0, len(events), BATCH_SIZE):
+        batch = events[i:i + BATCH_SIZE]
+        try:
+            c.transmit(Message(events=[Event(params=e) for e in batch]))
+        except:
+            pass
+
+
+class Reservoir(object):
+    """Summary of a stream of values, with a uniform sample of them.
+
+    The sample uses reservoir sampling, so it stays `size` values big no
+    matter how many values are added.  Once the reservoir is full we use
+    Vitter's algorithm X to skip ahead to the next value that goes into the
+    sample, so adding a value `count` times costs one random draw per value
+    that's kept instead of one per copy.
+
+    """
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def _skip(self, limit):
+        """Return how many of the next values won't go into the sample.
+
+        The chance that the next s values are all skipped is a ratio of
+        factorials, so we can binary search for the skip that a single random
+        draw lands on.  Stops at `limit`.
+
+        """
+        t, n = self.count, self.size
+        log_u = math.log(1.0 - random.random())
+        base = math.lgamma(t - n + 1) - math.lgamma(t + 1)
+
+        lo, hi = 0, limit
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            # log of the chance that the next `mid` values are all skipped
+            log_p = math.lgamma(t + mid - n + 1) - math.lgamma(t + mid + 1) - base
+            if log_p > log_u:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def add(self, value, count=1):
+        self.total += value * count
+
+        fill = min(count, self.size - len(self.samples))
+        if fill > 0:
+            self.samples.extend([value] * fill)
+            self.count += fill
+            count -= fill
+
+        while count > 0:
+            skip = self._skip(count)
+            if skip >= count:
+                self.count += count
+                break
+            self.count += skip + 1
+            count -= skip + 1
+            self.samples[random.randrange(self.size)] = value
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def summary(self):
+        """Return a list of (stat name, value) pairs."""
+        return [
+            ('count', self.count),
+            ('mean', self.total / self.count),
+            ('max', self.max),
+            ('p50', self.percentile(0.50)),
+            ('p95', self.percentile(0.95)),
+            ('p99', self.percentile(0.99)),
+        ]
+
+
+class Aggregator(object):
+    """Buffers metrics in process and sends them in batches.
+
+    `transmit` is called with the list of events on every flush.  The flush
+    thread is started lazily, and again after a fork, since threads don't
+    survive forking (e.g. into celery or web workers).  If `interval` is 0 or
+    None there's no thread and flush() must be called by hand.
+
+    """
+    def __init__(self, interval=FLUSH_INTERVAL, transmit=send_many,
+                 reservoir_size=RESERVOIR_SIZE):
+        self.interval = interval
+        self.transmit = transmit
+        self.reservoir_size = reservoir_size
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._reset()
+
+    def _reset(self):
+        self.counters = {}
+        self.reservoirs = {}
+
+    def _ensure_thread(self):
+        if not self.interval:
+            # Flushed by hand.
+            return
+
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+
+        with self._lock:
+            if self._thread_pid == pid:
+                return
+            if self._thread_pid is not None:
+                # We were forked, and what's buffered belongs to the parent.
+                self._reset()
+            self._thread_pid = pid
+
+        thread = threading.Thread(target=self._run, name='metrics-flush')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            _time.sleep(self.interval)
+            self.flush()
+
+    def count(self, name, tag, n=1):
+        self._ensure_thread()
+        key = (name, tag)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, name, tag, value, count=1):
+        self._ensure_thread()
+        key = (name, tag)
+        with self._lock:
+            reservoir = self.reservoirs.get(key)
+            if reservoir is None:
+                reservoir = Reservoir(self.reservoir_size)
+                self.reservoirs[key] = reservoir
+            reservoir.add(value, count)
+
+    def events(self):
+        """Return the buffered metrics as events, and clear the buffer."""
+        with self._lock:
+            counters, reservoirs = self.counters, self.reservoirs
+            self._reset()
+
+        events = [_event(name, tag, n)
+                  for (name, tag), n in counters.iteritems()]
+        for (name, tag), reservoir in reservoirs.iteritems():
+            for stat, value in reservoir.summary():
+                events.append(_event('%s.%s' % (name, stat), tag, value))
+        return events
+
+    def flush(self):
+        events = self.events()
+        if events:
+            self.transmit(events)
+
+
+aggregator = Aggregator()
+
+if ENABLED and FLUSH_INTERVAL:
+    atexit.register(aggregator.flush)
+
+def _count(name, tag, n=1):
+    if not ENABLED:
+        return
+    if FLUSH_INTERVAL:
+        aggregator.count(name, tag, n)
+    else:
+        send(name, tag, n)
+
+def _record(name, tag, value, count=1):
+    if not ENABLED:
+        return
+    if FLUSH_INTERVAL:
+        aggregator.record(name, tag, value, count)
+    else:
+        for _ in xrange(count):
+            send(name, tag, value)
+
 
 class Metric(object):
     def __init__(self, name):
@@ -86,15 +322,15 @@ class Metric(object):
 
 class Occurrence(Metric):
     def mark(self):
-        send(self.name, 'occurrence')
+        _count(self.name, 'occurrence')
 
 class Meter(Metric):
     def inc(self, n=1):
-        send(self.name, 'meter', n)
+        _count(self.name, 'meter', n)
 
 class Histogram(Metric):
-    def record(self, value):
-        send(self.name, 'histogram', value)
+    def record(self, value, count=1):
+        _record(self.name, 'histogram', value, count)
 
 class Gauge(Metric):
     def __init__(self, name):
@@ -117,7 +353,7 @@ def Timer(name):
         yield
     finally:
         ms = (_time.time() - start) * 1000
-        send(name, 'timer', ms)
+        _record(name, 'timer', ms)
 
 
 def time(f):
@@ -154,5 +390,5 @@ def time_as(name):
 
 
 class ManualTimer(Metric):
-    def record(self, value):
-        send(self.name, 'timer', value)
+    def record(self, value, count=1):
+        _record(self.name, 'timer', value, count)
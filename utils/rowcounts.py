@@ -0,0 +1,162 @@
+# Amara, universalsubtitles.org
+#
+# Copyright (C) 2012 Participatory Culture Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see
+# http://www.gnu.org/licenses/agpl-3.0.html.
+
+"""Approximate row counts, for the gauge tasks.
+
+COUNT(*) on a big InnoDB table is a full index scan, which is too much to do
+every few seconds.  Instead, each RowCounter keeps a total in Redis:
+
+* post_save and post_delete signals of the models it tracks add to and take
+  from it as rows come and go.
+* Every ROW_COUNT_RECONCILE_INTERVAL seconds, value() replaces it with an
+  exact count.  This fixes whatever the signals missed, like bulk_create(),
+  raw SQL and saves made while Redis was down.
+
+Counters are registered by name where their models are defined, so that the
+signals are connected in every process that saves them:
+
+    rowcounts.register('videos.Video', Video.objects.count).track(Video)
+
+and read by name with rowcounts.value('videos.Video').
+
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from utils.redis_utils import default_connection, IGNORE_REDIS
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = getattr(settings, 'ROW_COUNT_RECONCILE_INTERVAL',
+                             60 * 60)
+
+
+class RowCounter(object):
+    """An approximate count of rows, kept in Redis.
+
+    `count` is called with no arguments to get the exact count.
+
+    """
+    def __init__(self, name, count, interval=RECONCILE_INTERVAL,
+                 connection=default_connection):
+        self.name = name
+        self.count = count
+        self.interval = interval
+        self.connection = connection
+        self.key = 'row-count:%s' % name
+        self.reconciled_key = 'row-count:%s:reconciled' % name
+
+    def track(self, model, on_save=None, on_delete=None):
+        """Keep the count up to date as rows of `model` are saved and deleted.
+
+        By default creating a row adds one and deleting one takes one away.
+        `on_save(instance, created)` and `on_delete(instance)` can return the
+        change instead, for counts of something other than all of a model's
+        rows.  Returns the counter, so calls can be chained.
+
+        """
+        def saved(sender, instance, created, raw=False, **kwargs):
+            if raw:
+                return
+            self.add(on_save(instance, created) if on_save else int(created))
+
+        def deleted(sender, instance, **kwargs):
+            self.add(on_delete(instance) if on_delete else -1)
+
+        uid = 'rowcounts.%s.%s' % (self.name, model._meta.object_name)
+        post_save.connect(saved, model, weak=False, dispatch_uid=uid)
+        post_delete.connect(deleted, model, weak=False, dispatch_uid=uid)
+        return self
+
+    def add(self, n):
+        if not n or IGNORE_REDIS:
+            return
+        try:
+            self.connection.incr(self.key, n)
+        except Exception:
+            # Never fail a save over a gauge; the next reconcile fixes it.
+            logger.exception('Error updating row count %s', self.name)
+
+    def claim(self, token):
+        """Return True unless `token` has been claimed since it was released.
+
+        For on_delete callbacks that can't tell whether a change has been
+        counted already.  Claims last until the next reconcile at most.
+
+        """
+        if IGNORE_REDIS:
+            return True
+        key = '%s:claim:%s' % (self.key, token)
+        try:
+            pipe = self.connection.pipeline()
+            pipe.setnx(key, 1)
+            pipe.expire(key, self.interval)
+            return bool(pipe.execute()[0])
+        except Exception:
+            logger.exception('Error claiming %s for row count %s', token,
+                             self.name)
+            return True
+
+    def release(self, token):
+        if IGNORE_REDIS:
+            return
+        try:
+            self.connection.delete('%s:claim:%s' % (self.key, token))
+        except Exception:
+            logger.exception('Error releasing %s for row count %s', token,
+                             self.name)
+
+    def reconcile(self):
+        """Replace the count with an exact one, and return it."""
+        value = self.count()
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.set(self.key, value)
+        pipe.set(self.reconciled_key, int(time.time()))
+        pipe.expire(self.reconciled_key, self.interval)
+        pipe.execute()
+        return value
+
+    def value(self):
+        """Return the count, reconciling it first if it's due."""
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.get(self.key)
+        pipe.exists(self.reconciled_key)
+        value, fresh = pipe.execute()
+
+        if value is None or not fresh:
+            return self.reconcile()
+        return max(int(value), 0)
+
+
+_counters = {}
+
+def register(name, count, **kwargs):
+    """Register a RowCounter, or return the one already registered as name."""
+    if name not in _counters:
+        _counters[name] = RowCounter(name, count, **kwargs)
+    return _counters[name]
+
+def counter(name):
+    return _counters[name]
+
+def value(name):
+    return _counters[name].value()
@@ -17,14 +17,22 @@
 # along with this program. If not, see
 # http://www.gnu.org/licenses/agpl-3.0.html.
 
+import threading
+import time
 from string import printable as chars
 from random import randint, choice
 
+from django.core.cache import cache
 from django.test import TestCase
+from subtitles.tests.utils import make_sl, make_video
 from videos.models import Video
 from utils.multi_query_set import MultiQuerySet
+from utils import rowcounts
 from utils.compress import compress, decompress
 from utils.chunkediter import chunkediter
+from utils.cachefill import get_or_fill, jittered
+from utils.leases import LeaseService
+from utils.metrics import Aggregator, Reservoir
 from utils.unisubsmarkup import html_to_markup, markup_to_html
 
 
@@ -187,6 +195,210 @@ class ChunkedIterTest(TestCase):
         self.assertEqual(sum, 0)
 
 
+class CacheFillTest(TestCase):
+    def setUp(self):
+        cache.delete_many(['cachefill-test', 'cachefill-test-stale'])
+
+    def _run_concurrently(self, compute, stale_key=None, workers=10):
+        results = []
+        def worker():
+            results.append(get_or_fill('cachefill-test', compute, 60,
+                                       stale_key))
+
+        threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'fresh'
+
+        results = self._run_concurrently(compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['fresh'] * 10)
+        self.assertEqual(cache.get('cachefill-test'), 'fresh')
+
+    def test_serve_stale(self):
+        cache.set('cachefill-test-stale', 'stale')
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'fresh'
+
+        results = self._run_concurrently(compute, 'cachefill-test-stale')
+        self.assertEqual(len(calls), 1)
+        # Threads that start after the fill get the fresh value, so how many
+        # were handed the stale one depends on timing.
+        self.assertEqual(len(results), 10)
+        self.assertTrue('fresh' in results)
+        self.assertEqual(set(results) - set(['fresh', 'stale']), set())
+        self.assertEqual(cache.get('cachefill-test-stale'), 'fresh')
+
+    def test_none_is_not_stored(self):
+        calls = []
+        def compute():
+            calls.append(1)
+
+        self.assertEqual(get_or_fill('cachefill-test', compute, 60), None)
+        self.assertEqual(get_or_fill('cachefill-test', compute, 60), None)
+        self.assertEqual(len(calls), 2)
+
+    def test_jittered(self):
+        for _ in xrange(100):
+            timeout = jittered(1000)
+            self.assertTrue(900 <= timeout <= 1000)
+
+
+class MetricsAggregatorTest(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.aggregator = Aggregator(interval=None, transmit=self.sent.extend)
+
+    def _metrics(self):
+        return dict((e['service'], e.get('metric')) for e in self.sent)
+
+    def test_counters(self):
+        for _ in xrange(3):
+            self.aggregator.count('requests', 'meter')
+        self.aggregator.count('requests', 'meter', 5)
+        self.aggregator.flush()
+
+        self.assertEqual(self._metrics(), {'requests': 8})
+
+        # The buffer is emptied by a flush.
+        self.sent[:] = []
+        self.aggregator.flush()
+        self.assertEqual(self.sent, [])
+
+    def test_histograms(self):
+        for value in xrange(1, 101):
+            self.aggregator.record('query-time', 'timer', value)
+        self.aggregator.record('query-time', 'timer', 1000, count=100)
+        self.aggregator.flush()
+
+        metrics = self._metrics()
+        self.assertEqual(metrics['query-time.count'], 200)
+        self.assertEqual(metrics['query-time.max'], 1000)
+        self.assertAlmostEqual(metrics['query-time.mean'], 525.25)
+        self.assertEqual(set(e['tags'][0] for e in self.sent), set(['timer']))
+
+    def test_reservoir_is_bounded(self):
+        reservoir = Reservoir(size=10)
+        for value in xrange(1000):
+            reservoir.add(value)
+
+        self.assertEqual(len(reservoir.samples), 10)
+        self.assertEqual(reservoir.count, 1000)
+        self.assertEqual((reservoir.min, reservoir.max), (0, 999))
+        self.assertTrue(all(0 <= v < 1000 for v in reservoir.samples))
+
+    def test_reservoir_weighted_add(self):
+        reservoir = Reservoir(size=10)
+        reservoir.add(1, count=5)
+        reservoir.add(2, count=10 ** 9)
+
+        self.assertEqual(reservoir.count, 10 ** 9 + 5)
+        self.assertEqual(len(reservoir.samples), 10)
+        self.assertTrue(set(reservoir.samples) <= set([1, 2]))
+        self.assertAlmostEqual(reservoir.total, 5 + 2 * 10 ** 9)
+        self.assertEqual((reservoir.min, reservoir.max), (1, 2))
+
+
+class RowCountsTest(TestCase):
+    def setUp(self):
+        self.videos = rowcounts.counter('videos.Video')
+        self.captioned = rowcounts.counter('videos.Video-captioned')
+        self.video_count = self.videos.reconcile()
+        self.captioned_count = self.captioned.reconcile()
+
+    def test_tracks_saves_and_deletes(self):
+        video = make_video()
+        self.assertEqual(self.videos.value(), self.video_count + 1)
+        self.assertEqual(self.captioned.value(), self.captioned_count)
+
+        en = make_sl(video, 'en')
+        fr = make_sl(video, 'fr')
+        self.assertEqual(self.captioned.value(), self.captioned_count + 1)
+        en.delete()
+        self.assertEqual(self.captioned.value(), self.captioned_count + 1)
+        fr.delete()
+        self.assertEqual(self.captioned.value(), self.captioned_count)
+
+        video.delete()
+        self.assertEqual(self.videos.value(), self.video_count)
+
+    def test_cascade_counts_video_once(self):
+        video = make_video()
+        make_sl(video, 'en')
+        make_sl(video, 'fr')
+        self.assertEqual(self.captioned.value(), self.captioned_count + 1)
+
+        video.delete()
+        self.assertEqual(self.captioned.value(), self.captioned_count)
+        self.assertEqual(self.videos.value(), self.video_count)
+
+    def test_queryset_delete_counts_video_once(self):
+        video = make_video()
+        make_sl(video, 'en')
+        make_sl(video, 'fr')
+        video.newsubtitlelanguage_set.all().delete()
+        self.assertEqual(self.captioned.value(), self.captioned_count)
+
+        # It counts again once it has languages again.
+        make_sl(video, 'de')
+        self.assertEqual(self.captioned.value(), self.captioned_count + 1)
+        video.newsubtitlelanguage_set.all().delete()
+        self.assertEqual(self.captioned.value(), self.captioned_count)
+
+    def test_reconcile(self):
+        self.videos.add(10)
+        self.assertEqual(self.videos.value(), self.video_count + 10)
+
+        # Once the last reconcile expires, the next read recounts.
+        self.videos.connection.delete(self.videos.reconciled_key)
+        self.assertEqual(self.videos.value(), self.video_count)
+
+
+class LeaseServiceTest(TestCase):
+    def setUp(self):
+        self.leases = LeaseService('test-lease', 30)
+        self.leases.clear()
+
+    def tearDown(self):
+        self.leases.clear()
+
+    def test_acquire_renew_release(self):
+        self.assertTrue(self.leases.acquire('video', 'en', 'a', 1))
+        self.assertTrue(self.leases.acquire('video', 'en', 'a', 1))
+        self.assertFalse(self.leases.acquire('video', 'en', 'b', 2))
+
+        lease = self.leases.holder('video', 'en')
+        self.assertEqual(lease.session, 'a')
+        self.assertEqual(lease.owner, '1')
+        self.assertEqual(self.leases.held('video'), ['en'])
+
+        self.assertTrue(self.leases.renew('video', 'en', 'a'))
+        self.assertFalse(self.leases.renew('video', 'en', 'b'))
+        self.assertFalse(self.leases.renew('video', 'fr', 'a'))
+
+        self.assertFalse(self.leases.release('video', 'en', 'b'))
+        self.assertTrue(self.leases.release('video', 'en', 'a'))
+        self.assertEqual(self.leases.holder('video', 'en'), None)
+        self.assertEqual(self.leases.held('video'), [])
+
+        self.assertTrue(self.leases.acquire('video', 'en', 'b', None))
+        self.assertEqual(self.leases.holder('video', 'en').owner, None)
+        self.leases.release('video', 'en')
+        self.assertTrue(self.leases.acquire('video', 'en', 'a', 1))
+
+
 class MarkupHtmlTest(TestCase):
     def test_markup_to_html(self):
         t = "there **bold text** there"